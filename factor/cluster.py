@@ -212,6 +212,27 @@ def get_compute_nodes(clusterdesc_file):
     return sorted(clusterdesc.get_compute_nodes(cluster))
 
 
+def get_total_memory():
+    """
+    Returns the total memory of this machine
+
+    Returns
+    -------
+    result : float
+        Total memory in MB (0 if it cannot be determined)
+
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    return float(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+
+    return 0.0
+
+
 def find_executables(parset):
     """
     Adds the paths to required executables to parset dict
@@ -5,9 +5,11 @@ import os
 import numpy as np
 import logging
 from factor.lib.direction import Direction
-from factor.lib.polygon import Polygon
+from factor.lib.polygon import Polygon, rasterize
 import sys
-from scipy.spatial import Delaunay
+from scipy.spatial import Delaunay, cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 
 #multiprocessing required to faster uniformity search
 from multiprocessing import Pool
@@ -126,7 +128,7 @@ def directions_read(directions_file, factor_working_dir):
     return data
 
 
-def chooseGroupSize(K,ncpu=1,timeFactor=32*11.7/3.17e6,maxTime=None,minGroupSize=5,plot=False):
+def chooseGroupSize(K,ncpu=1,timeFactor=1.1e-8,maxTime=None,minGroupSize=5,plot=False):
     '''
     The sum of uniformly distributed ensembles should be uniform, so choose
     groupSizes to search within maxTime. Chooses the partitioning of
@@ -150,7 +152,8 @@ def chooseGroupSize(K,ncpu=1,timeFactor=32*11.7/3.17e6,maxTime=None,minGroupSize
         Convert complexity to time (I calibrated on Leiden Paracluster)
         Calibrated for big enough groupSize0,searchDepth0 as
         Ncpu*time(groupSize0,searchDepth0)[seconds]/computations(groupSize0,
-        searchDepth0)
+        searchDepth0), where the computations of one NU() evaluation scale as
+        (number of spacings)*(UV grid size)
     maxTime : float, optional
         Max time in minutes to let it run approximately
     minGroupSize : int, optional
@@ -161,7 +164,7 @@ def chooseGroupSize(K,ncpu=1,timeFactor=32*11.7/3.17e6,maxTime=None,minGroupSize
         maxTime = np.inf
     G,N = [],[]
     while groupSize < K:
-        computeSize = (groupSize*(groupSize - 1)/2.)**2
+        computeSize = groupSize*(groupSize - 1)/2.*(2*groupSize + 1)**2
         for n in [2,3,4,5]:
             if (K % groupSize) < minGroupSize + n:#remainder will be less than 5 (so not good uniformity)
                 groupSize += 1
@@ -188,63 +191,161 @@ def chooseGroupSize(K,ncpu=1,timeFactor=32*11.7/3.17e6,maxTime=None,minGroupSize
 def NU(arg):
     '''
     L2 non-uniformity of the spacings between the calibrators.
-    arg is a nest tuple for multiprocessing. This could be sped up definitely by precomputing spacings,
-    essentially getting rid of the nest while loops. Ask Joshua Albert
+    arg is a nest tuple for multiprocessing. Ask Joshua Albert for details
+
+    The sum over all pairs of spacings (i, ip), (j, jp) of
+    2*cos((s_ij - s_ipjp).k) equals 2*|sum_ij exp(i s_ij.k)|**2, so S_uv is
+    found from the phasor sum over the spacings only. As the UV grid is
+    regular, this sum is a single matrix product of the phasors along U and
+    along V
     '''
-    cals = arg[0]#idicies of calibrators to calculate over
+    cals = np.asarray(arg[0])#idicies of calibrators to calculate over
     subarg = arg[1]#nest tuple
-    x = subarg[0]#ra of all calibrators
-    y = subarg[1]#dec of all calibrators
+    x = np.asarray(subarg[0])[cals]#ra of the calibrators
+    y = np.asarray(subarg[1])[cals]#dec of the calibrators
     numClusters = np.size(cals)#number of calibrators
     if numClusters == 1:#otherwise you get divide by zero
         nonuni = numClusters**2/(numClusters**4*(numClusters**2 - 2*numClusters + 3)**2/4.)
         return nonuni
 
     #get nyquist sampling size
-    maxU = 0.
-    maxV = 0.
-    i = 0
-    while i < numClusters:
-        ic = cals[i]#Index of calibrator
-        j = 0
-        while j < numClusters:
-            jc = cals[j]#Index of cal_j
-            maxU = max(np.abs(x[ic] - x[jc]),maxU)
-            maxV = max(np.abs(y[ic] - y[jc]),maxV)
-            j += 1
-        i += 1
+    maxU = np.max(x) - np.min(x)
+    maxV = np.max(y) - np.min(y)
     dU_ = 2./maxU
     dV_ = 2./maxV
     vecU_ = np.linspace(-numClusters*dU_,numClusters*dU_,2*numClusters+1)
     vecV_ = np.linspace(-numClusters*dV_,numClusters*dV_,2*numClusters+1)
-    #S_uv carries information on distribution.
-    S_uv = np.ones([np.size(vecU_),np.size(vecV_)])*numClusters**2
-    U_,V_ = np.meshgrid(vecU_,vecV_)
-    ip = 0
-    while ip < numClusters:
-        ipc = cals[ip]
-        jp = 0
-        while jp < numClusters:
-            jpc = cals[jp]
-            i = 0
-            while i < ip:
-                ic = cals[i]
-                j = 0
-                while j < jp:
-                    jc = cals[j]
-                    #was too lazy to efficiently code this loop, precomputing things is possible
-                    S_uv += 2.*np.cos((x[ic]-x[jc] - x[ipc]+x[jpc])*U_ + (y[ic]-y[jc] - y[ipc]+y[jpc])*V_)
-                    j += 1
-                i += 1
-            jp += 1
-        ip += 1
+
+    #spacings s_ij for all pairs i < j
+    i, j = np.triu_indices(numClusters, 1)
+    dx = x[i] - x[j]
+    dy = y[i] - y[j]
+
+    #S_uv carries information on distribution. Rows are V and columns U, as
+    #given by np.meshgrid(vecU_,vecV_)
+    F_uv = np.dot(np.exp(1j*np.outer(dy,vecV_)).T, np.exp(1j*np.outer(dx,vecU_)))
+    S_uv = numClusters**2 + 2.*np.abs(F_uv)**2
     S_mu = np.mean(S_uv)
     nonuni = np.sum(np.abs(S_uv - S_mu)**2)/(numClusters**4*(numClusters**2 - 2*numClusters + 3)**2/4.)
     return nonuni
 
+def find_uniform_calibrators(pRA, pDec, fluxes, K, ncpu=1, maxTime=5.,
+    seed=0):
+    """
+    Selects K calibrators that minimize non-uniformity with a heuristic search
+
+    The selection is seeded greedily (starting from the brightest calibrator,
+    the calibrator that gives the lowest non-uniformity is added until K are
+    selected) and then improved by simulated annealing, in which a selected
+    calibrator is swapped for an unselected one at random. The best selection
+    found so far is kept, so the search can be stopped at any time. As NU()
+    depends on the order of the calibrators, selections are always evaluated
+    in order of decreasing flux density (as in the search over combinations
+    of flux-sorted calibrators)
+
+    Parameters
+    ----------
+    pRA : array
+        RA of all calibrators
+    pDec : array
+        Dec of all calibrators
+    fluxes : list
+        Flux densities of all calibrators
+    K : int
+        Number of calibrators to select
+    ncpu : int, optional
+        Number of processes to use for the greedy seeding
+    maxTime : float, optional
+        Maximum time in minutes to search. Half of it at most is used for the
+        greedy seeding. None -> search until no improvement is found in
+        20*(number of calibrators) swaps
+    seed : int, optional
+        Seed of the random number generator, so that the selection is
+        reproducible
+
+    Returns
+    -------
+    calibratorSet : list
+        Indices of the selected calibrators
+
+    """
+    order = np.argsort(fluxes)[::-1].tolist()
+    N = len(order)
+    if K >= N:
+        return order
+    rank = dict([(c, i) for i, c in enumerate(order)])
+
+    t0 = time.time()
+    if maxTime is None:
+        t_end = np.inf
+    else:
+        t_end = t0 + maxTime*60.
+    t_greedy_end = t0 + (t_end - t0)/2.
+
+    # Greedy seeding. Candidates are in order of decreasing flux density, so
+    # ties go to the brighter calibrator
+    selected = order[:1]
+    remaining = order[1:]
+    p = Pool(ncpu)
+    while len(selected) < K:
+        if time.time() > t_greedy_end:
+            log.info('Time limit for greedy calibrator selection reached. Adding '
+                'the {} brightest remaining calibrators'.format(K-len(selected)))
+            nmissing = K - len(selected)
+            selected += remaining[:nmissing]
+            remaining = remaining[nmissing:]
+            break
+        NU_Candidates = p.map(NU, itertools.product([sorted(selected+[c],
+            key=rank.get) for c in remaining], [[pRA,pDec]]))
+        selected.append(remaining.pop(int(np.argmin(NU_Candidates))))
+        selected.sort(key=rank.get)
+    p.close()
+    p.join()
+    current = NU((selected, [pRA,pDec]))
+    log.info('Non-uniformity after greedy selection: {0} ({1} seconds)'.format(current,
+        time.time()-t0))
+
+    # Simulated annealing over swaps of a selected and an unselected calibrator,
+    # with the temperature decreasing linearly to zero over the remaining time
+    rng = np.random.RandomState(seed)
+    best, bestSet = current, selected[:]
+    T0 = 0.01*current
+    t_anneal = time.time()
+    nswaps = 0
+    naccepted = 0
+    last_improvement = 0
+    while len(remaining) > 0 and nswaps - last_improvement < 20*N:
+        t = time.time()
+        if t > t_end:
+            break
+        nswaps += 1
+        i = rng.randint(K)
+        j = rng.randint(len(remaining))
+        trial = selected[:]
+        trial[i] = remaining[j]
+        trial.sort(key=rank.get)
+        value = NU((trial, [pRA,pDec]))
+        if np.isinf(t_end):
+            T = T0 / nswaps
+        else:
+            T = T0*max(0., (t_end - t)/(t_end - t_anneal))
+        if value < current or (T > 0. and rng.rand() < np.exp(-(value-current)/T)):
+            remaining[j] = selected[i]
+            selected = trial
+            naccepted += 1
+            current = value
+            if current < best:
+                best, bestSet = current, selected[:]
+                last_improvement = nswaps
+    log.info('Non-uniformity after {0} trial swaps ({1} accepted): {2} ({3} seconds '
+        'in total)'.format(nswaps, naccepted, best, time.time()-t0))
+
+    return bestSet
+
 def make_directions_file_from_skymodel_uniform(s, flux_min_Jy, size_max_arcmin,
     directions_separation_max_arcmin, directions_max_num=None, interactive=False,
-    flux_min_for_merging_Jy=0.1,ncpu=1,maxTime=5.,groupSize=None,searchDepth=None):
+    flux_min_for_merging_Jy=0.1,ncpu=1,maxTime=5.,groupSize=None,searchDepth=None,
+    search='groups'):
     """
     (parallel using mp)
     Selects appropriate calibrators from sky models and makes the directions file
@@ -279,6 +380,11 @@ def make_directions_file_from_skymodel_uniform(s, flux_min_Jy, size_max_arcmin,
     searchDepth : int, optional
         how deep to search iteratively. You will iteratively search groupSize + searchDepth
         of the **remaining brightest** calbrators for uniformly distributed ones.
+    search : str, optional
+        Search strategy: 'groups' (search all combinations in the iterative
+        groups described above) or 'anneal' (select from all calibrators with
+        greedy seeding and simulated annealing, keeping the best selection
+        found within maxTime; see find_uniform_calibrators())
 
     Returns
     -------
@@ -309,13 +415,7 @@ def make_directions_file_from_skymodel_uniform(s, flux_min_Jy, size_max_arcmin,
     # Look for nearby pairs
     log.info('Merging sources within {0} arcmin of each other...'.format(
         directions_separation_max_arcmin))
-    pRA, pDec = s.getPatchPositions(asArray=True)
-    for ra, dec in zip(pRA.tolist()[:], pDec.tolist()[:]):
-        dist = s.getDistance(ra, dec, byPatch=True, units='arcmin')
-        nearby = np.where(dist < directions_separation_max_arcmin)
-        if len(nearby[0]) > 1:
-            patches = s.getPatchNames()[nearby]
-            s.merge(patches.tolist())
+    merge_nearby_patches(s, directions_separation_max_arcmin)
 
     # Filter fainter patches on user flux-density limit
     s.select('I > {0} Jy'.format(flux_min_Jy), aggregate='sum', force=True)
@@ -336,6 +436,10 @@ def make_directions_file_from_skymodel_uniform(s, flux_min_Jy, size_max_arcmin,
         dir_fluxes = s.getColValues('I', aggregate='sum').tolist()
         dir_fluxes_sorted_arg = np.argsort(dir_fluxes)[::-1]#reverse view of sorted args
 
+    if directions_max_num is not None and search == 'anneal':
+        calibratorSet = find_uniform_calibrators(pRA, pDec, dir_fluxes,
+            directions_max_num, ncpu=ncpu, maxTime=maxTime)
+    elif directions_max_num is not None:
         p = Pool(ncpu)
         # if you want to set a time limit then let this do that, otherwise you might wait a long time.
         # Will search iteratively in groups of (groupSize + searchDepth) for groupSize calibrators until directions_max_num are found or calibrator set is empty
@@ -346,15 +450,11 @@ def make_directions_file_from_skymodel_uniform(s, flux_min_Jy, size_max_arcmin,
         calibratorSet = []
         while (len(calibratorSet) < directions_max_num) and (len(dir_fluxes) - len(calibratorSet) > 0):
             searchGroup = dir_fluxes_sorted_arg[:min(groupSize+searchDepth,np.size(dir_fluxes_sorted_arg))]
-            calibratorGroupCombinations = itertools.combinations(searchGroup,groupSize)
+            calibratorGroupCombinations = list(itertools.combinations(searchGroup,groupSize))
             t1 = time.time()
             NU_Grouping = p.map(NU,itertools.product(calibratorGroupCombinations,[[pRA,pDec]]))
             log.info('Time for groupSearch: {0} was {1} seconds'.format(groupSize,(time.time()-t1)))
-            min_NU_i = np.argmin(NU_Grouping)
-            c = 0#retrieve the winner
-            while c <= min_NU_i:
-                combination = calibratorGroupCombinations.next()
-                c += 1
+            combination = calibratorGroupCombinations[np.argmin(NU_Grouping)]#retrieve the winner
             #Create new reduced list and iterate the next group until desired number selected
             new_dir_fluxes_sorted_arg = []
             for calibrator in dir_fluxes_sorted_arg:
@@ -363,6 +463,10 @@ def make_directions_file_from_skymodel_uniform(s, flux_min_Jy, size_max_arcmin,
                 else:
                     calibratorSet.append(calibrator)
                 dir_fluxes_sorted_arg = np.array(new_dir_fluxes_sorted_arg)
+        p.close()
+        p.join()
+
+    if directions_max_num is not None:
         #calibratorSet contains the indices of the selected calibrators
         #keep only indices that are in the set
         selection = np.in1d(np.arange(np.size(s.getColValues('I', aggregate='sum').tolist())),calibratorSet)
@@ -387,6 +491,109 @@ def make_directions_file_from_skymodel_uniform(s, flux_min_Jy, size_max_arcmin,
 
     return directions_file
 
+def find_groups_within_separation(RA, Dec, separation_max_arcmin, ref_ind=None):
+    """
+    Finds groups of positions that are linked by separations below a limit
+
+    The positions are placed on the unit sphere in a KD-tree, and all pairs
+    within the limit are found in one query. The groups are the connected
+    components of the graph of these pairs
+
+    Parameters
+    ----------
+    RA : array
+        RA values in degrees
+    Dec : array
+        Dec values in degrees
+    separation_max_arcmin : float
+        Maximum separation in arcmin between two linked positions
+    ref_ind : array, optional
+        If given, only the positions with these indices (the reference
+        positions) are linked to each other, and every other position is linked
+        only to the nearest reference position within the limit. Two reference
+        positions are therefore never grouped through another position
+
+    Returns
+    -------
+    labels : array
+        Group number for each position
+
+    """
+    RA = np.radians(np.atleast_1d(RA))
+    Dec = np.radians(np.atleast_1d(Dec))
+    xyz = np.vstack([np.cos(Dec) * np.cos(RA), np.cos(Dec) * np.sin(RA),
+        np.sin(Dec)]).T
+    N = len(xyz)
+
+    # Chord length corresponding to the maximum separation
+    radius = 2.0 * np.sin(np.radians(separation_max_arcmin / 60.0) / 2.0)
+    tree = cKDTree(xyz)
+    if ref_ind is None:
+        pairs = np.array(list(tree.query_pairs(radius)), dtype=int).reshape(-1, 2)
+    else:
+        ref_ind = np.atleast_1d(ref_ind)
+        ref_tree = cKDTree(xyz[ref_ind])
+        pairs = [(ref_ind[i], ref_ind[j]) for i, j in ref_tree.query_pairs(radius)]
+        other_ind = np.setdiff1d(np.arange(N), ref_ind)
+        if len(other_ind) > 0:
+            dist, nearest = ref_tree.query(xyz[other_ind], distance_upper_bound=radius)
+            in_range = np.isfinite(dist)
+            pairs.extend(zip(other_ind[in_range], ref_ind[nearest[in_range]]))
+        pairs = np.array(pairs, dtype=int).reshape(-1, 2)
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])),
+        shape=(N, N))
+    ngroups, labels = connected_components(graph, directed=False)
+
+    return labels
+
+
+def merge_nearby_patches(s, separation_max_arcmin, calibrator_names=None):
+    """
+    Merges patches of a sky model that lie within a separation of each other
+
+    Parameters
+    ----------
+    s : LSMTool SkyModel object
+        Sky model with patches
+    separation_max_arcmin : float
+        Maximum separation in arcmin between two patches for merging
+    calibrator_names : list, optional
+        Names of calibrator patches. If given, each other patch is merged only
+        with the nearest calibrator within the separation, calibrators within
+        the separation of each other are merged, and the merged patch gets the
+        name of the first calibrator in the list
+
+    """
+    pRA, pDec = s.getPatchPositions(asArray=True)
+    names = s.getPatchNames()
+    if calibrator_names is not None:
+        names_list = names.tolist()
+        ref_ind = np.array([names_list.index(calibrator_name) for
+            calibrator_name in calibrator_names if calibrator_name in names_list])
+        if len(ref_ind) == 0:
+            return
+    else:
+        ref_ind = None
+    labels = find_groups_within_separation(pRA, pDec, separation_max_arcmin,
+        ref_ind=ref_ind)
+
+    groups = [np.where(labels == label)[0] for label in np.unique(labels)]
+    for group in groups:
+        if len(group) < 2:
+            continue
+        patches = names[group].tolist()
+        if calibrator_names is not None:
+            # Ensure that calibrator patch is first in list (as merged
+            # patch will get its name). If there are two calibrator patches
+            # in the list, use the first one
+            for calibrator_name in calibrator_names:
+                if calibrator_name in patches:
+                    patches.remove(calibrator_name)
+                    patches.insert(0, calibrator_name)
+                    break
+        s.merge(patches)
+
+
 def make_directions_file_from_skymodel(s, flux_min_Jy, size_max_arcmin,
     directions_separation_max_arcmin, directions_max_num=None, interactive=False,
     flux_min_for_merging_Jy=0.1):
@@ -444,13 +651,7 @@ def make_directions_file_from_skymodel(s, flux_min_Jy, size_max_arcmin,
     # Look for nearby pairs
     log.info('Merging sources within {0} arcmin of each other...'.format(
         directions_separation_max_arcmin))
-    pRA, pDec = s.getPatchPositions(asArray=True)
-    for ra, dec in zip(pRA.tolist()[:], pDec.tolist()[:]):
-        dist = s.getDistance(ra, dec, byPatch=True, units='arcmin')
-        nearby = np.where(dist < directions_separation_max_arcmin)
-        if len(nearby[0]) > 1:
-            patches = s.getPatchNames()[nearby]
-            s.merge(patches.tolist())
+    merge_nearby_patches(s, directions_separation_max_arcmin)
     # update patch positions
     s.setPatchPositions(method='mid')
 
@@ -480,24 +681,9 @@ def make_directions_file_from_skymodel(s, flux_min_Jy, size_max_arcmin,
         log.info('Merging extended sources within {0} arcmin of calibrators...'.format(
             directions_separation_max_arcmin))
         calibrator_names = s.getPatchNames().tolist()
-        # calibrator positions
-        pRA, pDec = s.getPatchPositions(asArray=True)
         s.concatenate(s_large)
-        for ra, dec in zip(pRA.tolist()[:], pDec.tolist()[:]):
-            dist = s.getDistance(ra, dec, byPatch=True, units='arcmin')
-            nearby = np.where(dist < directions_separation_max_arcmin)
-            if len(nearby[0]) > 1:
-                patches = s.getPatchNames()[nearby].tolist()
-
-                # Ensure that calibrator patch is first in list (as merged
-                # patch will get its name). If there are two calibrator patches
-                # in the list, use the first one
-                for calibrator_name in calibrator_names:
-                    if calibrator_name in patches:
-                        patches.remove(calibrator_name)
-                        patches.insert(0, calibrator_name)
-                        break
-                s.merge(patches)
+        merge_nearby_patches(s, directions_separation_max_arcmin,
+            calibrator_names=calibrator_names)
 
         # Remove any non-calibrator patches from the merged model
         all_names = s.getPatchNames().tolist()
@@ -729,9 +915,9 @@ def thiessen(directions_list, field_ra_deg, field_dec_deg, faceting_radius_deg,
     fov_poly = Polygon(fx, fy)
 
     points, _, _ = getxy(directions_list, field_ra_deg, field_dec_deg)
-    for x, y, d in zip(points[0], points[1], directions_list):
-        dist = fov_poly.is_inside(x, y)
-        if dist < 0.0:
+    in_fov = fov_poly.contains(points[0], points[1], include_sides=True)
+    for inside, d in zip(in_fov, directions_list):
+        if not inside:
             # Source is outside of FOV, so use simple rectangular patches
             d.is_patch = True
 
@@ -807,57 +993,53 @@ def thiessen(directions_list, field_ra_deg, field_dec_deg, faceting_radius_deg,
         fwhm = 25.0 / 3600.0 # degrees
         min_sizes = [fwhm*min(10.0, max(2.0, np.sqrt(flux_jy/0.01))) for flux_jy in fluxes_jy]
         sizes = [max(size, min_size) for size, min_size in zip(sizes, min_sizes)]
+        sx = np.array(sx)
+        sy = np.array(sy)
+        pix_radii = np.array(sizes) * 1.2 / 2.0 / 0.066667 # radii of sources in pixels
+        source_tree = cKDTree(np.vstack([sx, sy]).T)
 
-        # Filter sources to get only those close to a boundary. We need to iterate
-        # until no sources are found
+        # Find the sources close to the boundary of each facet and adjust the
+        # facets for them. We need to iterate until no sources are found
         niter = 0
         while niter < 3:
             niter += 1
-            ind_near_edge = []
-            for i, thiessen_poly in enumerate(thiessen_polys):
-                polyv = np.vstack(thiessen_poly)
-                poly_tuple = tuple([(x, y) for x, y in zip(polyv[:, 0], polyv[:, 1])])
-                poly = Polygon(polyv[:, 0], polyv[:, 1])
-                dists = poly.is_inside(sx, sy)
-                for j, dist in enumerate(dists):
-                    pix_radius = sizes[j] * 1.2 / 2.0 / 0.066667 # radius of source in pixels
-                    if abs(dist) < pix_radius and j not in ind_near_edge:
-                        ind_near_edge.append(j)
-            if len(ind_near_edge) == 0:
+            near_edge = [_find_sources_near_edge(np.vstack(thiessen_poly), sx, sy,
+                pix_radii, source_tree) for thiessen_poly in thiessen_polys]
+            if sum([len(ind) for ind, dists in near_edge]) == 0:
                 break
-            sx_filt = np.array(sx)[ind_near_edge]
-            sy_filt = np.array(sy)[ind_near_edge]
-            sizes_filt = np.array(sizes)[ind_near_edge]
-
-            # Adjust all facets for each source near a boundary
-            for x, y, size in zip(sx_filt, sy_filt, sizes_filt):
-                for i, thiessen_poly in enumerate(thiessen_polys):
-                    polyv = np.vstack(thiessen_poly)
-                    poly_tuple = tuple([(xp, yp) for xp, yp in zip(polyv[:, 0], polyv[:, 1])])
-                    poly = Polygon(polyv[:, 0], polyv[:, 1])
-                    dist = poly.is_inside(x, y)
-                    p1 = shapely.geometry.Polygon(poly_tuple)
-
-                    pix_radius = size * 1.2 / 2.0 / 0.066667 # size of source in pixels
-                    if abs(dist) < pix_radius:
-                        p2 = shapely.geometry.Point((x, y))
-                        p2buf = p2.buffer(pix_radius)
-                        if dist < 0.0:
-                            # If point is outside, difference the polys
-                            p1 = p1.difference(p2buf)
-                        else:
-                            # If point is inside, union the polys
-                            p1 = p1.union(p2buf)
-                        try:
-                            xyverts = [np.array([xp, yp]) for xp, yp in
-                                zip(p1.exterior.coords.xy[0].tolist(),
-                                p1.exterior.coords.xy[1].tolist())]
-                            thiessen_polys[i] = xyverts
-                        except AttributeError:
-                            continue
-
-    # Add the final facet and patch info to the directions
+
+            # Adjust each facet for all the sources near its boundary at once
+            for i, (ind, dists) in enumerate(near_edge):
+                if len(ind) == 0:
+                    continue
+                polyv = np.vstack(thiessen_polys[i])
+                poly_tuple = tuple([(xp, yp) for xp, yp in zip(polyv[:, 0], polyv[:, 1])])
+                p1 = shapely.geometry.Polygon(poly_tuple)
+                p2buf = [shapely.geometry.Point((sx[j], sy[j])).buffer(pix_radii[j])
+                    for j in ind]
+
+                # If point is inside, union the polys. If point is outside,
+                # difference the polys
+                inside = [buf for buf, dist in zip(p2buf, dists) if dist >= 0.0]
+                outside = [buf for buf, dist in zip(p2buf, dists) if dist < 0.0]
+                if len(inside) > 0:
+                    p1 = p1.union(cascaded_union(inside))
+                if len(outside) > 0:
+                    p1 = p1.difference(cascaded_union(outside))
+                try:
+                    xyverts = [np.array([xp, yp]) for xp, yp in
+                        zip(p1.exterior.coords.xy[0].tolist(),
+                        p1.exterior.coords.xy[1].tolist())]
+                    thiessen_polys[i] = xyverts
+                except AttributeError:
+                    continue
+
+    # Add the final facet and patch info to the directions. The facets (and the
+    # patches as they are made) are used to clip the patches
     patch_polys = []
+    clip_polys = [shapely.geometry.Polygon([tuple(v) for v in thiessen_poly])
+        for thiessen_poly in thiessen_polys]
+    clip_bounds = np.array([p1.bounds for p1 in clip_polys]).reshape(-1, 4)
     for d in directions_list:
         # Make calibrator patch
         sx, sy = radec2xy([d.ra], [d.dec], refRA=field_ra_deg, refDec=field_dec_deg)
@@ -882,29 +1064,82 @@ def thiessen(directions_list, field_ra_deg, field_dec_deg, faceting_radius_deg,
             # altered by the clipping
             patch_poly = [np.copy(vert) for vert in selfcal_poly]
 
-            # Now loop over the facets and patches and clip
-            for facet_poly in thiessen_polys + patch_polys:
-                polyv = np.vstack(facet_poly)
-                poly_tuple = tuple([(xp, yp) for xp, yp in zip(polyv[:, 0], polyv[:, 1])])
-                p1 = shapely.geometry.Polygon(poly_tuple)
-                p2 = shapely.geometry.Polygon(patch_poly)
-                if p2.intersects(p1):
-                    p2 = p2.difference(p1)
-                    try:
-                        xyverts = [np.array([xp, yp]) for xp, yp in
-                            zip(p2.exterior.coords.xy[0].tolist(),
-                            p2.exterior.coords.xy[1].tolist())]
-                        patch_poly = xyverts
-                    except AttributeError:
-                        pass
+            # Now clip with all the facets and patches that overlap the patch
+            # (selected by their bounding boxes)
+            p2 = shapely.geometry.Polygon(patch_poly)
+            xmin, ymin, xmax, ymax = p2.bounds
+            overlap = ((clip_bounds[:, 0] < xmax) & (clip_bounds[:, 2] > xmin) &
+                (clip_bounds[:, 1] < ymax) & (clip_bounds[:, 3] > ymin))
+            clip_overlap = [p1 for p1, o in zip(clip_polys, overlap) if o and
+                p2.intersects(p1)]
+            if len(clip_overlap) > 0:
+                p2 = p2.difference(cascaded_union(clip_overlap))
+                try:
+                    xyverts = [np.array([xp, yp]) for xp, yp in
+                        zip(p2.exterior.coords.xy[0].tolist(),
+                        p2.exterior.coords.xy[1].tolist())]
+                    patch_poly = xyverts
+                except AttributeError:
+                    pass
 
             add_facet_info(d, selfcal_poly, patch_poly, field_ra_deg, field_dec_deg)
             patch_polys.append(patch_poly)
+            p1 = shapely.geometry.Polygon(patch_poly)
+            clip_polys.append(p1)
+            clip_bounds = np.vstack([clip_bounds, p1.bounds])
         else:
             facet_poly = thiessen_polys[directions_list_thiessen.index(d)]
             add_facet_info(d, selfcal_poly, facet_poly, field_ra_deg, field_dec_deg)
 
 
+def _find_sources_near_edge(polyv, sx, sy, pix_radii, source_tree):
+    """
+    Finds the sources that lie within their radius of the edge of a facet
+
+    Only sources near the bounding box of the facet (found with the KD-tree
+    of the source positions) are checked
+
+    Parameters
+    ----------
+    polyv : array
+        Vertices of the facet, as an array of shape (n, 2)
+    sx, sy : array
+        Positions of the sources in pixels
+    pix_radii : array
+        Radii of the sources in pixels
+    source_tree : cKDTree
+        KD-tree of the source positions
+
+    Returns
+    -------
+    ind : array
+        Indices of the sources near the edge
+    dists : array
+        Distances of these sources from the edge (negative for sources outside
+        the facet)
+
+    """
+    xmin, ymin = polyv.min(axis=0)
+    xmax, ymax = polyv.max(axis=0)
+    center = [(xmin + xmax) / 2.0, (ymin + ymax) / 2.0]
+    half_diagonal = np.hypot(xmax - xmin, ymax - ymin) / 2.0
+    ind = np.array(source_tree.query_ball_point(center, half_diagonal +
+        np.max(pix_radii)), dtype=int)
+    if len(ind) == 0:
+        return ind, np.array([])
+    in_box = ((sx[ind] > xmin - pix_radii[ind]) & (sx[ind] < xmax + pix_radii[ind]) &
+        (sy[ind] > ymin - pix_radii[ind]) & (sy[ind] < ymax + pix_radii[ind]))
+    ind = ind[in_box]
+    if len(ind) == 0:
+        return ind, np.array([])
+
+    poly = Polygon(polyv[:, 0], polyv[:, 1])
+    dists = np.atleast_1d(poly.is_inside(sx[ind], sy[ind]))
+    near = np.abs(dists) < pix_radii[ind]
+
+    return ind[near], dists[near]
+
+
 def add_facet_info(d, selfcal_poly, facet_poly, midRA, midDec):
     """
     Convert facet polygon from x, y to RA, Dec and find width of facet and
@@ -1404,14 +1639,11 @@ def mask_vertices(mask_im, vertices_file):
         yvert.append(pixels[3]) # y -> RA
     poly = Polygon(xvert, yvert)
 
-    # Find distance to nearest poly edge and unmask those that
-    # are outside the facet (dist < 0)
-    masked_ind = np.indices(data[0, 0].shape)
-    dist = poly.is_inside(masked_ind[0], masked_ind[1])
-    outside_ind = np.where(dist < 0.0)
-    if len(outside_ind[0]) > 0:
-        data[0, 0, masked_ind[0][outside_ind], [masked_ind[1][outside_ind]]] = 0
-        bool_data[0, 0, masked_ind[0][outside_ind], [masked_ind[1][outside_ind]]] = 0
+    # Unmask the pixels that are outside the facet (those on its edge are
+    # kept)
+    outside = ~rasterize([poly], data[0, 0].shape, include_sides=True)
+    data[0, 0, outside] = 0
+    bool_data[0, 0, outside] = 0
 
     new_im.putdata(data)
     bool_mask.putdata(bool_data)
@@ -52,14 +52,14 @@ class Band(object):
         self.working_dir = factor_working_dir
         self.dirindparmdbs = [ os.path.join(MS, dirindparmdb) for MS in self.files ]
         self.numMS = len(self.files)
+        self.metadata_dir = os.path.join(self.working_dir, 'state', 'ms_metadata')
 
         # Get the frequency info and set name
-        sw = pt.table(self.files[0]+'::SPECTRAL_WINDOW', ack=False)
-        self.freq = sw.col('REF_FREQUENCY')[0]
-        self.nchan = sw.col('NUM_CHAN')[0]
-        self.chan_freqs_hz = sw.col('CHAN_FREQ')[0]
-        self.chan_width_hz = sw.col('CHAN_WIDTH')[0][0]
-        sw.close()
+        metadata = get_ms_metadata(self.files[0], self.metadata_dir, ['frequency'])
+        self.freq = metadata['freq']
+        self.nchan = metadata['nchan']
+        self.chan_freqs_hz = metadata['chan_freqs_hz']
+        self.chan_width_hz = metadata['chan_width_hz']
         self.name = 'Band_{0:.2f}MHz'.format(self.freq/1e6)
         self.log = logging.getLogger('factor:{}'.format(self.name))
         self.log.debug('Band name is {}'.format(self.name))
@@ -73,42 +73,24 @@ class Band(object):
 
         # Do some checks if desired
         if process_files or not has_state:
+            # Read the metadata of all files in parallel (or from the cache)
+            self.metadata = get_ms_metadata_parallel(self.files, self.metadata_dir,
+                ['frequency', 'phase_center', 'station', 'elevation', 'columns',
+                'time'])
             self.check_freqs()
             self.check_parmdb()
 
             # Get the field RA and Dec
-            obs = pt.table(self.files[0]+'::FIELD', ack=False)
-            self.ra = np.degrees(float(obs.col('REFERENCE_DIR')[0][0][0]))
-            if self.ra < 0.:
-                self.ra = 360.0 + (self.ra)
-            self.dec = np.degrees(float(obs.col('REFERENCE_DIR')[0][0][1]))
-            obs.close()
+            self.ra = self.metadata[0]['ra']
+            self.dec = self.metadata[0]['dec']
 
             # Get the station diameter
-            ant = pt.table(self.files[0]+'::ANTENNA', ack=False)
-            self.diam = float(ant.col('DISH_DIAMETER')[0])
-            ant.close()
-
-            # Find mean elevation and FOV
-            for MS_id in xrange(self.numMS):
-                # Add (virtual) elevation column to MS
-                tab = pt.table(self.files[MS_id], ack=False)
-                exiting_colnames = tab.colnames()
-                if 'AZEL1' not in exiting_colnames:
-                    tab.close()
-                    pt.addDerivedMSCal(self.files[MS_id])
-                    tab = pt.table(self.files[MS_id], ack=False)
-
-                # Calculate mean elevation
-                if MS_id == 0:
-                    global_el_values = tab.getcol('AZEL1', rowincr=10000)[:, 1]
-                else:
-                    global_el_values = np.hstack( (global_el_values, tab.getcol('AZEL1', rowincr=10000)[:, 1]) )
-                tab.close()
+            self.diam = self.metadata[0]['diam']
 
-                # Remove (virtual) elevation column from MS
-                pt.removeDerivedMSCal(self.files[MS_id])
-            self.mean_el_rad = np.mean(global_el_values)
+            # Find mean elevation (over the samples of all files) and FOV
+            nel = np.array([m['nel'] for m in self.metadata])
+            mean_el_rad = np.array([m['mean_el_rad'] for m in self.metadata])
+            self.mean_el_rad = np.sum(mean_el_rad * nel) / np.sum(nel)
             sec_el = 1.0 / np.sin(self.mean_el_rad)
             self.fwhm_deg = 1.1 * ((3.0e8 / self.freq) / self.diam) * 180. / np.pi * sec_el
 
@@ -116,12 +98,10 @@ class Band(object):
             self.has_sub_data = True
             self.has_sub_data_new = False
             for MSid in xrange(self.numMS):
-                tab = pt.table(self.files[MSid], ack=False)
-                if not 'SUBTRACTED_DATA_ALL' in tab.colnames():
+                if not 'SUBTRACTED_DATA_ALL' in self.metadata[MSid]['colnames']:
                     self.log.error('SUBTRACTED_DATA_ALL column not found in file '
                         '{}'.format(self.files[MSid]))
                     self.has_sub_data = False
-                tab.close()
             if not self.has_sub_data:
                 self.log.info('Exiting...')
                 sys.exit(1)
@@ -139,18 +119,17 @@ class Band(object):
                 self.minSamplesPerFile = 4294967295  # If LOFAR lasts that many seconds then I buy you a beer.
                 self.starttime = np.finfo('d').max
                 self.endtime = 0.
-                for MSid in xrange(self.numMS):
-                    tab = pt.table(self.files[MSid], ack=False)
-                    self.starttime = min(self.starttime,np.min(tab.getcol('TIME')))
-                    self.endtime = max(self.endtime,np.min(tab.getcol('TIME')))
-                    for t2 in tab.iter(["ANTENNA1","ANTENNA2"]):
-                        if (t2.getcell('ANTENNA1',0)) < (t2.getcell('ANTENNA2',0)):
-                            self.timepersample = t2.col('TIME')[1] - t2.col('TIME')[0]
-                            numsamples = t2.nrows()
-                            self.sumsamples += numsamples
-                            self.minSamplesPerFile = min(self.minSamplesPerFile,numsamples)
-                            break
-                    tab.close()
+                chunk_metadata = get_ms_metadata_parallel(self.files,
+                    self.metadata_dir, ['samples'])
+                for metadata in chunk_metadata:
+                    self.starttime = min(self.starttime, metadata['first_time'])
+                    self.endtime = max(self.endtime, metadata['first_time'])
+                    if 'numsamples' in metadata:
+                        self.timepersample = metadata['timepersample']
+                        numsamples = metadata['numsamples']
+                        self.sumsamples += numsamples
+                        self.minSamplesPerFile = min(self.minSamplesPerFile,numsamples)
+            self.metadata = None
             self.save_state()
 
         self.log.debug("Using {0} files.".format(len(self.files)))
@@ -277,14 +256,13 @@ class Band(object):
         """
         # check that all MSs have the same frequency axis
         for MS_id in xrange(1,self.numMS):
-            sw = pt.table(self.files[MS_id]+'::SPECTRAL_WINDOW', ack=False)
-            if self.freq != sw.col('REF_FREQUENCY')[0] or self.nchan != sw.col('NUM_CHAN')[0] \
-                    or not np.array_equal(self.chan_freqs_hz, sw.getcell('CHAN_FREQ',0)) \
-                    or not np.array_equal(self.chan_width_hz, sw.getcell('CHAN_WIDTH',0)[0] ):
+            metadata = self.metadata[MS_id]
+            if self.freq != metadata['freq'] or self.nchan != metadata['nchan'] \
+                    or not np.array_equal(self.chan_freqs_hz, metadata['chan_freqs_hz']) \
+                    or not np.array_equal(self.chan_width_hz, metadata['chan_width_hz']):
                 self.log.critical('Frequency axis for MS {0} differs from the one for MS {1}! '
                                   'Exiting!'.format(self.files[MS_id],self.files[0]))
                 sys.exit(1)
-            sw.close()
 
         # check for gaps in the frequency channels
         self.missing_channels = []
@@ -323,32 +301,30 @@ class Band(object):
         """
         newfiles = []
         newdirindparmdbs = []
+        ms_chunks = [[] for MS_id in xrange(self.numMS)]
+        split_ids = []
+        split_jobs = []
         for MS_id in xrange(self.numMS):
             nchunks = 1
-            tab = pt.table(self.files[MS_id], ack=False)
+            metadata = self.metadata[MS_id]
 
             # Make filter for data columns that we don't need. These include imaging
             # columns and those made during initial subtraction
-            colnames = tab.colnames()
+            colnames = metadata['colnames']
             colnames_to_remove = ['MODEL_DATA', 'CORRECTED_DATA', 'IMAGING_WEIGHT',
                 'SUBTRACTED_DATA_HIGH', 'SUBTRACTED_DATA_ALL_NEW', 'SUBTRACTED_DATA',
                 'LOFAR_FULL_RES_FLAG']
             colnames_to_keep = [c for c in colnames if c not in colnames_to_remove]
 
-            timepersample = tab.getcell('EXPOSURE',0)
-            timetab = tab.sort('unique desc TIME')
-            tab.close()
-            timearray = timetab.getcol('TIME')
-            timetab.close()
-            numsamples = len(timearray)
-            mystarttime = np.min(timearray)
-            myendtime = np.max(timearray)
+            timepersample = metadata['exposure']
+            numsamples = metadata['ntimes']
+            mystarttime = metadata['starttime']
+            myendtime = metadata['endtime']
             assert (timepersample*(numsamples-1)+.5) > (myendtime-mystarttime)
             if (myendtime-mystarttime) > (2.*chunksize):
                 nchunks = int((numsamples*timepersample)/chunksize)
             if test_run:
                 self.log.debug('Would split (or not) {0} into {1} chunks. '.format(self.files[MS_id], nchunks))
-                tab.close()
                 continue
 
             # Define directory where chunks are stored
@@ -358,27 +334,11 @@ class Band(object):
 
             if nchunks > 1 or use_compression:
                 self.log.debug('Spliting {0} into {1} chunks...'.format(self.files[MS_id], nchunks))
-
-                pool = multiprocessing.Pool()
-                results = pool.map(process_chunk_star,
-                    itertools.izip(itertools.repeat(self.files[MS_id]),
-                    itertools.repeat(self.dirindparmdbs[MS_id]),
-                    range(nchunks), itertools.repeat(nchunks),
-                    itertools.repeat(mystarttime),
-                    itertools.repeat(myendtime), itertools.repeat(chunksize),
-                    itertools.repeat(dirindparmdb),
-                    itertools.repeat(colnames_to_keep),
-                    itertools.repeat(newdirname),
-                    itertools.repeat(local_dir),
-                    itertools.repeat(min_fraction),
-                    itertools.repeat(use_compression) ))
-                pool.close()
-                pool.join()
-
-                for chunk_file, chunk_parmdb in results:
-                    if bool(chunk_file) and bool(chunk_parmdb) :
-                        newfiles.append(chunk_file)
-                        newdirindparmdbs.append(chunk_parmdb)
+                split_ids.append(MS_id)
+                split_jobs.append((self.files[MS_id], self.dirindparmdbs[MS_id],
+                    nchunks, mystarttime, chunksize, dirindparmdb,
+                    colnames_to_keep, newdirname, local_dir, min_fraction,
+                    use_compression))
             else:
                 # Make symlinks for the files
                 chunk_name = '{0}_chunk0.ms'.format(os.path.splitext(os.path.basename(self.files[MS_id]))[0])
@@ -390,7 +350,9 @@ class Band(object):
                     # unflagged data. If not, then continue with the for loop over MSs
                     # This will re-run for bad files every time factor is started, but the
                     # user could just remove the file from the input directory.
-                    if find_unflagged_fraction(self.files[MS_id]) < min_fraction:
+                    unflagged_fraction = get_ms_metadata(self.files[MS_id],
+                        self.metadata_dir, ['flags'])['unflagged_fraction']
+                    if unflagged_fraction < min_fraction:
                         self.log.debug('File {} not used because it contains too little unflagged'
                                        ' data'.format(os.path.basename(self.files[MS_id])))
                         continue
@@ -399,8 +361,27 @@ class Band(object):
                 if not os.path.exists(newdirindparmdb):
                     os.symlink(self.dirindparmdbs[MS_id], newdirindparmdb)
 
+                ms_chunks[MS_id].append((chunk_file, newdirindparmdb))
+
+        # Split the files, each in a single pass over its data. The files are
+        # split in parallel
+        if len(split_jobs) > 0:
+            pool = multiprocessing.Pool(min(len(split_jobs), multiprocessing.cpu_count()))
+            try:
+                results = pool.map(chunk_ms_star, split_jobs)
+            except ValueError as e:
+                self.log.error(str(e))
+                sys.exit(1)
+            finally:
+                pool.close()
+                pool.join()
+            for MS_id, chunks in zip(split_ids, results):
+                ms_chunks[MS_id] = [(chunk_file, chunk_parmdb) for chunk_file,
+                    chunk_parmdb in chunks if bool(chunk_file) and bool(chunk_parmdb)]
+        for chunks in ms_chunks:
+            for chunk_file, chunk_parmdb in chunks:
                 newfiles.append(chunk_file)
-                newdirindparmdbs.append(newdirindparmdb)
+                newdirindparmdbs.append(chunk_parmdb)
 
         # Check that each file has at least min_fraction unflagged data. If not, remove
         # it from the file list.
@@ -483,6 +464,228 @@ class Band(object):
 
 
 
+def get_ms_mtime(ms_file):
+    """
+    Returns the time at which an MS was last modified
+
+    Parameters
+    ----------
+    ms_file : str
+        Filename of MS
+
+    Returns
+    -------
+    mtime : float
+        Latest modification time of the MS directory and the files in it (not
+        including subtables)
+
+    """
+    mtime = os.path.getmtime(ms_file)
+    for f in os.listdir(ms_file):
+        path = os.path.join(ms_file, f)
+        if os.path.isfile(path):
+            mtime = max(mtime, os.path.getmtime(path))
+
+    return mtime
+
+
+def read_ms_metadata(ms_file, group):
+    """
+    Reads a group of metadata from an MS
+
+    Parameters
+    ----------
+    ms_file : str
+        Filename of MS
+    group : str
+        Group of metadata to read:
+            'frequency' - reference frequency, number of channels, channel
+                frequencies and channel width
+            'phase_center' - RA and Dec of the phase center in degrees
+            'station' - station diameter
+            'elevation' - mean elevation and number of samples used
+            'columns' - column names
+            'time' - exposure, number of time slots, and start and end times
+            'samples' - start time, time per sample, and number of samples of
+                the first cross-correlation baseline
+            'flags' - fraction of unflagged data
+
+    Returns
+    -------
+    metadata : dict
+        Metadata of the group
+
+    """
+    if group == 'frequency':
+        sw = pt.table(ms_file+'::SPECTRAL_WINDOW', ack=False)
+        metadata = {'freq': sw.col('REF_FREQUENCY')[0],
+                    'nchan': sw.col('NUM_CHAN')[0],
+                    'chan_freqs_hz': sw.col('CHAN_FREQ')[0],
+                    'chan_width_hz': sw.col('CHAN_WIDTH')[0][0]}
+        sw.close()
+    elif group == 'phase_center':
+        obs = pt.table(ms_file+'::FIELD', ack=False)
+        ra = np.degrees(float(obs.col('REFERENCE_DIR')[0][0][0]))
+        if ra < 0.:
+            ra = 360.0 + (ra)
+        dec = np.degrees(float(obs.col('REFERENCE_DIR')[0][0][1]))
+        obs.close()
+        metadata = {'ra': ra, 'dec': dec}
+    elif group == 'station':
+        ant = pt.table(ms_file+'::ANTENNA', ack=False)
+        metadata = {'diam': float(ant.col('DISH_DIAMETER')[0])}
+        ant.close()
+    elif group == 'elevation':
+        # Add (virtual) elevation column to MS
+        tab = pt.table(ms_file, ack=False)
+        exiting_colnames = tab.colnames()
+        if 'AZEL1' not in exiting_colnames:
+            tab.close()
+            pt.addDerivedMSCal(ms_file)
+            tab = pt.table(ms_file, ack=False)
+        el_values = tab.getcol('AZEL1', rowincr=10000)[:, 1]
+        tab.close()
+
+        # Remove (virtual) elevation column from MS
+        pt.removeDerivedMSCal(ms_file)
+        metadata = {'mean_el_rad': np.mean(el_values), 'nel': len(el_values)}
+    elif group == 'columns':
+        tab = pt.table(ms_file, ack=False)
+        metadata = {'colnames': tab.colnames()}
+        tab.close()
+    elif group == 'time':
+        tab = pt.table(ms_file, ack=False)
+        timepersample = tab.getcell('EXPOSURE',0)
+        timetab = tab.sort('unique desc TIME')
+        tab.close()
+        timearray = timetab.getcol('TIME')
+        timetab.close()
+        metadata = {'exposure': timepersample, 'ntimes': len(timearray),
+                    'starttime': np.min(timearray), 'endtime': np.max(timearray)}
+    elif group == 'samples':
+        tab = pt.table(ms_file, ack=False)
+        metadata = {'first_time': np.min(tab.getcol('TIME'))}
+        for t2 in tab.iter(["ANTENNA1","ANTENNA2"]):
+            if (t2.getcell('ANTENNA1',0)) < (t2.getcell('ANTENNA2',0)):
+                metadata['timepersample'] = t2.col('TIME')[1] - t2.col('TIME')[0]
+                metadata['numsamples'] = t2.nrows()
+                break
+        tab.close()
+    elif group == 'flags':
+        metadata = {'unflagged_fraction': find_unflagged_fraction(ms_file)}
+    else:
+        raise ValueError('Metadata group "{}" not understood'.format(group))
+
+    return metadata
+
+
+def get_ms_metadata(ms_file, cache_dir, groups):
+    """
+    Returns metadata of an MS, using the cache where possible
+
+    The metadata of each MS are cached in a file in cache_dir, together with
+    the path and the modification time of the MS. Cached metadata are used
+    only if the MS has not been modified since they were read
+
+    Parameters
+    ----------
+    ms_file : str
+        Filename of MS
+    cache_dir : str
+        Directory in which the cache files are stored
+    groups : list of str
+        Groups of metadata to return (see read_ms_metadata())
+
+    Returns
+    -------
+    metadata : dict
+        Metadata of all the groups
+
+    """
+    import pickle
+    import hashlib
+
+    ms_path = os.path.abspath(ms_file)
+    cache_file = os.path.join(cache_dir, '{0}_{1}.pkl'.format(os.path.basename(
+        ms_path.rstrip('/')), hashlib.md5(ms_path).hexdigest()[0:8]))
+    mtime = get_ms_mtime(ms_file)
+    cache = {'path': ms_path, 'mtime': mtime, 'groups': {}}
+    try:
+        with open(cache_file, 'rb') as f:
+            cached = pickle.load(f)
+        if cached['path'] == ms_path and cached['mtime'] == mtime:
+            cache = cached
+    except Exception:
+        pass
+
+    metadata = {}
+    updated = False
+    for group in groups:
+        if group not in cache['groups']:
+            cache['groups'][group] = read_ms_metadata(ms_file, group)
+            updated = True
+        metadata.update(cache['groups'][group])
+
+    if updated:
+        # Some groups (e.g., 'elevation') modify the MS, so store the current
+        # modification time
+        cache['mtime'] = get_ms_mtime(ms_file)
+        if not os.path.exists(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # Made by another process
+                pass
+        temp_file = '{0}.{1}.tmp'.format(cache_file, os.getpid())
+        with open(temp_file, 'wb') as f:
+            pickle.dump(cache, f)
+        os.rename(temp_file, cache_file)
+
+    return metadata
+
+
+def get_ms_metadata_star(inputs):
+    """
+    Simple helper function for pool.map
+    """
+    return get_ms_metadata(*inputs)
+
+
+def get_ms_metadata_parallel(ms_files, cache_dir, groups, ncpu=None):
+    """
+    Returns metadata of a number of MSs, reading them in parallel
+
+    Parameters
+    ----------
+    ms_files : list of str
+        Filenames of MSs
+    cache_dir : str
+        Directory in which the cache files are stored
+    groups : list of str
+        Groups of metadata to return (see read_ms_metadata())
+    ncpu : int, optional
+        Number of processes to use. If None, the number of cpus is used
+
+    Returns
+    -------
+    metadata : list of dict
+        Metadata of each MS
+
+    """
+    if len(ms_files) < 2:
+        return [get_ms_metadata(ms_file, cache_dir, groups) for ms_file in ms_files]
+
+    if ncpu is None:
+        ncpu = multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(min(ncpu, len(ms_files)))
+    metadata = pool.map(get_ms_metadata_star, itertools.izip(ms_files,
+        itertools.repeat(cache_dir), itertools.repeat(groups)))
+    pool.close()
+    pool.join()
+
+    return metadata
+
+
 def find_unflagged_fraction(ms_file):
     """
     Finds the fraction of data that is unflagged
@@ -526,17 +729,23 @@ def find_unflagged_fraction(ms_file):
     return unflagged_fraction
 
 
-def process_chunk_star(inputs):
+def chunk_ms_star(inputs):
     """
     Simple helper function for pool.map
     """
-    return process_chunk(*inputs)
+    return chunk_ms(*inputs)
 
 
-def process_chunk(ms_file, ms_parmdb, chunkid, nchunks, mystarttime, myendtime, chunksize, dirindparmdb,
-    colnames_to_keep, newdirname, local_dir=None, min_fraction=0.1, use_compression=True):
+def chunk_ms(ms_file, ms_parmdb, nchunks, mystarttime, chunksize, dirindparmdb,
+    colnames_to_keep, newdirname, local_dir=None, min_fraction=0.1,
+    use_compression=True, nrows_per_read=10000):
     """
-    Processes one time chunk of input ms_file and returns new file names
+    Splits an MS into time chunks in a single pass and returns new file names
+
+    The input MS is read once, in time order, and its rows are written to the
+    chunk files in turn. Flagged values are set to NaN (needed for Dysco
+    compression) and the unflagged fraction of each chunk is found while the
+    rows are copied
 
     Parameters
     ----------
@@ -544,14 +753,10 @@ def process_chunk(ms_file, ms_parmdb, chunkid, nchunks, mystarttime, myendtime,
         Input MS file to chunk
     ms_parmdb : str
         Input dir-independent parmdb for input MS file
-    chunkid : int
-        ID of chunk
     nchunks : int
         Total number of chunks
     mystarttime : float
         Start time of MS file
-    myendtime : float
-        End time of MS file
     chunksize : float
         length of a chunk in seconds
     dirindparmdb : str
@@ -568,157 +773,208 @@ def process_chunk(ms_file, ms_parmdb, chunkid, nchunks, mystarttime, myendtime,
         to be kept
     use_compression : bool, optional
         If True, use Dysco compression on output chunk files
+    nrows_per_read : int, optional
+        Number of rows read from the input MS at once
 
     Returns
     -------
-    chunk_file : str
-        Filename of chunk MS or None
-    newdirindparmdb : str
-        Filename of direction-independent instrument parmdb for chunk_file or None
+    chunks : list of (str, str) tuples
+        Filename of chunk MS and filename of direction-independent instrument
+        parmdb for it, or (None, None) if the chunk has too little unflagged
+        data, for each chunk
 
     """
     log = logging.getLogger('factor:MS-chunker')
-    chunk_name = '{0}_chunk{1}.ms'.format(os.path.splitext(os.path.basename(ms_file))[0], chunkid)
-    chunk_file = os.path.join(newdirname, chunk_name)
-    old_chunk_file = os.path.join(os.path.dirname(ms_file), 'chunks', chunk_name)
-
-    starttime = mystarttime+chunkid*chunksize
-    endtime = mystarttime+(chunkid+1)*chunksize
-    if chunkid == 0:
-        starttime -= chunksize
-    if chunkid == (nchunks-1):
-        endtime += 2.*chunksize
     tab = pt.table(ms_file, lockoptions='autonoread', ack=False)
-    seltab = tab.query('TIME >= ' + str(starttime) + ' && TIME < ' + str(endtime),
-        sortlist='TIME,ANTENNA1,ANTENNA2', columns=','.join(colnames_to_keep))
-
-    copy = True
-    if os.path.exists(chunk_file):
-        try:
-            newtab = pt.table(chunk_file, ack=False)
-            if len(newtab) == len(seltab):
-                copy = False
-                newtab.close()
-            else:
-                log.error('Chunk {0} exists with incorrect length ({1} samples expected, {2} samples found), please check it!'.format(chunk_name, len(seltab), len(newtab)))
-                newtab.close()
-                sys.exit(1)
-        except:
-            copy = True
-        if copy:
-            shutil.rmtree(chunk_file)
-    elif os.path.exists(old_chunk_file):
-        # For compatibility, also search in old location
-        try:
-            newtab = pt.table(old_chunk_file, ack=False)
-            if len(newtab) == len(seltab):
-                copy = False
-                chunk_file = old_chunk_file
+    seltab = tab.query(sortlist='TIME,ANTENNA1,ANTENNA2',
+        columns=','.join(colnames_to_keep))
+    timearray = seltab.getcol('TIME')
+
+    # Find the rows of each chunk (the rows are sorted by time)
+    chunks = []
+    for chunkid in range(nchunks):
+        chunk_name = '{0}_chunk{1}.ms'.format(os.path.splitext(os.path.basename(ms_file))[0], chunkid)
+        starttime = mystarttime+chunkid*chunksize
+        endtime = mystarttime+(chunkid+1)*chunksize
+        if chunkid == 0:
+            starttime -= chunksize
+        if chunkid == (nchunks-1):
+            endtime += 2.*chunksize
+        startrow = np.searchsorted(timearray, starttime, side='left')
+        endrow = np.searchsorted(timearray, endtime, side='left')
+        chunks.append({'name': chunk_name, 'startrow': startrow,
+            'nrows': endrow - startrow,
+            'file': os.path.join(newdirname, chunk_name),
+            'old_file': os.path.join(os.path.dirname(ms_file), 'chunks', chunk_name)})
+
+    # Check for existing chunks
+    for chunk in chunks:
+        chunk['copy'] = True
+        for chunk_file in [chunk['file'], chunk['old_file']]:
+            if not os.path.exists(chunk_file):
+                continue
+            try:
+                newtab = pt.table(chunk_file, ack=False)
+                nrows_found = len(newtab)
                 newtab.close()
+            except:
+                # Chunk cannot be opened, so make it again
+                if chunk_file == chunk['file']:
+                    shutil.rmtree(chunk_file)
+                break
+            if nrows_found != chunk['nrows']:
+                seltab.close()
+                tab.close()
+                raise ValueError('Chunk {0} exists with incorrect length ({1} '
+                    'samples expected, {2} samples found), please check '
+                    'it!'.format(chunk['name'], chunk['nrows'], nrows_found))
+            log.debug('Chunk {} exists with correct length, not copying!'.format(chunk['name']))
+            chunk['copy'] = False
+            chunk['file'] = chunk_file
+            break
+    colnames_to_copy = [c for c in colnames_to_keep if c not in ['TIME', 'FLAG']]
+
+    # Make the new chunks, reading the rows of the input MS in order
+    for chunk in chunks:
+        outtab = None
+        if chunk['copy']:
+            log.debug('Going to copy {0} samples to file {1}'.format(chunk['nrows'],
+                chunk['file']))
+            if local_dir is not None:
+                # Set output to temp directory
+                chunk['output_file'] = os.path.join(local_dir, chunk['name'])
             else:
-                log.error('Chunk {0} exists with incorrect length ({1} samples expected, {2} samples found), please check it!'.format(chunk_name, len(seltab), len(newtab)))
-                newtab.close()
-                sys.exit(1)
-        except:
-            copy = True
-    else:
-        copy = True
-
-    newdirindparmdb = os.path.join(chunk_file, dirindparmdb)
-
-    if copy:
-        log.debug('Going to copy {0} samples to file {1}'.format(str(len(seltab)),chunk_file))
-
-        if local_dir is not None:
-            # Set output to temp directory
-            chunk_file_original = chunk_file
-            chunk_file = os.path.join(local_dir, os.path.basename(chunk_file_original))
-            if os.path.exists(chunk_file):
-                shutil.rmtree(chunk_file)
-
-        if use_compression:
-            # Replace current storage manager by DyscoStMan if needed
-            log.debug('Compressing file...')
-
-            # Write table to disk so that we can open it in write mode
-            temp_file = chunk_file + '.tmp'
-            seltab.copy(temp_file, deep=True)
-            seltab.close()
-            seltab = pt.table(temp_file, readonly=False, ack=False)
-
-            # Get flags, as we must replace flagged values with NaNs before
-            # compression
-            flags = seltab.getcol('FLAG')
-            flagged = np.where(flags)
-
-            # Replace DATA with SUBTRACTED_DATA_ALL and set flagged values to
-            # NaN (needed for Dysco compression)
-            seltab.renamecol('DATA', 'DATA_TEMP')
-            desc = seltab.getcoldesc('DATA_TEMP')
-            desc['name'] = 'DATA'
-            seltab.addcols(desc)
-            data = seltab.getcol('SUBTRACTED_DATA_ALL')
-            data[flagged] = np.NaN
-            seltab.putcol('DATA', data)
-            seltab.removecols(['DATA_TEMP'])
-            seltab.removecols(['SUBTRACTED_DATA_ALL'])
-
-            # Set DyscoStMan to be storage manager for WEIGHT_SPECTRUM
-            # For the weights, we use a bit rate of 12, as
-            # recommended in Sec 4.4 of Offringa (2016)
-            dmi = {
-                'SPEC': {
-                    'dataBitCount': np.uint32(16),
-                    'distribution': 'TruncatedGaussian',
-                    'distributionTruncation': 1.5,
-                    'normalization': 'RF',
-                    'weightBitCount': np.uint32(12)},
-                'NAME': 'WEIGHT_SPECTRUM_dm',
-                'SEQNR': 1,
-                'TYPE': 'DyscoStMan'}
-
-            # Change WEIGHT_SPECTRUM to a Direct column if needed
-            desc = seltab.getcoldesc('WEIGHT_SPECTRUM')
-            if desc['option'] != 1:
-                seltab.renamecol('WEIGHT_SPECTRUM', 'WEIGHT_SPECTRUM_TEMP')
-                desc = seltab.getcoldesc('WEIGHT_SPECTRUM_TEMP')
-                desc['name'] = 'WEIGHT_SPECTRUM'
-                desc['option'] = 1 # make a Direct column
-                seltab.addcols(desc, dmi)
-                data = seltab.getcol('WEIGHT_SPECTRUM_TEMP')
-                data[flagged] = np.NaN
-                seltab.putcol('WEIGHT_SPECTRUM', data)
-                seltab.removecols(['WEIGHT_SPECTRUM_TEMP'])
-
-            # Save the new table
-            seltab.copy(chunk_file, deep=True)
-        else:
-            # Just use existing storage manager
-            seltab.copy(chunk_file, deep=True)
-
-        if local_dir is not None:
-            # Copy temp file to original output location and clean up
-            chunk_file_destination_dir = os.path.dirname(chunk_file_original)
-            os.system('/bin/cp -r {0} {1}'.format(chunk_file, chunk_file_destination_dir))
-            if not os.path.samefile(chunk_file, chunk_file_original):
-                shutil.rmtree(chunk_file)
-            chunk_file = chunk_file_original
-
-        shutil.copytree(ms_parmdb, newdirindparmdb)
-    else:
-        log.debug('Chunk {} exists with correct length, not copying!'.format(chunk_name))
+                chunk['output_file'] = chunk['file']
+            if os.path.exists(chunk['output_file']):
+                shutil.rmtree(chunk['output_file'])
+            outtab, replace_weights = make_empty_chunk(seltab, chunk['output_file'],
+                use_compression)
+            outtab.addrows(chunk['nrows'])
+
+        # Copy the rows in blocks. Only the flags are read for chunks that
+        # already exist, to find their unflagged fraction
+        nunflagged = 0
+        nelements = 0
+        endrow = chunk['startrow'] + chunk['nrows']
+        for startrow in range(chunk['startrow'], endrow, nrows_per_read):
+            nrows = min(nrows_per_read, endrow - startrow)
+            outrow = startrow - chunk['startrow']
+            flags = seltab.getcol('FLAG', startrow, nrows)
+            nunflagged += np.count_nonzero(~flags)
+            nelements += flags.size
+            if outtab is None:
+                continue
 
+            outtab.putcol('TIME', timearray[startrow:startrow+nrows], outrow, nrows)
+            outtab.putcol('FLAG', flags, outrow, nrows)
+            for colname in colnames_to_copy:
+                if use_compression and colname == 'SUBTRACTED_DATA_ALL':
+                    continue
+                if use_compression and colname == 'DATA':
+                    # Replace DATA with SUBTRACTED_DATA_ALL and set flagged
+                    # values to NaN (needed for Dysco compression)
+                    data = seltab.getcol('SUBTRACTED_DATA_ALL', startrow, nrows)
+                    data[flags] = np.NaN
+                elif use_compression and colname == 'WEIGHT_SPECTRUM' and replace_weights:
+                    data = seltab.getcol(colname, startrow, nrows)
+                    data[flags] = np.NaN
+                else:
+                    data = seltab.getcol(colname, startrow, nrows)
+                outtab.putcol(colname, data, outrow, nrows)
+        if nelements > 0:
+            chunk['unflagged_fraction'] = float(nunflagged) / nelements
+        else:
+            chunk['unflagged_fraction'] = 0.0
+
+        if outtab is not None:
+            outtab.close()
+            if local_dir is not None:
+                # Copy temp file to original output location and clean up
+                chunk_file_destination_dir = os.path.dirname(chunk['file'])
+                os.system('/bin/cp -r {0} {1}'.format(chunk['output_file'],
+                    chunk_file_destination_dir))
+                if not os.path.samefile(chunk['output_file'], chunk['file']):
+                    shutil.rmtree(chunk['output_file'])
+            shutil.copytree(ms_parmdb, os.path.join(chunk['file'], dirindparmdb))
     seltab.close()
     tab.close()
-    if copy and use_compression:
-        shutil.rmtree(temp_file)
-
-    # Check that the chunk has at least min_fraction unflagged data.
-    # If not, then return (None, None)
-    if find_unflagged_fraction(chunk_file) < min_fraction:
-        log.debug('Chunk {} not used because it contains too little unflagged data'.format(chunk_name))
-        seltab.close()
-        tab.close()
-        return (None, None)
 
-    return (chunk_file, newdirindparmdb)
+    # Check that each chunk has at least min_fraction unflagged data.
+    # If not, then return (None, None) for it
+    results = []
+    for chunk in chunks:
+        if chunk['unflagged_fraction'] < min_fraction:
+            log.debug('Chunk {} not used because it contains too little unflagged data'.format(chunk['name']))
+            results.append((None, None))
+        else:
+            results.append((chunk['file'], os.path.join(chunk['file'], dirindparmdb)))
+
+    return results
+
+
+def make_empty_chunk(seltab, chunk_file, use_compression=True):
+    """
+    Makes an empty chunk file with the columns and subtables of an MS
+
+    Parameters
+    ----------
+    seltab : table
+        Table with the columns to keep of the input MS
+    chunk_file : str
+        Filename of chunk MS
+    use_compression : bool, optional
+        If True, set up the chunk for Dysco compression: the DATA column will
+        hold the SUBTRACTED_DATA_ALL values and WEIGHT_SPECTRUM is stored with
+        the DyscoStMan
+
+    Returns
+    -------
+    outtab : table
+        The chunk, opened for writing
+    replace_weights : bool
+        True if the WEIGHT_SPECTRUM column was replaced by a Dysco-compressed
+        column (in which case its flagged values must be set to NaN)
+
+    """
+    seltab.copy(chunk_file, deep=True, valuecopy=True, copynorows=True)
+
+    # Copying without rows also empties the subtables (ANTENNA,
+    # SPECTRAL_WINDOW, etc.), so replace them with full copies of the
+    # subtables of the input MS
+    for subtable in seltab.getsubtables():
+        chunk_subtable = os.path.join(chunk_file, os.path.basename(subtable))
+        if os.path.exists(chunk_subtable):
+            shutil.rmtree(chunk_subtable)
+        subtab = pt.table(subtable, ack=False)
+        subtab.copy(chunk_subtable, deep=True, valuecopy=True)
+        subtab.close()
+
+    outtab = pt.table(chunk_file, readonly=False, ack=False)
+    replace_weights = False
+    if use_compression:
+        outtab.removecols(['SUBTRACTED_DATA_ALL'])
+
+        # Set DyscoStMan to be storage manager for WEIGHT_SPECTRUM
+        # For the weights, we use a bit rate of 12, as
+        # recommended in Sec 4.4 of Offringa (2016)
+        dmi = {
+            'SPEC': {
+                'dataBitCount': np.uint32(16),
+                'distribution': 'TruncatedGaussian',
+                'distributionTruncation': 1.5,
+                'normalization': 'RF',
+                'weightBitCount': np.uint32(12)},
+            'NAME': 'WEIGHT_SPECTRUM_dm',
+            'SEQNR': 1,
+            'TYPE': 'DyscoStMan'}
+
+        # Change WEIGHT_SPECTRUM to a Direct column if needed
+        desc = outtab.getcoldesc('WEIGHT_SPECTRUM')
+        if desc['option'] != 1:
+            outtab.removecols(['WEIGHT_SPECTRUM'])
+            desc['name'] = 'WEIGHT_SPECTRUM'
+            desc['option'] = 1 # make a Direct column
+            outtab.addcols(desc, dmi)
+            replace_weights = True
+
+    return outtab, replace_weights
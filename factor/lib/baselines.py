@@ -0,0 +1,160 @@
+"""
+Module that holds the BaselineIndex class
+"""
+import numpy as np
+
+
+class BaselineIndex(object):
+    """
+    The BaselineIndex object groups the rows of an MS by baseline
+
+    The rows are sorted once by baseline (and by time within each baseline if
+    times are given; otherwise they keep their order in the MS), so that the
+    rows of each baseline form a contiguous block of the sorted rows
+
+    Parameters
+    ----------
+    ant1 : array of int
+        ANTENNA1 column of the MS
+    ant2 : array of int
+        ANTENNA2 column of the MS
+    time : array of float, optional
+        TIME (or TIME_CENTROID) column of the MS
+
+    """
+    def __init__(self, ant1, ant2, time=None):
+        ant1 = np.asarray(ant1, dtype=np.int64)
+        ant2 = np.asarray(ant2, dtype=np.int64)
+        if len(ant1) != len(ant2):
+            raise ValueError('ANTENNA1 and ANTENNA2 must be equally sized.')
+        self.nrows = len(ant1)
+        if self.nrows > 0:
+            nant = max(np.max(ant1), np.max(ant2)) + 1
+        else:
+            nant = 1
+        key = ant1 * nant + ant2
+        if time is None:
+            # A stable sort keeps the rows of each baseline in MS order
+            self.order = np.argsort(key, kind='mergesort')
+        else:
+            self.order = np.lexsort((np.asarray(time), key))
+
+        sorted_key = key[self.order]
+        bl_keys, self.starts, counts = np.unique(sorted_key, return_index=True,
+            return_counts=True)
+        self.ends = self.starts + counts
+        self.baselines = zip((bl_keys // nant).tolist(), (bl_keys % nant).tolist())
+        self.slices = [slice(s, e) for s, e in zip(self.starts, self.ends)]
+        self._index = dict(zip(self.baselines, range(len(self.baselines))))
+
+
+    def __len__(self):
+        return len(self.baselines)
+
+
+    def get_slice(self, ant1, ant2):
+        """
+        Returns the slice of the sorted rows of a baseline
+
+        Parameters
+        ----------
+        ant1 : int
+            First antenna of the baseline
+        ant2 : int
+            Second antenna of the baseline
+
+        Returns
+        -------
+        bl_slice : slice
+            Slice of the sorted rows (empty if the baseline is not present)
+
+        """
+        i = self._index.get((ant1, ant2))
+        if i is None:
+            return slice(0, 0)
+        return self.slices[i]
+
+
+    def get_rows(self, ant1, ant2):
+        """
+        Returns the MS row numbers of a baseline
+
+        Parameters
+        ----------
+        ant1 : int
+            First antenna of the baseline
+        ant2 : int
+            Second antenna of the baseline
+
+        Returns
+        -------
+        rows : array of int
+            Row numbers, in sorted order
+
+        """
+        return self.order[self.get_slice(ant1, ant2)]
+
+
+    def sort(self, values):
+        """
+        Returns values (with rows along the first axis) in sorted order
+
+        Parameters
+        ----------
+        values : array
+            Values of an MS column
+
+        Returns
+        -------
+        sorted_values : array
+            Copy of the values in sorted order
+
+        """
+        return values[self.order]
+
+
+    def unsort(self, sorted_values, out=None):
+        """
+        Returns sorted values in MS row order
+
+        Parameters
+        ----------
+        sorted_values : array
+            Values in sorted order (as returned by sort())
+        out : array, optional
+            Array into which the values are written. If None, a new array is
+            made
+
+        Returns
+        -------
+        values : array
+            Values in MS row order
+
+        """
+        if out is None:
+            out = np.empty_like(sorted_values)
+        out[self.order] = sorted_values
+
+        return out
+
+
+    def get_dense(self, values):
+        """
+        Returns values as a dense (baseline, time, ...) array
+
+        Parameters
+        ----------
+        values : array
+            Values of an MS column (e.g., with shape (row, chan, pol))
+
+        Returns
+        -------
+        dense_values : array or None
+            Copy of the values with shape (baseline, time, ...), or None if the
+            baselines do not all have the same number of rows
+
+        """
+        counts = self.ends - self.starts
+        if len(counts) == 0 or np.any(counts != counts[0]):
+            return None
+        return self.sort(values).reshape((len(counts), counts[0]) + values.shape[1:])
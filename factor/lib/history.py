@@ -0,0 +1,216 @@
+"""
+Definition of the runtime history class
+"""
+import os
+import logging
+import time
+import numpy as np
+
+log = logging.getLogger('factor:history')
+
+
+class RuntimeHistory(object):
+    """
+    The RuntimeHistory object stores the measured resource usage of operations
+
+    For each completed operation, the wall time, cpu time, peak memory and the
+    wall time of each pipeline step are recorded, keyed by the type of the
+    operation, the image size, the number of bands and the number of time
+    chunks. The records are kept in a file in the state directory of the
+    working directory, so that they are available to later runs
+
+    Parameters
+    ----------
+    factor_working_dir : str
+        Full path of working directory
+
+    """
+    def __init__(self, factor_working_dir):
+        self.save_file = os.path.join(factor_working_dir, 'state',
+            'runtime_history.pkl')
+        self.records = []
+        self.load_state()
+
+
+    def get_key(self, op):
+        """
+        Returns the key of an operation
+
+        Parameters
+        ----------
+        op : Operation instance
+            The operation
+
+        Returns
+        -------
+        key : tuple
+            The (op type, image size, number of bands, number of time chunks)
+            of the operation
+
+        """
+        op_type = op.name.split('_')[0]
+        if getattr(op.direction, 'facet_imsize', None) is not None:
+            imsize = op.direction.facet_imsize
+        else:
+            imsize = getattr(op.direction, 'cal_imsize', 0)
+        nbands = len(op.bands)
+        nchunks = len(op.bands[0].files)
+
+        return (op_type, imsize, nbands, nchunks)
+
+
+    def add(self, op, wall_time, cpu_time=None, peak_memory_mb=None,
+        step_times=None):
+        """
+        Adds a record for a completed operation and saves the history
+
+        Parameters
+        ----------
+        op : Operation instance
+            The completed operation
+        wall_time : float
+            Wall time in seconds
+        cpu_time : float, optional
+            Cpu time in seconds
+        peak_memory_mb : float, optional
+            Peak resident memory in MB
+        step_times : list of (str, float) tuples, optional
+            Wall time in seconds of each pipeline step, in order
+
+        """
+        if step_times is None:
+            step_times = []
+        self.records.append({'key': self.get_key(op), 'name': op.name,
+            'direction': op.direction.name, 'wall_time': wall_time,
+            'cpu_time': cpu_time, 'peak_memory_mb': peak_memory_mb,
+            'step_times': step_times, 'date': time.time()})
+        self.save_state()
+
+
+    def get_scaled_values(self, op, value_key):
+        """
+        Returns the values recorded for operations like the given one
+
+        Records with the same key are used if there are any. Otherwise, the
+        records of the same type of operation are used, scaled to the given
+        operation by the number of image pixels and the number of files
+
+        Parameters
+        ----------
+        op : Operation instance
+            The operation
+        value_key : str
+            Name of the recorded value (e.g., 'wall_time')
+
+        Returns
+        -------
+        values : list of float
+            The (scaled) values
+
+        """
+        op_type, imsize, nbands, nchunks = self.get_key(op)
+        values = [r[value_key] for r in self.records if r['key'] ==
+            (op_type, imsize, nbands, nchunks) and r[value_key] is not None]
+        if len(values) > 0:
+            return values
+
+        for r in self.records:
+            if r['key'][0] != op_type or r[value_key] is None:
+                continue
+            scale = float(nbands * nchunks) / (r['key'][2] * r['key'][3])
+            if imsize > 0 and r['key'][1] > 0:
+                scale *= (float(imsize) / r['key'][1])**2
+            values.append(r[value_key] * scale)
+
+        return values
+
+
+    def predict(self, op, value_key='wall_time'):
+        """
+        Predicts the resource usage of an operation
+
+        Parameters
+        ----------
+        op : Operation instance
+            The operation
+        value_key : str, optional
+            Name of the recorded value to predict (e.g., 'wall_time' or
+            'peak_memory_mb')
+
+        Returns
+        -------
+        prediction : float or None
+            The median of the values of similar operations, or None if there
+            are no records for this type of operation
+
+        """
+        values = self.get_scaled_values(op, value_key)
+        if len(values) == 0:
+            return None
+
+        return float(np.median(values))
+
+
+    def predict_step_times(self, op):
+        """
+        Predicts the wall time of each pipeline step of an operation
+
+        Parameters
+        ----------
+        op : Operation instance
+            The operation
+
+        Returns
+        -------
+        step_times : list of (str, float) tuples
+            Wall time in seconds of each step, taken from the most recent
+            record of the same type of operation (scaled as for predict()).
+            Empty if there is no such record
+
+        """
+        op_type, imsize, nbands, nchunks = self.get_key(op)
+        records = [r for r in self.records if r['key'][0] == op_type and
+            len(r['step_times']) > 0]
+        if len(records) == 0:
+            return []
+
+        exact = [r for r in records if r['key'] == (op_type, imsize, nbands, nchunks)]
+        if len(exact) > 0:
+            return exact[-1]['step_times'][:]
+        r = records[-1]
+        scale = float(nbands * nchunks) / (r['key'][2] * r['key'][3])
+        if imsize > 0 and r['key'][1] > 0:
+            scale *= (float(imsize) / r['key'][1])**2
+
+        return [(name, t * scale) for name, t in r['step_times']]
+
+
+    def save_state(self):
+        """
+        Saves the history to a file
+        """
+        import pickle
+
+        with open(self.save_file+'.tmp', 'wb') as f:
+            pickle.dump(self.records, f)
+        os.rename(self.save_file+'.tmp', self.save_file)
+
+
+    def load_state(self):
+        """
+        Loads the history from a file
+
+        Returns
+        -------
+        success : bool
+            True if state was successfully loaded, False if not
+
+        """
+        import pickle
+
+        try:
+            with open(self.save_file, 'rb') as f:
+                self.records = pickle.load(f)
+            return True
+        except:
+            return False
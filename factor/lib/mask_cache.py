@@ -0,0 +1,152 @@
+"""
+Module that holds the on-disk cache of facet masks
+"""
+import os
+import hashlib
+import numpy as np
+from factor.lib.polygon import rasterize
+
+
+def get_mask_key(polygons, shape, holes=None, include_sides=False):
+    """
+    Returns the key of a mask in the cache
+
+    The key is a hash of the pixel coordinates of the vertices of the polygons
+    and holes (which depend on both the vertices of the facet and the WCS of
+    the image), the image shape and include_sides
+
+    Parameters
+    ----------
+    polygons : list of Polygon objects
+        Polygons of the mask
+    shape : tuple of int
+        Shape of the mask
+    holes : list of Polygon objects, optional
+        Polygons cut out of the mask
+    include_sides : bool, optional
+        Treatment of pixels on the sides (see polygon.rasterize())
+
+    Returns
+    -------
+    key : str
+        Hex digest of the key
+
+    """
+    if holes is None:
+        holes = []
+    md5 = hashlib.md5()
+    md5.update(repr((tuple(shape), bool(include_sides), len(polygons), len(holes))))
+    for poly in polygons + holes:
+        md5.update(np.ascontiguousarray(poly.x, dtype=np.float64).tostring())
+        md5.update(np.ascontiguousarray(poly.y, dtype=np.float64).tostring())
+
+    return md5.hexdigest()
+
+
+def get_mask(cache_dir, polygons, shape, holes=None, include_sides=False,
+    max_cache_size_mb=512.0):
+    """
+    Returns a facet mask, using the cache where possible
+
+    Masks are stored in cache_dir as packed bits (one bit per pixel), so that a
+    cached mask can be read with a memory-mapped load. When the total size of
+    the cache exceeds max_cache_size_mb, the least recently used masks are
+    removed. The default of 512 MB holds about ten masks of the largest facet
+    images (20000 x 20000 pixels, 50 MB each), or many more of typical size
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory in which the masks are stored
+    polygons : list of Polygon objects
+        Polygons of the mask (see polygon.rasterize())
+    shape : tuple of int
+        Shape of the mask
+    holes : list of Polygon objects, optional
+        Polygons cut out of the mask
+    include_sides : bool, optional
+        Treatment of pixels on the sides (see polygon.rasterize())
+    max_cache_size_mb : float, optional
+        Maximum total size of the cache in MB. If 0, the cache is not used
+
+    Returns
+    -------
+    mask : array of bool
+        True for the pixels inside the polygons and outside the holes
+
+    """
+    if max_cache_size_mb <= 0.0:
+        return rasterize(polygons, shape, holes=holes, include_sides=include_sides)
+
+    shape = tuple(shape)
+    npix = int(np.prod(shape))
+    key = get_mask_key(polygons, shape, holes, include_sides)
+    cache_file = os.path.join(cache_dir, 'mask_{0}.npy'.format(key))
+
+    try:
+        packed = np.load(cache_file, mmap_mode='r')
+        if packed.size == (npix + 7) // 8:
+            mask = np.unpackbits(packed)[:npix].reshape(shape).astype(bool)
+            try:
+                # Mark the mask as recently used
+                os.utime(cache_file, None)
+            except OSError:
+                pass
+            return mask
+    except Exception:
+        pass
+
+    mask = rasterize(polygons, shape, holes=holes, include_sides=include_sides)
+
+    if not os.path.exists(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # Made by another process
+            pass
+    temp_file = '{0}.{1}.tmp'.format(cache_file, os.getpid())
+    try:
+        with open(temp_file, 'wb') as f:
+            np.save(f, np.packbits(mask.ravel()))
+        os.rename(temp_file, cache_file)
+        prune_mask_cache(cache_dir, max_cache_size_mb)
+    except (IOError, OSError):
+        # The cache is not essential, so continue without it
+        pass
+
+    return mask
+
+
+def prune_mask_cache(cache_dir, max_cache_size_mb):
+    """
+    Removes the least recently used masks until the cache fits in the given size
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory in which the masks are stored
+    max_cache_size_mb : float
+        Maximum total size of the cache in MB
+
+    """
+    entries = []
+    for filename in os.listdir(cache_dir):
+        if not (filename.startswith('mask_') and filename.endswith('.npy')):
+            continue
+        try:
+            st = os.stat(os.path.join(cache_dir, filename))
+        except OSError:
+            # Removed by another process
+            continue
+        entries.append((st.st_mtime, st.st_size, filename))
+
+    total_size = sum([e[1] for e in entries])
+    max_size = max_cache_size_mb * 1024.0 * 1024.0
+    for mtime, size, filename in sorted(entries):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, filename))
+        except OSError:
+            pass
+        total_size -= size
@@ -52,6 +52,17 @@ class Operation(object):
         self.hostname = socket.gethostname()
         self.node_list = parset['cluster_specific']['node_list']
 
+        # Name of the pipeline job (the pipeline makes a subdir in the runtime
+        # and working dirs with this name) and the operation of which this one
+        # is a copy (see make_copy())
+        self.job_name = self.direction.name
+        self.original = None
+
+        # Whether a copy of this operation may be run at the same time as it
+        # (e.g., on another node if it is running slowly). This should be set
+        # in the subclasses for operations that do not modify their input data
+        self.allow_speculation = False
+
         # Working directory
         self.factor_working_dir = parset['dir_working']
 
@@ -156,7 +167,8 @@ class Operation(object):
                            'local_dir_parent': self.local_dir_parent,
                            'selfcal_local_dir': self.local_selfcal_scratch_dir,
                            'pipeline_parset_dir': self.pipeline_parset_dir,
-                           'hosts': self.node_list}
+                           'hosts': self.node_list,
+                           'mask_cache_size_mb': parset['cluster_specific']['mask_cache_size_mb']}
 
         # Add cluster-related info
         if self.parset['cluster_specific']['clustertype'] == 'local':
@@ -183,6 +195,64 @@ class Operation(object):
             self.parset['cluster_specific']['clusterdesc'])
 
 
+    def make_copy(self, job_name):
+        """
+        Returns a copy of this operation that runs as a separate pipeline job
+
+        The copy has its own pipeline directory (and hence mapfiles and
+        outputs), logs and scratch directories, so that it can run at the same
+        time as this operation. Its direction object is a shallow copy of this
+        one, with its own state file, so that its nodes can be set
+        independently
+
+        Parameters
+        ----------
+        job_name : str
+            Name of the pipeline job of the copy
+
+        Returns
+        -------
+        op : Operation instance
+            The copy
+
+        """
+        import copy
+
+        op = copy.copy(self)
+        op.original = self
+        op.job_name = job_name
+        op.direction = copy.copy(self.direction)
+
+        op.pipeline_parset_dir = os.path.join(self.pipeline_runtime_dir, job_name)
+        create_directory(op.pipeline_parset_dir)
+        op.pipeline_mapfile_dir = os.path.join(op.pipeline_parset_dir, 'mapfiles')
+        create_directory(op.pipeline_mapfile_dir)
+        op.pipeline_parset_file = os.path.join(op.pipeline_parset_dir,
+            'pipeline.parset')
+        op.pipeline_config_file = os.path.join(op.pipeline_parset_dir,
+            'pipeline.cfg')
+        op.logbasename = os.path.join(self.log_dir, job_name)
+        op.direction.save_file = os.path.join(op.pipeline_parset_dir,
+            'direction_state.pkl')
+
+        scratch_subdir = '{0}_{1}'.format(job_name, str(uuid.uuid4().get_hex()[0:6]))
+        if self.local_scratch_dir is not None:
+            op.local_scratch_dir = os.path.join(self.local_dir_parent,
+                scratch_subdir)
+        if self.local_selfcal_scratch_dir is not None:
+            op.local_selfcal_scratch_dir = os.path.join(
+                self.parset['cluster_specific']['dir_local_selfcal'], scratch_subdir)
+
+        op.cfg_dict = self.cfg_dict.copy()
+        op.parms_dict = self.parms_dict.copy()
+        op.parms_dict.update({'mapfile_dir': op.pipeline_mapfile_dir,
+                              'local_dir': op.local_scratch_dir,
+                              'selfcal_local_dir': op.local_selfcal_scratch_dir,
+                              'pipeline_parset_dir': op.pipeline_parset_dir})
+
+        return op
+
+
     def update_dicts(self):
         """
         Update the dicts used for the pipeline parset templates
@@ -43,7 +43,7 @@ class Polygon:
             self.y = self.y[::-1]
 
 
-    def is_inside(self, xpoint, ypoint, smalld=1e-12):
+    def is_inside(self, xpoint, ypoint, smalld=1e-12, max_elements=1000000):
         """
         Check if point is inside a general polygon.
 
@@ -52,6 +52,9 @@ class Polygon:
         REF: SLOAN, S.W. (1985): A point-in-polygon program. Adv. Eng.
         Software, Vol 7, No. 1, pp 45-47.
 
+        The points are processed in blocks of at most max_elements points, to
+        limit the memory used.
+
         Parameters
         ----------
         xpoint : array or float
@@ -60,6 +63,8 @@ class Polygon:
             The y-coords of the point to be tested.
         smalld : float
             Tolerance within which point is considered to be on a side.
+        max_elements : int, optional
+            Maximum number of points per block.
 
         Returns
         -------
@@ -85,21 +90,54 @@ class Polygon:
         if xpoint.shape != ypoint.shape:
             raise IndexError('x and y  must be equally sized.')
 
-        # If snear = True: Dist to nearest side < nearest vertex
-        # If snear = False: Dist to nearest vertex < nearest side
-        snear = np.ma.masked_all(xpoint.shape, dtype=bool)
+        xflat = xpoint.ravel()
+        yflat = ypoint.ravel()
+        mindst = np.empty(xflat.shape, dtype=float)
+        for start in range(0, len(xflat), max_elements):
+            end = start + max_elements
+            mindst[start:end] = self._signed_distance(xflat[start:end],
+                yflat[start:end])
+        mindst = mindst.reshape(xpoint.shape)
 
-        # Initialize arrays
-        mindst = np.ones_like(xpoint, dtype=float) * np.inf
-        j = np.ma.masked_all(xpoint.shape, dtype=int)
+        # Point is on side of polygon
+        mindst[np.fabs(mindst) < smalld] = 0
+
+        # If input values were scalar then the output should be too
+        if scalar:
+            mindst = float(mindst)
+        return mindst
+
+
+    def _signed_distance(self, xpoint, ypoint):
+        """
+        Returns the signed distance of points to the polygon (see is_inside())
+
+        Parameters
+        ----------
+        xpoint : array
+            The x-coords of the points (1-D).
+        ypoint : array
+            The y-coords of the points (1-D).
+
+        Returns
+        -------
+        mindst : array
+            The signed distance from each point to the nearest point of the
+            polygon.
+
+        """
         x = self.x
         y = self.y
         n = len(x) - 1  # Number of sides/vertices defining the polygon
 
+        # If snear = True: Dist to nearest side < nearest vertex
+        # If snear = False: Dist to nearest vertex < nearest side
+        snear = np.zeros(xpoint.shape, dtype=bool)
+        mindst = np.ones_like(xpoint, dtype=float) * np.inf
+        j = np.zeros(xpoint.shape, dtype=int)
+
         # Loop over each side defining polygon
         for i in range(n):
-            d = np.ones_like(xpoint, dtype=float) * np.inf
-
             # Start of side has coords (x1, y1)
             # End of side has coords (x2, y2)
             # Point has coords (xpoint, ypoint)
@@ -118,11 +156,13 @@ class Polygon:
             #     t = 1    at (x2, y2)
             # Find where normal passing through (xpoint, ypoint) intersects
             # infinite line
-            t = -(x1p * x21 + y1p * y21) / (x21 ** 2 + y21 ** 2)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t = -(x1p * x21 + y1p * y21) / (x21 ** 2 + y21 ** 2)
             tlt0 = t < 0
             tle1 = (0 <= t) & (t <= 1)
 
             # Normal intersects side
+            d = np.ones_like(xpoint, dtype=float) * np.inf
             d[tle1] = ((x1p[tle1] + t[tle1] * x21) ** 2 +
                        (y1p[tle1] + t[tle1] * y21) ** 2)
 
@@ -136,13 +176,11 @@ class Polygon:
             mindst[mask] = d[mask]
             j[mask] = i
 
-            # Point is closer to (x1, y1) than any other vertex or side
-            snear[mask & tlt0] = False
-
-            # Point is closer to this side than to any other side or vertex
-            snear[mask & tle1] = True
+            # Point is closer to (x1, y1) than any other vertex or side (tlt0),
+            # or closer to this side than to any other side or vertex (tle1)
+            snear[mask] = tle1[mask]
 
-        if np.ma.count(snear) != snear.size:
+        if np.any(np.isinf(mindst)):
             raise IndexError('Error computing distances')
         mindst **= 0.5
 
@@ -164,13 +202,97 @@ class Polygon:
         area[area==0.] =-1.  # remove point if it  is _on_ the line
         mindst[snear] = np.copysign(mindst, area)[snear]
 
-        # Point is on side of polygon
-        mindst[np.fabs(mindst) < smalld] = 0
+        return mindst
 
-        # If input values were scalar then the output should be too
+
+    def contains(self, xpoint, ypoint, include_sides=False, smalld=1e-12,
+        max_elements=250000):
+        """
+        Check if points are inside the polygon, without computing distances.
+
+        Points outside the bounding box of the polygon are rejected first. The
+        others are tested against all sides at once with the crossing-number
+        (even-odd) rule, in blocks of points. Points that lie on or very near a
+        side, for which the crossing-number test is ambiguous, are tested with
+        is_inside(), so that (for simple polygons) the result is identical to
+        is_inside() > 0 (or >= 0 if include_sides is True).
+
+        Parameters
+        ----------
+        xpoint : array or float
+            The x-coords of the points to be tested.
+        ypoint : array or float
+            The y-coords of the points to be tested.
+        include_sides : bool, optional
+            If True, points on a side of the polygon count as inside.
+        smalld : float, optional
+            Tolerance within which point is considered to be on a side.
+        max_elements : int, optional
+            Maximum number of elements of the arrays used per block of points.
+
+        Returns
+        -------
+        inside : array or bool
+            True for points inside the polygon.
+
+        """
+        xpoint = np.asfarray(xpoint)
+        ypoint = np.asfarray(ypoint)
+        if xpoint.shape != ypoint.shape:
+            raise IndexError('x and y  must be equally sized.')
+        scalar = (xpoint.shape is tuple())
+        xflat = xpoint.ravel()
+        yflat = ypoint.ravel()
+        inside = np.zeros(xflat.shape, dtype=bool)
+
+        # Bounding-box prefilter
+        margin = max(smalld, 1e-9 * max(1.0, np.max(np.abs(self.x)),
+            np.max(np.abs(self.y))))
+        in_box = np.where((xflat >= np.min(self.x) - margin) &
+            (xflat <= np.max(self.x) + margin) & (yflat >= np.min(self.y) - margin) &
+            (yflat <= np.max(self.y) + margin))[0]
+
+        x1 = self.x[np.newaxis, :-1]
+        y1 = self.y[np.newaxis, :-1]
+        x21 = self.x[np.newaxis, 1:] - x1
+        y21 = self.y[np.newaxis, 1:] - y1
+        sin21 = np.abs(y21) / np.sqrt(x21 ** 2 + y21 ** 2)
+        horizontal = np.where(y21[0] == 0.0)[0]
+        nblock = max(1, int(max_elements / (len(self.x) - 1)))
+        for start in range(0, len(in_box), nblock):
+            ind = in_box[start:start+nblock]
+            xp = xflat[ind, np.newaxis]
+            yp = yflat[ind, np.newaxis]
+
+            # Count the sides crossed by a ray from the point in the +x
+            # direction
+            straddle = (y1 > yp) != (y1 + y21 > yp)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                dxcross = xp - (x1 + (yp - y1) * x21 / y21)
+                ncross = np.sum(straddle & (dxcross < 0.0), axis=1)
+                inside[ind] = (ncross % 2 == 1)
+
+                # Find points on or near a side or vertex, and use the
+                # distance test for them
+                near = np.any((straddle & (np.abs(dxcross) * sin21 <= margin)) |
+                    ((np.abs(yp - y1) <= margin) & (np.abs(xp - x1) <= margin)), axis=1)
+            for i in horizontal:
+                near |= ((np.abs(yp[:, 0] - y1[0, i]) <= margin) &
+                    (xp[:, 0] >= min(x1[0, i], x1[0, i] + x21[0, i]) - margin) &
+                    (xp[:, 0] <= max(x1[0, i], x1[0, i] + x21[0, i]) + margin))
+            near = np.where(near)[0]
+            if len(near) > 0:
+                dist = self.is_inside(xflat[ind[near]], yflat[ind[near]],
+                    smalld=smalld)
+                if include_sides:
+                    inside[ind[near]] = dist >= 0.0
+                else:
+                    inside[ind[near]] = dist > 0.0
+
+        inside = inside.reshape(xpoint.shape)
         if scalar:
-            mindst = float(mindst)
-        return mindst
+            inside = bool(inside)
+        return inside
 
     def  check_intersections(self):
         """
@@ -198,6 +320,131 @@ class Polygon:
                         segB,segB+1,self.x[segB], self.y[segB], self.x[segB+1], self.y[segB+1])
         return num_intersections
                 
+def rasterize(polygons, shape, holes=None, include_sides=False):
+    """
+    Makes a boolean mask of the pixels inside one or more polygons.
+
+    The polygons are filled row by row from their vertices (scanline fill):
+    for each row, the positions at which the sides cross the row are found,
+    and the pixels between pairs of crossings are filled. This takes
+    O(rows x sides) operations instead of the O(pixels x sides) of testing
+    every pixel. Pixels on or very near a side, and rows that pass through a
+    vertex, are tested with Polygon.contains(), so that the mask is identical
+    to Polygon.is_inside() > 0 (or >= 0 if include_sides is True).
+
+    Pixel (i, j) has x = i and y = j, as for Polygon.is_inside().
+
+    Parameters
+    ----------
+    polygons : list of Polygon instances
+        Polygons to fill. Pixels inside any of them are True.
+    shape : tuple of int
+        Shape (nx, ny) of the mask.
+    holes : list of Polygon instances, optional
+        Polygons to cut out of the filled polygons.
+    include_sides : bool, optional
+        If True, pixels on a side of the polygons (or of the holes) are
+        considered to be inside (or outside) the filled region.
+
+    Returns
+    -------
+    mask : array
+        Boolean mask of the given shape.
+
+    """
+    mask = np.zeros(shape, dtype=bool)
+    for poly in polygons:
+        mask |= _rasterize_polygon(poly, shape, include_sides)
+    if holes is not None:
+        for poly in holes:
+            mask &= ~_rasterize_polygon(poly, shape, not include_sides)
+
+    return mask
+
+
+def _rasterize_polygon(poly, shape, include_sides=False):
+    """
+    Makes a boolean mask of the pixels inside a polygon (see rasterize()).
+
+    Parameters
+    ----------
+    poly : Polygon instance
+        Polygon to fill.
+    shape : tuple of int
+        Shape (nx, ny) of the mask.
+    include_sides : bool, optional
+        If True, pixels on a side of the polygon are considered to be inside.
+
+    Returns
+    -------
+    mask : array
+        Boolean mask of the given shape.
+
+    """
+    nx, ny = shape
+    mask = np.zeros((nx, ny), dtype=bool)
+    margin = max(1e-12, 1e-9 * max(1.0, np.max(np.abs(poly.x)),
+        np.max(np.abs(poly.y))))
+    xmin = max(0, int(np.ceil(np.min(poly.x) - margin)))
+    xmax = min(nx - 1, int(np.floor(np.max(poly.x) + margin)))
+    if xmax < xmin:
+        return mask
+    rows = np.arange(xmin, xmax + 1)
+
+    # Find the crossings of the sides with each row
+    x1 = poly.x[np.newaxis, :-1]
+    y1 = poly.y[np.newaxis, :-1]
+    x21 = poly.x[np.newaxis, 1:] - x1
+    y21 = poly.y[np.newaxis, 1:] - y1
+    xr = rows[:, np.newaxis].astype(float)
+    straddle = (x1 > xr) != (x1 + x21 > xr)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ycross = np.where(straddle, y1 + (xr - x1) * y21 / x21, np.inf)
+    ycross.sort(axis=1)
+    ncross = np.sum(straddle, axis=1)
+
+    # Fill the pixels between pairs of crossings, using the difference of
+    # the starts and ends of the filled runs
+    runs = np.zeros((len(rows), ny + 1), dtype=int)
+    for k in range(0, ycross.shape[1] - 1, 2):
+        has_pair = ncross > k + 1
+        start = np.floor(ycross[has_pair, k]) + 1
+        end = np.ceil(ycross[has_pair, k+1]) - 1
+        start = np.clip(start, 0, ny).astype(int)
+        end = np.clip(end, -1, ny - 1).astype(int)
+        filled = start <= end
+        ind = np.where(has_pair)[0][filled]
+        np.add.at(runs, (ind, start[filled]), 1)
+        np.add.at(runs, (ind, end[filled] + 1), -1)
+    mask[xmin:xmax+1] = np.cumsum(runs[:, :ny], axis=1) > 0
+
+    # Test the pixels near a crossing, and the rows near a vertex, directly
+    near_vertex = np.any(np.abs(xr - x1) <= margin, axis=1)
+    ycross_finite = np.where(np.isfinite(ycross), ycross, np.nan)
+    with np.errstate(invalid='ignore'):
+        near_pix = np.abs(ycross_finite - np.round(ycross_finite)) <= margin
+    check_rows = []
+    check_cols = []
+    ymin = max(0, int(np.ceil(np.min(poly.y) - margin)))
+    ymax = min(ny - 1, int(np.floor(np.max(poly.y) + margin)))
+    for i in np.where(near_vertex)[0]:
+        cols = np.arange(ymin, ymax + 1)
+        check_rows.append(np.ones(len(cols), dtype=int) * rows[i])
+        check_cols.append(cols)
+    ind, k = np.where(near_pix & ~near_vertex[:, np.newaxis])
+    cols = np.round(ycross[ind, k]).astype(int)
+    in_image = (cols >= 0) & (cols < ny)
+    check_rows.append(rows[ind[in_image]])
+    check_cols.append(cols[in_image])
+    check_rows = np.concatenate(check_rows)
+    check_cols = np.concatenate(check_cols)
+    if len(check_rows) > 0:
+        mask[check_rows, check_cols] = poly.contains(check_rows, check_cols,
+            include_sides=include_sides)
+
+    return mask
+
+
 def _segments_intersect(Ax, Ay, Bx, By, Cx, Cy, Dx, Dy):
     """
     Check if two line-segments (Ax, Ay) -> (Bx, By) and (Cx, Cy) -> (Dx, Dy)
@@ -9,14 +9,273 @@ import sys
 import imp
 import numpy as np
 import shutil
+import copy
+import Queue
 from collections import Counter
 from factor.lib.context import Timer
 
 log = logging.getLogger('factor:scheduler')
 
 
+# Generic pipeline modules loaded in this process, keyed by executable path
+_genericpipeline_modules = {}
+
+
+def load_genericpipeline(genericpipeline_executable):
+    """
+    Loads the generic pipeline modules, reusing them if already loaded
+
+    Parameters
+    ----------
+    genericpipeline_executable : str
+        Path to genericpipeline.py executable
+
+    Returns
+    -------
+    gp : module
+        The genericpipeline module
+
+    """
+    if genericpipeline_executable not in _genericpipeline_modules:
+        genericpipeline_path = os.path.dirname(genericpipeline_executable)
+        loader = imp.load_source('loader', os.path.join(genericpipeline_path,
+            'loader.py'))
+        gp = imp.load_source('gp', genericpipeline_executable)
+        _genericpipeline_modules[genericpipeline_executable] = gp
+
+    return _genericpipeline_modules[genericpipeline_executable]
+
+
+def init_worker(genericpipeline_executable):
+    """
+    Initializes a worker process of the scheduler's pool
+
+    The generic pipeline is loaded once here, so that it does not need to be
+    loaded again for each pipeline run by the worker
+
+    Parameters
+    ----------
+    genericpipeline_executable : str
+        Path to genericpipeline.py executable
+
+    """
+    try:
+        load_genericpipeline(genericpipeline_executable)
+    except Exception:
+        # Leave any error to be reported when a pipeline is run, as the pool
+        # would otherwise keep restarting the worker
+        pass
+
+
+def watch_resources(pipeline, resource_file, stop_event, interval=10.0):
+    """
+    Applies updated process limits to a running pipeline
+
+    The limits (e.g., max_proc_per_node) are set in the defaults of the
+    pipeline's config and task definitions, from which the maximum number of
+    processes per node is read at the start of each step. The new limits are
+    therefore used from the next step on
+
+    Parameters
+    ----------
+    pipeline : GenericPipeline instance
+        The running pipeline
+    resource_file : str
+        Name of pickle file with a dict of the limits, written by the scheduler
+    stop_event : threading.Event instance
+        Event that is set when the pipeline has finished
+    interval : float, optional
+        Time in seconds between checks of the resource file
+
+    """
+    import pickle
+
+    mtime = None
+    while not stop_event.wait(interval):
+        try:
+            new_mtime = os.path.getmtime(resource_file)
+            if new_mtime == mtime:
+                continue
+            mtime = new_mtime
+            with open(resource_file, 'rb') as f:
+                resources = pickle.load(f)
+            for parser in [getattr(pipeline, 'config', None),
+                getattr(pipeline, 'task_definitions', None)]:
+                if parser is not None:
+                    for key, val in resources.items():
+                        parser.set('DEFAULT', key, str(val))
+        except Exception:
+            # The file may be in the middle of being replaced; try again later
+            mtime = None
+
+
+def get_process_table():
+    """
+    Returns the parent-child relations and resident memory of all processes
+
+    Only processes on the local machine can be seen (using /proc, so this
+    works on Linux only)
+
+    Returns
+    -------
+    children : dict
+        List of the IDs of the child processes of each process
+    rss_mb : dict
+        Resident memory in MB of each process
+
+    """
+    children = {}
+    rss_mb = {}
+    try:
+        pids = [int(p) for p in os.listdir('/proc') if p.isdigit()]
+        page_size_mb = os.sysconf('SC_PAGE_SIZE') / 1024.0**2
+    except (OSError, ValueError):
+        return children, rss_mb
+
+    for p in pids:
+        try:
+            with open('/proc/{0}/stat'.format(p)) as f:
+                # The fields after the command name, which may contain spaces
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (IOError, IndexError):
+            continue
+        children.setdefault(int(fields[1]), []).append(p)
+        rss_mb[p] = int(fields[21]) * page_size_mb
+
+    return children, rss_mb
+
+
+def get_descendants(pid, children):
+    """
+    Returns the IDs of all descendants of a process
+
+    Parameters
+    ----------
+    pid : int
+        Process ID of the parent process
+    children : dict
+        List of the IDs of the child processes of each process (as returned
+        by get_process_table())
+
+    Returns
+    -------
+    descendants : list of int
+        Process IDs
+
+    """
+    descendants = []
+    tree = children.get(pid, [])[:]
+    while len(tree) > 0:
+        p = tree.pop()
+        descendants.append(p)
+        tree.extend(children.get(p, []))
+
+    return descendants
+
+
+def get_process_tree_rss(pid):
+    """
+    Returns the resident memory of a process and all of its descendants
+
+    Parameters
+    ----------
+    pid : int
+        Process ID of the parent process
+
+    Returns
+    -------
+    rss_mb : float
+        Total resident memory in MB (0 if it cannot be determined)
+
+    """
+    children, rss_mb = get_process_table()
+
+    return sum([rss_mb.get(p, 0.0) for p in [pid] + get_descendants(pid, children)])
+
+
+def kill_pipeline(pipeline_dir):
+    """
+    Stops the processes started by a running pipeline
+
+    The pool worker that runs the pipeline is not stopped (so that the pool
+    is unaffected), but the pipeline fails once its processes are gone. Only
+    processes on the local machine are stopped directly (processes on remote
+    nodes are stopped only if they end when their ssh connection does)
+
+    Parameters
+    ----------
+    pipeline_dir : str
+        Directory of the pipeline (where the pid file of the worker is
+        written by call_generic_pipeline())
+
+    """
+    try:
+        with open(os.path.join(pipeline_dir, 'worker.pid')) as f:
+            pid = int(f.read())
+    except (IOError, ValueError):
+        # Pipeline is not running
+        return
+
+    children, rss_mb = get_process_table()
+    for p in get_descendants(pid, children):
+        try:
+            os.kill(p, signal.SIGTERM)
+        except OSError:
+            pass
+
+
+def monitor_usage(pipeline_dir, usage, stop_event, interval=5.0):
+    """
+    Records the peak memory and the step times of a running pipeline
+
+    The memory is sampled for the worker process and all of its children. The
+    step times are derived from the times at which the steps appear in the
+    pipeline's statefile, so they are accurate to about the sampling interval
+
+    Parameters
+    ----------
+    pipeline_dir : str
+        Directory of the pipeline (where its statefile is written)
+    usage : dict
+        Dict in which the peak memory (under 'peak_memory_mb') and the
+        list of (step, wall time) tuples (under 'step_times') are stored
+    stop_event : threading.Event instance
+        Event that is set when the pipeline has finished
+    interval : float, optional
+        Time in seconds between samples
+
+    """
+    import pickle
+    import time
+
+    statefile = os.path.join(pipeline_dir, 'statefile')
+    pid = os.getpid()
+    nsteps = None
+    last_time = time.time()
+    while True:
+        usage['peak_memory_mb'] = max(usage['peak_memory_mb'],
+            get_process_tree_rss(pid))
+        try:
+            with open(statefile, 'rb') as f:
+                steps = [item[0] for item in pickle.load(f)[1]]
+        except Exception:
+            steps = []
+        if nsteps is None:
+            # Skip steps done in a previous (resumed) run
+            nsteps = len(steps)
+        now = time.time()
+        new_steps = steps[nsteps:]
+        for step in new_steps:
+            usage['step_times'].append((step, (now - last_time) / len(new_steps)))
+        if len(new_steps) > 0:
+            nsteps = len(steps)
+            last_time = now
+        if stop_event.wait(interval):
+            break
+
+
 def call_generic_pipeline(op_name, direction_name, parset, config, logbasename,
-    genericpipeline_executable):
+    genericpipeline_executable, resource_file=None, job_name=None):
     """
     Creates a GenericPipeline object and runs the pipeline
 
@@ -34,26 +293,38 @@ def call_generic_pipeline(op_name, direction_name, parset, config, logbasename,
         Log file base name
     genericpipeline_executable : str
         Path to genericpipeline.py executable
+    resource_file : str, optional
+        Name of file with updated process limits for the pipeline (see
+        watch_resources()). If None, the limits are not updated while the
+        pipeline runs
+    job_name : str, optional
+        Name of the pipeline job. If None, the direction name is used
+
+    Returns
+    -------
+    result : tuple
+        The (op_name, job_name, status, usage) of the pipeline run, where usage
+        is a dict with the cpu time, peak memory and step times
 
     """
     from lofarpipe.support.pipelinelogging import getSearchingLogger
     from factor.lib.context import RedirectStdStreams
-    import time
+    import threading
+    import resource
 
-    genericpipeline_path = os.path.dirname(genericpipeline_executable)
-    loader = imp.load_source('loader', os.path.join(genericpipeline_path,
-        'loader.py'))
-    gp = imp.load_source('gp', genericpipeline_executable)
+    if job_name is None:
+        job_name = direction_name
+    gp = load_genericpipeline(genericpipeline_executable)
 
     # Initalize pipeline object
     pipeline = gp.GenericPipeline()
 
     # Add needed attr/methods
-    pipeline.name = '{0}_{1}'.format(op_name, direction_name)
+    pipeline.name = '{0}_{1}'.format(op_name, job_name)
     pipeline.logger = getSearchingLogger(pipeline.name)
     pipeline.inputs['args'] = [parset]
     pipeline.inputs['config'] = config
-    pipeline.inputs['job_name'] = direction_name
+    pipeline.inputs['job_name'] = job_name
 
     # Set pipeline logging to DEBUG level
     logging.root.setLevel(logging.DEBUG)
@@ -61,16 +332,312 @@ def call_generic_pipeline(op_name, direction_name, parset, config, logbasename,
     for handler in pipeline.logger.handlers:
         handler.setLevel(logging.DEBUG)
 
+    # Watch for changes to the process limits while the pipeline runs
+    if resource_file is not None:
+        stop_event = threading.Event()
+        watcher = threading.Thread(target=watch_resources, args=(pipeline,
+            resource_file, stop_event))
+        watcher.daemon = True
+        watcher.start()
+
+    # Record the resource usage of the pipeline
+    usage = {'peak_memory_mb': 0.0, 'step_times': []}
+    usage_stop_event = threading.Event()
+    monitor = threading.Thread(target=monitor_usage, args=(os.path.dirname(parset),
+        usage, usage_stop_event))
+    monitor.daemon = True
+    monitor.start()
+    start_rusage = [resource.getrusage(resource.RUSAGE_SELF),
+        resource.getrusage(resource.RUSAGE_CHILDREN)]
+
+    # Record the ID of this process, so that the pipeline can be stopped (see
+    # kill_pipeline())
+    pid_file = os.path.join(os.path.dirname(parset), 'worker.pid')
+    with open(pid_file, 'w') as f:
+        f.write(str(os.getpid()))
+
     # Run the pipeline, redirecting screen output to log files
-    time.sleep(2.0) # pause to allow result_callback() to transfer resources
     log.info('<-- Operation {0} started (direction: {1})'.format(op_name,
         direction_name))
-    with open("{0}.out.log".format(logbasename), "wb") as out, \
-        open("{0}.err.log".format(logbasename), "wb") as err:
-        with RedirectStdStreams(stdout=out, stderr=err):
-            status = pipeline.run(pipeline.name)
+    try:
+        with open("{0}.out.log".format(logbasename), "wb") as out, \
+            open("{0}.err.log".format(logbasename), "wb") as err:
+            with RedirectStdStreams(stdout=out, stderr=err):
+                status = pipeline.run(pipeline.name)
+    finally:
+        if resource_file is not None:
+            stop_event.set()
+            watcher.join()
+        usage_stop_event.set()
+        monitor.join()
+        os.remove(pid_file)
+    end_rusage = [resource.getrusage(resource.RUSAGE_SELF),
+        resource.getrusage(resource.RUSAGE_CHILDREN)]
+    usage['cpu_time'] = sum([(e.ru_utime + e.ru_stime) - (s.ru_utime + s.ru_stime)
+        for s, e in zip(start_rusage, end_rusage)])
+
+    return (op_name, job_name, status, usage)
 
-    return (op_name, direction_name, status)
+
+class OperationNode(object):
+    """
+    Node of the operation graph run by Scheduler.run_dag()
+
+    Dependencies between nodes are derived from the shared resources that
+    their operations read and write (e.g., the subtracted-data column of the
+    input datasets or the state of a direction): a node depends on every
+    earlier node in the list that writes a resource it reads or writes, or that
+    reads a resource it writes. Further dependencies can be given explicitly
+
+    Parameters
+    ----------
+    make_op : callable or None
+        Function that returns the Operation instance of this node. It is called
+        only once all dependencies have completed, so that the operation is
+        set up with the direction state produced by them. If None, the node
+        has no operation and only its on_completion function is run (e.g., to
+        do bookkeeping after a group of operations)
+    reads : list of str, optional
+        Shared resources read by the operation
+    writes : list of str, optional
+        Shared resources written by the operation
+    depends_on : list of OperationNode instances, optional
+        Explicit dependencies in addition to those derived from reads and
+        writes
+    condition : callable, optional
+        Function that is called when the node is ready. If it returns False,
+        the operation is skipped (e.g., facetsub for a direction for which
+        selfcal failed)
+    on_completion : callable, optional
+        Function that is called with the completed operation (or None) after
+        it has been finalized. If it returns False, no further operations are
+        started
+    name : str, optional
+        Name of node (used for logging)
+
+    """
+    def __init__(self, make_op, reads=[], writes=[], depends_on=[],
+        condition=None, on_completion=None, name=''):
+        self.make_op = make_op
+        self.reads = set(reads)
+        self.writes = set(writes)
+        self.depends_on = depends_on[:]
+        self.condition = condition
+        self.on_completion = on_completion
+        self.name = name
+        self.op = None
+        self.slots = {} # number of slots used on each node while running
+        self.state = 'pending' # one of 'pending', 'running', 'done', 'skipped'
+
+
+    def conflicts_with(self, other):
+        """
+        Checks whether this node and another node access a resource in a way
+        that requires them to be run in order
+
+        Parameters
+        ----------
+        other : OperationNode instance
+            Node to check against
+
+        Returns
+        -------
+        conflict : bool
+            True if the nodes cannot be run at the same time
+
+        """
+        return (len(self.writes & (other.reads | other.writes)) > 0 or
+            len(self.reads & other.writes) > 0)
+
+
+    def is_ready(self):
+        """
+        Checks whether all dependencies of this node have finished
+
+        Returns
+        -------
+        ready : bool
+            True if all dependencies are done or skipped
+
+        """
+        return all([n.state in ['done', 'skipped'] for n in self.depends_on])
+
+
+class MemoryAdmission(object):
+    """
+    The MemoryAdmission object decides whether an operation fits in the free
+    memory of its nodes
+
+    The expected peak memory of an operation is taken from the history of
+    similar operations if available. Otherwise, it is estimated from the
+    volume of the visibility data that its processes read at once and the size
+    of its images. The memory expected to be used by the operations running on
+    each node is tracked, and a new operation is only started on a node if it
+    fits in the remaining memory (an operation is always allowed to start on
+    an otherwise idle node)
+
+    Parameters
+    ----------
+    node_memory_mb : float
+        Memory per node in MB that operations may use
+    history : RuntimeHistory instance, optional
+        Store of the measured resource usage of previous operations
+
+    """
+    def __init__(self, node_memory_mb, history=None):
+        self.node_memory_mb = node_memory_mb
+        self.history = history
+        self.reserved = Counter() # memory in MB expected to be in use per node
+        self.reservations = {} # (hosts, memory) per (op name, job name)
+        self.file_sizes = {} # size in MB of each MS file
+
+
+    def get_file_size(self, ms_file):
+        """
+        Returns the size of an MS file in MB
+
+        Parameters
+        ----------
+        ms_file : str
+            Filename of MS file
+
+        Returns
+        -------
+        size_mb : float
+            Total size of the files in the MS directory (not including
+            subtables)
+
+        """
+        if ms_file not in self.file_sizes:
+            size = 0
+            try:
+                for f in os.listdir(ms_file):
+                    path = os.path.join(ms_file, f)
+                    if os.path.isfile(path):
+                        size += os.path.getsize(path)
+            except OSError:
+                pass
+            self.file_sizes[ms_file] = size / 1024.0**2
+
+        return self.file_sizes[ms_file]
+
+
+    def estimate_peak_memory(self, op):
+        """
+        Returns the expected peak memory of an operation on each of its nodes
+
+        Parameters
+        ----------
+        op : Operation instance
+            The operation
+
+        Returns
+        -------
+        peak_memory_mb : float
+            Expected peak memory in MB
+
+        """
+        if self.history is not None:
+            peak_memory_mb = self.history.predict(op, 'peak_memory_mb')
+            if peak_memory_mb is not None:
+                return peak_memory_mb
+
+        # Visibility data: each process holds (at most) one file, and the
+        # number of processes per node is limited by the cpus of the node
+        cluster_parset = op.parset['cluster_specific']
+        nfiles = sum([len(band.files) for band in op.bands])
+        nproc = max(1, min(nfiles, cluster_parset['ncpu'] //
+            cluster_parset['ndir_per_node']))
+        file_size_mb = max([self.get_file_size(f) for band in op.bands
+            for f in band.files] + [0.0])
+        vis_mb = nproc * file_size_mb
+
+        # Images: WSClean keeps about 10 images (dirty, model, residual, psf,
+        # etc.) of 4-byte pixels for each of its output channels
+        if getattr(op.direction, 'facet_imsize', None) is not None:
+            imsize = op.direction.facet_imsize
+        else:
+            imsize = getattr(op.direction, 'cal_imsize', None)
+        if imsize is None:
+            imsize = 0
+        nchannels = getattr(op.direction, 'wsclean_nchannels', 1)
+        image_mb = 10 * nchannels * imsize**2 * 4 / 1024.0**2
+
+        return vis_mb + image_mb
+
+
+    def fits(self, op, hosts):
+        """
+        Checks whether an operation fits in the free memory of the given nodes
+
+        Parameters
+        ----------
+        op : Operation instance
+            The operation
+        hosts : list of str
+            Nodes on which the operation would run
+
+        Returns
+        -------
+        fits : bool
+            True if the operation fits on all the nodes (or the nodes are idle)
+
+        """
+        peak_memory_mb = self.estimate_peak_memory(op)
+        for h in hosts:
+            if (self.reserved[h] > 0 and self.reserved[h] + peak_memory_mb >
+                self.node_memory_mb):
+                return False
+
+        return True
+
+
+    def reserve(self, op):
+        """
+        Records the expected memory of an operation that is started
+
+        Parameters
+        ----------
+        op : Operation instance
+            The operation, with its nodes set
+
+        """
+        peak_memory_mb = self.estimate_peak_memory(op)
+        if peak_memory_mb > self.node_memory_mb:
+            log.warning('Operation {0} (direction: {1}) is expected to need more '
+                'memory ({2:.0f} MB) than is available per node ({3:.0f} MB)'.format(
+                op.name, op.direction.name, peak_memory_mb, self.node_memory_mb))
+        hosts = op.direction.hosts[:]
+        for h in hosts:
+            self.reserved[h] += peak_memory_mb
+        self.reservations[(op.name, op.job_name)] = (hosts, peak_memory_mb)
+
+
+    def release(self, op_name, job_name):
+        """
+        Frees the memory of an operation that has finished
+
+        Parameters
+        ----------
+        op_name : str
+            Name of the operation
+        job_name : str
+            Name of the pipeline job of the operation
+
+        """
+        if (op_name, job_name) not in self.reservations:
+            return
+        hosts, peak_memory_mb = self.reservations.pop((op_name, job_name))
+        for h in hosts:
+            self.reserved[h] = max(0.0, self.reserved[h] - peak_memory_mb)
+
+
+    def reset(self):
+        """
+        Frees the memory of all operations
+        """
+        self.reserved = Counter()
+        self.reservations = {}
 
 
 class Scheduler(object):
@@ -88,18 +655,64 @@ class Scheduler(object):
     dry_run : bool, optional
         If True, the pipelines are not run but all parsets and config files
         are made as normal
+    ndir_per_node : int, optional
+        Maximum number of operations to run at once on a single node when
+        operations are run with run_dag()
+    rebalance : bool, optional
+        If True, the cpus of a node are shared among the operations that are
+        running on it at any time, so that the cpus freed by an operation that
+        finishes early are lent to the others (and to newly started
+        operations) instead of staying idle
+    history : RuntimeHistory instance, optional
+        Store in which the resource usage of completed operations is recorded
+    longest_first : bool, optional
+        If True, operations are started in order of decreasing run time (as
+        predicted from the history) and the cpus are divided among them in
+        proportion to their predicted run times
+    admission : MemoryAdmission instance, optional
+        If given, operations are only started on nodes with enough free
+        memory for them
+    speculate : bool, optional
+        If True, a copy of an operation that runs much slower than expected is
+        started on free nodes when operations are run with run(), and the
+        first of the two runs to finish is kept (only for operations that
+        allow it)
+    straggler_factor : float, optional
+        Factor by which the projected run time of an operation must exceed its
+        expected run time for a copy of it to be started
 
     """
     def __init__(self, genericpipeline_executable, max_procs=1, name='scheduler',
-        dry_run=False):
+        dry_run=False, ndir_per_node=1, rebalance=False, history=None,
+        longest_first=False, admission=None, speculate=False,
+        straggler_factor=2.0):
         self.genericpipeline_executable = genericpipeline_executable
         self.max_procs = max_procs
         self.name = name
         self.dry_run = dry_run
+        self.ndir_per_node = ndir_per_node
+        self.rebalance = rebalance
+        self.history = history
+        self.longest_first = longest_first
+        self.admission = admission
+        self.speculate = speculate
+        self.straggler_factor = straggler_factor
         self.success = True
+        self.pool = None
+        self.completed_queue = Queue.Queue()
+        self.running_ops = {}
+        self.start_times = {}
+        self.job_hosts = {} # nodes of each running job
+        self.queued_ops = []
+        self.free_hosts = [] # sets of nodes that are free
+        self.copy_ops = {} # copies of slow operations (see check_stragglers())
+        self.cancelled = {} # stopped operations that still need cleaning up
+        self.batch_times = [] # run times of the completed ops of the current batch
+        self.batch_size = 0
+        self.simulator = None # MakespanSimulator used in dry runs
 
 
-    def allocate_resources(self, operation_list=None):
+    def allocate_resources(self, operation_list=None, save_state=True):
         """
         Divide up nodes and cpus among the operations to be run in parallel
 
@@ -108,18 +721,21 @@ class Scheduler(object):
         operation_list : list of Operation objects, optional
             Input list of operations over which to distribute the resources. If
             None, self.operation_list is used
+        save_state : bool, optional
+            If False, the resources are not saved to the state of the
+            directions (e.g., for dry runs)
 
         """
         if operation_list is None:
             operation_list = self.operation_list
 
-        node_list = self.operation_list[0].node_list
-        ncpu_max = self.operation_list[0].parset['cluster_specific']['ncpu']
-        nthread_io = self.operation_list[0].parset['cluster_specific']['nthread_io']
-        fmem_max = self.operation_list[0].parset['cluster_specific']['wsclean_fmem']
-        ndir_per_node = self.operation_list[0].parset['cluster_specific']['ndir_per_node']
-        nbands = len(self.operation_list[0].bands)
-        ntimes = len(self.operation_list[0].bands[0].files)
+        node_list = operation_list[0].node_list
+        ncpu_max = operation_list[0].parset['cluster_specific']['ncpu']
+        nthread_io = operation_list[0].parset['cluster_specific']['nthread_io']
+        fmem_max = operation_list[0].parset['cluster_specific']['wsclean_fmem']
+        ndir_per_node = operation_list[0].parset['cluster_specific']['ndir_per_node']
+        nbands = len(operation_list[0].bands)
+        ntimes = len(operation_list[0].bands[0].files)
         nfiles = ntimes * nbands
         nops_simul = self.max_procs
 
@@ -156,88 +772,483 @@ class Scheduler(object):
                     float(nops_per_node))))
 
             # Adjust resources to stay within limits for each node by adding or
-            # subtracting CPUs from the most appropriate operation(s). For now,
-            # we use the size of the facet image to determine the weights
-            resource_weights = [op.direction.facet_imsize if op.direction.facet_imsize is
-                not None else 0.0 for op in op_group]
+            # subtracting CPUs from the most appropriate operation(s). We use
+            # the predicted run time (or the size of the facet image if there is
+            # no prediction) to determine the weights
+            resource_weights = self.get_runtime_weights(op_group)
             j = 0
             while sum([op.direction.max_proc_per_node for op in op_group]) > ncpu_max * len(hosts):
                 op_take = op_group[resource_weights.index(sorted(resource_weights)[j])]
                 op_take.direction.max_proc_per_node -= 1
-                op_take.direction.save_state()
+                if save_state:
+                    op_take.direction.save_state()
                 if j < len(op_group)-1:
                     j += 1
                 else:
                     j = 0
 
             for op in op_group:
-                # Set maximum number of threads for normal and IO-intensive
-                # multithreaded processes (e.g., DPPP jobs) when run once,
-                # nfiles, and ntimes times per step (the most common cases)
-                op.direction.max_cpus_per_proc_single = op.direction.max_proc_per_node
-                op.direction.max_cpus_per_proc_ntimes = int(np.ceil(
-                    op.direction.max_proc_per_node /
-                    float(min(ntimes, op.direction.max_proc_per_node))))
-                op.direction.max_cpus_per_io_proc_ntimes = int(np.ceil(
-                    op.direction.max_proc_per_node /
-                    float(min(ntimes, op.direction.max_io_proc_per_node))))
-                op.direction.max_cpus_per_proc_nfiles = int(np.ceil(
-                    op.direction.max_proc_per_node /
-                    float(min(nfiles, op.direction.max_proc_per_node))))
-                op.direction.max_cpus_per_io_proc_nfiles = int(np.ceil(
-                    op.direction.max_proc_per_node /
-                    float(min(nfiles, op.direction.max_io_proc_per_node))))
-
-                # Maximum percentage of memory to give to jobs that allow memory
-                # limits (e.g., WSClean jobs)
-                op.direction.max_percent_memory_per_proc_single = (fmem_max /
-                    float(nops_per_node) * 100.0)
-                op.direction.max_percent_memory_per_proc_ntimes = (fmem_max /
-                    float(nops_per_node) * 100.0 /
-                    float(min(ntimes, op.direction.max_proc_per_node)))
-                op.direction.max_percent_memory_per_io_proc_ntimes = (fmem_max /
-                    float(nops_per_node) * 100.0 /
-                    float(min(ntimes, op.direction.max_io_proc_per_node)))
-                op.direction.max_percent_memory_per_proc_nfiles = (fmem_max /
-                    float(nops_per_node) * 100.0 /
-                    float(min(nfiles, op.direction.max_proc_per_node)))
-                op.direction.max_percent_memory_per_io_proc_nfiles = (fmem_max /
-                    float(nops_per_node) * 100.0 /
-                    float(min(nfiles, op.direction.max_io_proc_per_node)))
-
-                # Save the state
+                self.set_thread_and_memory_limits(op, nops_per_node, ntimes,
+                    nfiles, fmem_max, save_state)
+
+
+    def get_runtime_weights(self, operation_list):
+        """
+        Returns weights that indicate the relative run times of operations
+
+        Parameters
+        ----------
+        operation_list : list of Operation instances
+            Operations to weight
+
+        Returns
+        -------
+        weights : list of float
+            The predicted run times of the operations if longest-first ordering
+            is used and all of them can be predicted from the history.
+            Otherwise, the sizes of their facet images
+
+        """
+        if self.longest_first and self.history is not None:
+            predictions = [self.history.predict(op) for op in operation_list]
+            if None not in predictions:
+                return predictions
+
+        return [op.direction.facet_imsize if op.direction.facet_imsize is
+            not None else 0.0 for op in operation_list]
+
+
+    def sort_by_runtime(self, operation_list):
+        """
+        Sorts operations so that the longest ones are started first
+
+        Starting the longest operations first and giving each node the next
+        operation in line as soon as it is free keeps the total run time of a
+        batch of operations close to the minimum
+
+        Parameters
+        ----------
+        operation_list : list of Operation instances
+            Operations to sort
+
+        Returns
+        -------
+        operation_list : list of Operation instances
+            The sorted operations (unchanged if longest-first ordering is not
+            used)
+
+        """
+        if not self.longest_first:
+            return operation_list
+        weights = self.get_runtime_weights(operation_list)
+        order = sorted(range(len(operation_list)), key=lambda i: -weights[i])
+
+        return [operation_list[i] for i in order]
+
+
+    def record_usage(self, op, usage, hosts):
+        """
+        Records the resource usage of a completed operation in the history
+
+        Parameters
+        ----------
+        op : Operation instance
+            The completed operation
+        usage : dict
+            Usage returned by call_generic_pipeline()
+        hosts : list of str
+            Nodes on which the operation ran
+
+        """
+        import time
+
+        start_time = self.start_times.pop((op.name, op.job_name), None)
+        if self.history is None or start_time is None:
+            return
+
+        # The memory can only be measured for processes on this machine
+        if set(hosts) == set(['localhost']):
+            peak_memory_mb = usage.get('peak_memory_mb')
+        else:
+            peak_memory_mb = None
+        self.history.add(op, time.time() - start_time, usage.get('cpu_time'),
+            peak_memory_mb, usage.get('step_times'))
+
+
+    def set_thread_and_memory_limits(self, op, nops_per_node, ntimes, nfiles,
+        fmem_max, save_state=True):
+        """
+        Sets the per-process thread and memory limits of an operation
+
+        The limits are derived from the maximum number of processes per node
+        (op.direction.max_proc_per_node and op.direction.max_io_proc_per_node),
+        which must be set before calling this method
+
+        Parameters
+        ----------
+        op : Operation instance
+            Operation for which to set the limits
+        nops_per_node : int
+            Number of operations that share a node with this one
+        ntimes : int
+            Number of time chunks per band
+        nfiles : int
+            Total number of files
+        fmem_max : float
+            Maximum fraction of the memory per node for WSClean jobs
+        save_state : bool, optional
+            If False, the limits are not saved to the state of the direction
+
+        """
+        # Set maximum number of threads for normal and IO-intensive
+        # multithreaded processes (e.g., DPPP jobs) when run once,
+        # nfiles, and ntimes times per step (the most common cases)
+        op.direction.max_cpus_per_proc_single = op.direction.max_proc_per_node
+        op.direction.max_cpus_per_proc_ntimes = int(np.ceil(
+            op.direction.max_proc_per_node /
+            float(min(ntimes, op.direction.max_proc_per_node))))
+        op.direction.max_cpus_per_io_proc_ntimes = int(np.ceil(
+            op.direction.max_proc_per_node /
+            float(min(ntimes, op.direction.max_io_proc_per_node))))
+        op.direction.max_cpus_per_proc_nfiles = int(np.ceil(
+            op.direction.max_proc_per_node /
+            float(min(nfiles, op.direction.max_proc_per_node))))
+        op.direction.max_cpus_per_io_proc_nfiles = int(np.ceil(
+            op.direction.max_proc_per_node /
+            float(min(nfiles, op.direction.max_io_proc_per_node))))
+
+        # Maximum percentage of memory to give to jobs that allow memory
+        # limits (e.g., WSClean jobs)
+        op.direction.max_percent_memory_per_proc_single = (fmem_max /
+            float(nops_per_node) * 100.0)
+        op.direction.max_percent_memory_per_proc_ntimes = (fmem_max /
+            float(nops_per_node) * 100.0 /
+            float(min(ntimes, op.direction.max_proc_per_node)))
+        op.direction.max_percent_memory_per_io_proc_ntimes = (fmem_max /
+            float(nops_per_node) * 100.0 /
+            float(min(ntimes, op.direction.max_io_proc_per_node)))
+        op.direction.max_percent_memory_per_proc_nfiles = (fmem_max /
+            float(nops_per_node) * 100.0 /
+            float(min(nfiles, op.direction.max_proc_per_node)))
+        op.direction.max_percent_memory_per_io_proc_nfiles = (fmem_max /
+            float(nops_per_node) * 100.0 /
+            float(min(nfiles, op.direction.max_io_proc_per_node)))
+
+        # Save the state
+        if save_state:
+            op.direction.save_state()
+
+
+    def allocate_node_resources(self, op, hosts, nops_per_node):
+        """
+        Gives an operation the given nodes and its share of their cpus and memory
+
+        Used by run_dag(), where operations are started one at a time as their
+        dependencies complete instead of in groups
+
+        Parameters
+        ----------
+        op : Operation instance
+            Operation to which to allocate the resources
+        hosts : list of str
+            Nodes on which the operation is to be run
+        nops_per_node : int
+            Number of operations that share each node
+
+        """
+        ncpu_max = op.parset['cluster_specific']['ncpu']
+        nthread_io = op.parset['cluster_specific']['nthread_io']
+        fmem_max = op.parset['cluster_specific']['wsclean_fmem']
+        nbands = len(op.bands)
+        ntimes = len(op.bands[0].files)
+        nfiles = ntimes * nbands
+
+        op.direction.hosts = hosts
+        op.direction.max_proc_per_node = max(1, int(np.ceil(ncpu_max /
+            float(nops_per_node))))
+        op.direction.max_io_proc_per_node = max(1, int(np.ceil(nthread_io /
+            float(nops_per_node))))
+        self.set_thread_and_memory_limits(op, nops_per_node, ntimes, nfiles,
+            fmem_max)
+
+
+    def get_pool(self):
+        """
+        Returns the pool of worker processes, starting it if needed
+
+        The pool is kept for the whole run, so that its workers (which load
+        the generic pipeline only once) are reused by all operations
+
+        Returns
+        -------
+        pool : multiprocessing.Pool instance
+            The pool
+
+        """
+        if self.pool is None:
+            # change signal-handler so that Keyboard-Interrupts go to the master thread
+            original_sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
+            self.pool = multiprocessing.Pool(processes=self.max_procs,
+                initializer=init_worker, initargs=(self.genericpipeline_executable,))
+            signal.signal(signal.SIGINT, original_sigint_handler)
+
+        return self.pool
+
+
+    def terminate(self):
+        """
+        Stops all running pipelines
+        """
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self.completed_queue = Queue.Queue()
+        self.running_ops = {}
+        self.job_hosts = {}
+        self.copy_ops = {}
+        for op, job in self.cancelled.values():
+            op.cleanup()
+        self.cancelled = {}
+        if self.admission is not None:
+            self.admission.reset()
+
+
+    def close(self):
+        """
+        Shuts down the pool of worker processes once all jobs are done
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+    def start_op(self, op, running):
+        """
+        Sets up an operation and sends its pipeline to the pool
+
+        Parameters
+        ----------
+        op : Operation instance
+            Operation to start
+        running : dict
+            Dict of running jobs, keyed by (operation name, job name), to
+            which the job is added
+
+        """
+        import time
+
+        op.setup()
+        op.set_started()
+        if self.rebalance:
+            resource_file = self.write_resource_file(op)
+        else:
+            resource_file = None
+        key = (op.name, op.job_name)
+        self.running_ops[key] = op
+        self.job_hosts[key] = op.direction.hosts[:]
+        if self.admission is not None:
+            self.admission.reserve(op)
+        self.start_times[key] = time.time()
+        running[key] = self.get_pool().apply_async(
+            call_generic_pipeline, (op.name, op.direction.name,
+            op.pipeline_parset_file, op.pipeline_config_file, op.logbasename,
+            self.genericpipeline_executable, resource_file, op.job_name),
+            callback=self.completed_queue.put)
+
+
+    def write_resource_file(self, op):
+        """
+        Writes the current process limits of an operation for its pipeline
+
+        Parameters
+        ----------
+        op : Operation instance
+            Operation for which to write the limits
+
+        Returns
+        -------
+        resource_file : str
+            Name of the file
+
+        """
+        import pickle
+
+        resource_file = os.path.join(op.pipeline_parset_dir, 'resources')
+        resources = {'max_proc_per_node': op.direction.max_proc_per_node,
+                     'max_io_proc_per_node': op.direction.max_io_proc_per_node}
+        with open(resource_file+'.tmp', 'wb') as f:
+            pickle.dump(resources, f)
+        os.rename(resource_file+'.tmp', resource_file)
+
+        return resource_file
+
+
+    def rebalance_resources(self):
+        """
+        Shares the cpus of each node among the operations running on it
+
+        The cpus freed by an operation that has finished are lent to the
+        operations that are still running on its nodes (and are taken back when
+        a new operation is started there). Running pipelines pick up their new
+        limits at the start of their next step. Note that the number of threads
+        and the memory given to each process are set when the pipeline parset
+        is made and so can only change for newly started operations
+        """
+        if not self.rebalance or self.dry_run:
+            return
+
+        node_nops = Counter()
+        for op in self.running_ops.values():
+            node_nops.update(op.direction.hosts)
+
+        for op in self.running_ops.values():
+            nops_per_node = max([node_nops[h] for h in op.direction.hosts])
+            max_proc_per_node = max(1, int(np.ceil(
+                op.parset['cluster_specific']['ncpu'] / float(nops_per_node))))
+            max_io_proc_per_node = max(1, int(np.ceil(
+                op.parset['cluster_specific']['nthread_io'] / float(nops_per_node))))
+            if (max_proc_per_node != op.direction.max_proc_per_node or
+                max_io_proc_per_node != op.direction.max_io_proc_per_node):
+                log.debug('Changing resources of operation {0} (direction: {1}) '
+                    'to {2} process(es) per node'.format(op.name, op.direction.name,
+                    max_proc_per_node))
+                op.direction.max_proc_per_node = max_proc_per_node
+                op.direction.max_io_proc_per_node = max_io_proc_per_node
                 op.direction.save_state()
+                self.write_resource_file(op)
+
+
+    def get_nops_per_node(self, hosts):
+        """
+        Returns the number of operations that will share the given nodes if
+        one more operation is started on them
+
+        Parameters
+        ----------
+        hosts : list of str
+            Nodes
+
+        Returns
+        -------
+        nops_per_node : int
+            Number of operations per node (at most self.ndir_per_node)
+
+        """
+        node_nops = Counter()
+        for op in self.running_ops.values():
+            node_nops.update(op.direction.hosts)
+
+        return min(self.ndir_per_node, max([node_nops[h] for h in hosts]) + 1)
+
+
+    def wait_for_result(self, running):
+        """
+        Waits until one of the running jobs has finished
+
+        Parameters
+        ----------
+        running : dict
+            Dict of running jobs, keyed by (operation name, job name). The
+            finished job is removed from it
+
+        Returns
+        -------
+        result : tuple
+            The (op_name, job_name, status, usage) of the finished job. A job
+            that died without returning a result is given a nonzero status
+
+        """
+        while True:
+            # We need to wait with a timeout, because otherwise all signals are blocked
+            # *bleeep*ing python multi-threading/processing
+            try:
+                op_name, job_name, status, usage = self.completed_queue.get(True, 30)
+                if (op_name, job_name) in running:
+                    break
+            except Queue.Empty:
+                # Check for jobs that died without returning a result
+                failed = [k for k, r in running.items() if r.ready() and not
+                    r.successful()]
+                if len(failed) > 0:
+                    op_name, job_name = failed[0]
+                    status = 1
+                    usage = {}
+                    break
+                if self.speculate:
+                    self.check_stragglers()
+            self.reap_cancelled()
+        running.pop((op_name, job_name))
+        self.running_ops.pop((op_name, job_name), None)
+        if self.admission is not None:
+            self.admission.release(op_name, job_name)
+
+        return (op_name, job_name, status, usage)
 
 
     def result_callback(self, result):
         """
-        Callback function for apply_async result
+        Handles the result of a finished job
         """
-        op_name, direction_name, status = result
+        import time
 
-        # Identify the current operation from the direction name
-        try:
-            this_op_indx = [op.direction.name for op in self.operation_list].index(direction_name)
-            this_op =  self.operation_list[this_op_indx]
-        except ValueError:
-            log.warn('Operation {0} (direction: {1}) not in list of active '
-                'operations. This could indicate a problem with the operation'.
-                format(op_name, direction_name))
-            return
+        op_name, job_name, status, usage = result
 
-        # Reallocate resources
-        if len(self.queued_ops) > 0:
-            # Give the completed op's resources to the next one in line (if any)
-            next_op = self.queued_ops.pop(0)
-            next_op.direction.hosts = this_op.direction.hosts[:]
-            next_op.setup()
+        # Identify the current operation from the job name
+        if (op_name, job_name) in self.copy_ops:
+            this_op = self.copy_ops.pop((op_name, job_name))
+            original_op = this_op.original
+        else:
+            try:
+                this_op_indx = [op.job_name for op in self.operation_list].index(job_name)
+                this_op = self.operation_list[this_op_indx]
+            except ValueError:
+                log.warn('Operation {0} (direction: {1}) not in list of active '
+                    'operations. This could indicate a problem with the operation'.
+                    format(op_name, job_name))
+                return
+            original_op = this_op
+        direction_name = original_op.direction.name
+        hosts = self.job_hosts.pop((op_name, job_name))
+
+        # If the operation was run twice (see check_stragglers()), keep the run
+        # that finishes first and stop the other one. If the first one failed,
+        # wait for the other one instead
+        other_op = self.get_other_run(this_op)
+        if other_op is not None:
+            if status == 0:
+                log.info('Stopping the slower run of operation {0} (direction: '
+                    '{1})'.format(op_name, direction_name))
+                self.cancel_op(other_op)
+            else:
+                log.warning('One of the two runs of operation {0} (direction: '
+                    '{1}) failed. Waiting for the other one'.format(op_name,
+                    direction_name))
+                self.start_times.pop((op_name, job_name), None)
+                self.cancelled[(op_name, job_name)] = (this_op, None)
+                self.free_hosts.append(hosts)
+                self.start_queued_ops()
+                self.rebalance_resources()
+                return
+
+        # Reallocate resources: give the completed op's resources to the next
+        # one in line (if any) and start it
+        self.free_hosts.append(hosts)
+        self.start_queued_ops()
+        self.rebalance_resources()
 
         # Finalize the operation
         if status == 0:
             log.info('--> Operation {0} completed (direction: '
                 '{1})'.format(op_name, direction_name))
+            self.batch_times.append(time.time() - self.start_times[(op_name, job_name)])
+            self.record_usage(this_op, usage, hosts)
+            if this_op is not original_op:
+                # Use the outputs of the copy for the direction
+                this_op.direction = original_op.direction
             this_op.finalize()
-            this_op.set_completed()
+            original_op.set_completed()
         else:
             self.success = False
             if this_op.can_restart():
@@ -246,8 +1257,225 @@ class Scheduler(object):
             else:
                 log.error('Operation {0} failed due to an error (direction: '
                     '{1})'.format(op_name, direction_name))
-                import thread
-                thread.interrupt_main()
+                self.terminate()
+                self.running = {}
+                self.queued_ops = []
+
+
+    def get_other_run(self, op):
+        """
+        Returns the other run of an operation that is run twice
+
+        Parameters
+        ----------
+        op : Operation instance
+            The operation or its copy
+
+        Returns
+        -------
+        other_op : Operation instance or None
+            The copy (if op is the original) or the original (if op is the
+            copy), if it is still running. None otherwise
+
+        """
+        if op.original is not None:
+            other_op = op.original
+        else:
+            copies = [c for c in self.copy_ops.values() if c.original is op]
+            if len(copies) == 0:
+                return None
+            other_op = copies[0]
+        if (other_op.name, other_op.job_name) not in self.running:
+            return None
+
+        return other_op
+
+
+    def cancel_op(self, op):
+        """
+        Stops a running operation and frees its resources
+
+        Its pipeline is stopped with kill_pipeline(), and its temporary files
+        are removed once the pipeline has ended (see reap_cancelled())
+
+        Parameters
+        ----------
+        op : Operation instance
+            Operation to stop
+
+        """
+        key = (op.name, op.job_name)
+        job = self.running.pop(key)
+        self.running_ops.pop(key, None)
+        self.start_times.pop(key, None)
+        self.copy_ops.pop(key, None)
+        self.free_hosts.append(self.job_hosts.pop(key))
+        if self.admission is not None:
+            self.admission.release(op.name, op.job_name)
+        self.cancelled[key] = (op, job)
+        kill_pipeline(op.pipeline_parset_dir)
+
+
+    def reap_cancelled(self):
+        """
+        Cleans up after stopped (or superseded) operations whose pipelines have
+        ended
+        """
+        for key, (op, job) in self.cancelled.items():
+            if job is not None and not job.ready():
+                # Stop any steps that were started since the last try
+                kill_pipeline(op.pipeline_parset_dir)
+                continue
+            self.cancelled.pop(key)
+            op.cleanup()
+            if op.original is not None:
+                shutil.rmtree(op.pipeline_parset_dir, ignore_errors=True)
+
+
+    def wait_for_cancelled(self):
+        """
+        Waits until the pipelines of all stopped operations have ended
+        """
+        import time
+
+        while len(self.cancelled) > 0:
+            self.reap_cancelled()
+            if len(self.cancelled) > 0:
+                time.sleep(5)
+
+
+    def get_expected_runtime(self, op):
+        """
+        Returns the expected run time of an operation
+
+        Parameters
+        ----------
+        op : Operation instance
+            The operation
+
+        Returns
+        -------
+        runtime : float or None
+            The run time predicted by the history if available. Otherwise,
+            the median run time of the operations of the current batch that
+            have completed (if at least half of them have). None if neither is
+            available
+
+        """
+        if self.history is not None:
+            runtime = self.history.predict(op)
+            if runtime is not None:
+                return runtime
+        if len(self.batch_times) > 0 and len(self.batch_times) >= self.batch_size / 2.0:
+            return float(np.median(self.batch_times))
+
+        return None
+
+
+    def get_projected_runtime(self, op, elapsed):
+        """
+        Returns the projected total run time of a running operation
+
+        The projection uses the progress of the operation through its pipeline
+        steps (from its statefile) and the step times predicted by the history
+
+        Parameters
+        ----------
+        op : Operation instance
+            The operation
+        elapsed : float
+            Time in seconds since the operation was started
+
+        Returns
+        -------
+        runtime : float
+            Projected run time in seconds (the elapsed time if there is no
+            prediction of the step times)
+
+        """
+        step_times = []
+        if self.history is not None:
+            step_times = [t for name, t in self.history.predict_step_times(op)]
+        try:
+            nsteps = len(op.get_steptypes())
+        except Exception:
+            # Statefile is being written
+            nsteps = 0
+        time_done = sum(step_times[:nsteps])
+        if nsteps == 0 or time_done <= 0.0:
+            return elapsed
+
+        return max(elapsed, elapsed * sum(step_times) / time_done)
+
+
+    def check_stragglers(self):
+        """
+        Starts copies of operations that are running much slower than expected
+
+        An operation is a straggler if its projected run time is more than
+        self.straggler_factor times its expected run time. If no operations are
+        waiting to be started and a set of nodes that does not overlap with
+        those of the straggler is free, a copy of it (see
+        Operation.make_copy()) is started there. The first run to finish
+        successfully is kept (see result_callback())
+        """
+        import time
+
+        if len(self.queued_ops) > 0 or len(self.free_hosts) == 0:
+            return
+
+        for key, op in self.running_ops.items():
+            if (not op.allow_speculation or op.original is not None or
+                self.get_other_run(op) is not None):
+                continue
+            expected = self.get_expected_runtime(op)
+            if expected is None:
+                continue
+            elapsed = time.time() - self.start_times[key]
+            if self.get_projected_runtime(op, elapsed) < self.straggler_factor * expected:
+                continue
+            free_hosts = [h for h in self.free_hosts if len(set(h) &
+                set(self.job_hosts[key])) == 0]
+            if len(free_hosts) == 0:
+                continue
+
+            log.info('Operation {0} (direction: {1}) is running slowly. Starting '
+                'a copy of it on {2}'.format(op.name, op.direction.name,
+                ', '.join(free_hosts[0])))
+            self.free_hosts.remove(free_hosts[0])
+            copy_op = op.make_copy('{0}_speculative'.format(op.job_name))
+            copy_op.direction.hosts = free_hosts[0][:]
+            self.copy_ops[(copy_op.name, copy_op.job_name)] = copy_op
+            self.start_op(copy_op, self.running)
+            if len(self.free_hosts) == 0:
+                break
+
+
+    def start_queued_ops(self):
+        """
+        Starts queued operations on the nodes freed by finished operations
+
+        Each set of free nodes is given to the first queued operation that fits
+        in their memory (if admission control is used), so smaller operations
+        can start while a large one waits for memory to become free
+        """
+        for hosts in self.free_hosts[:]:
+            for i, next_op in enumerate(self.queued_ops):
+                if self.admission is None or self.admission.fits(next_op, hosts):
+                    self.queued_ops.pop(i)
+                    self.free_hosts.remove(hosts)
+                    next_op.direction.hosts = hosts[:]
+                    if self.rebalance:
+                        # Give it the share of the nodes that is free now
+                        # instead of the one set up front by allocate_resources()
+                        self.allocate_node_resources(next_op, hosts,
+                            self.get_nops_per_node(hosts))
+                    self.start_op(next_op, self.running)
+                    break
+                elif i == 0:
+                    log.debug('Not enough free memory on {0} to start operation '
+                        '{1} (direction: {2})'.format(', '.join(hosts),
+                        next_op.name, next_op.direction.name))
 
 
     def run(self, operation_list):
@@ -266,6 +1494,22 @@ class Scheduler(object):
         # Finalize completed ops (so that various attributes are set correctly).
         # The incomplete ops are finalized when complete in self.result_callback()
         if self.dry_run:
+            if self.simulator is not None:
+                # Record the ops that would be run, with their resources. The
+                # resources are allocated to copies of the ops (with their own
+                # directions and node list), so that the ops and their saved
+                # state are left unchanged
+                sim_ops = []
+                sim_node_list = operation_list[0].node_list[:]
+                for op in self.sort_by_runtime([op for op in operation_list
+                    if not op.check_completed()]):
+                    sim_op = copy.copy(op)
+                    sim_op.direction = copy.copy(op.direction)
+                    sim_op.node_list = sim_node_list
+                    sim_ops.append(sim_op)
+                if len(sim_ops) > 0:
+                    self.allocate_resources(sim_ops, save_state=False)
+                    self.simulator.add_batch(sim_ops)
             completed_ops = operation_list
         else:
             completed_ops = [op for op in operation_list if op.check_completed()]
@@ -279,39 +1523,37 @@ class Scheduler(object):
 
         # Filter out completed ops
         self.operation_list = [op for op in operation_list if not op.check_completed()]
+        self.operation_list = self.sort_by_runtime(self.operation_list)
 
         # Run the operation(s)
         n_tries = 0
         while len(self.operation_list) > 0:
             self.allocate_resources()
             with Timer(log, 'operation'):
-                # change signal-handler so that Keyboard-Interrupts go to the master thread
-                original_sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN)
-                pool = multiprocessing.Pool(processes=self.max_procs)
-                signal.signal(signal.SIGINT, original_sigint_handler)
+                # Start as many ops as can be run at once. The others are started
+                # as soon as an op finishes and its resources are free
                 self.queued_ops = self.operation_list[self.max_procs:]
-                process_list = []
-                for op in self.operation_list:
-                    op.setup()
-                    op.set_started()
-                    process_list.append(
-                        pool.apply_async(call_generic_pipeline, (op.name,
-                            op.direction.name, op.pipeline_parset_file,
-                            op.pipeline_config_file, op.logbasename,
-                            self.genericpipeline_executable),
-                            callback=self.result_callback)
-                        )
-                pool.close() #no more new processes will be started
+                self.running = {}
+                self.free_hosts = []
+                self.batch_times = []
+                self.batch_size = len(self.operation_list)
+                for i, op in enumerate(self.operation_list[:self.max_procs]):
+                    if self.admission is None or self.admission.fits(op, op.direction.hosts):
+                        self.start_op(op, self.running)
+                    else:
+                        # Wait until enough memory is free
+                        self.queued_ops.insert(len(self.free_hosts), op)
+                        self.free_hosts.append(op.direction.hosts[:])
+                self.start_queued_ops()
                 try:
-                    # We need to wait with a timeout, because otherwise all signals are blocked
-                    # *bleeep*ing python multi-threading/processing
-                    for process in process_list:
-                        while not process.ready():
-                            process.wait(30)
+                    while len(self.running) > 0:
+                        self.result_callback(self.wait_for_result(self.running))
+                    self.wait_for_cancelled()
+                    self.free_hosts = []
                 except KeyboardInterrupt:
                     log.error("Caught an (Keyboard-)Interrupt, stopping all pipelines.")
-                    pool.terminate()
-                pool.join()
+                    self.terminate()
+                    sys.exit(1)
 
             # Check for and handle any failed ops
             if not self.success:
@@ -343,5 +1585,198 @@ class Scheduler(object):
                 self.operation_list = []
 
 
+    def _select_hosts(self, op, node_list, node_load, nready):
+        """
+        Selects the nodes for an operation to be started by run_dag()
+
+        Parameters
+        ----------
+        op : Operation instance
+            Operation to be started
+        node_list : list of str
+            All available nodes
+        node_load : Counter instance
+            Number of running operations per node
+        nready : int
+            Number of operations (including this one) that are ready to start
+
+        Returns
+        -------
+        hosts : list of str
+            Nodes to use (empty if no node has a free slot with enough memory)
+        nops_per_node : int
+            Number of operations that will share each of these nodes
+        nslots : int
+            Number of slots the operation takes on each of these nodes
+
+        """
+        free_nodes = [n for n in node_list if node_load[n] == 0]
+        if len(free_nodes) >= nready:
+            # Enough empty nodes: give the operation its share of them
+            nnodes = len(free_nodes) // nready
+            return free_nodes[:nnodes], 1, self.ndir_per_node
+
+        # Otherwise, use one slot on the least-loaded node
+        open_nodes = [n for n in node_list if node_load[n] < self.ndir_per_node]
+        if self.admission is not None:
+            open_nodes = [n for n in open_nodes if self.admission.fits(op, [n])]
+        if len(open_nodes) == 0:
+            return [], 0, 0
+        host = sorted(open_nodes, key=lambda n: node_load[n])[0]
+        if self.rebalance:
+            # Share the node only with the operations that are running on it
+            return [host], self.get_nops_per_node([host]), 1
+        return [host], self.ndir_per_node, 1
+
+
+    def run_dag(self, node_list):
+        """
+        Runs a graph of operations, starting each one as soon as its
+        dependencies have completed
+
+        Unlike run(), which treats each list of operations as a barrier, this
+        method lets independent operations (e.g., facetimage operations for
+        different image settings) run at the same time, sharing the nodes
+        through the scheduler's pool of self.max_procs processes
+
+        Parameters
+        ----------
+        node_list : list of OperationNode instances
+            Nodes to process. The order of the list defines the order in which
+            conflicting operations are run
+
+        Returns
+        -------
+        success : bool
+            False if processing was halted by the on_completion function of a
+            node
+
+        """
+        # Derive the dependencies from the order of the nodes and their
+        # resource usage
+        for j, node in enumerate(node_list):
+            for prev in node_list[:j]:
+                if node.conflicts_with(prev) and prev not in node.depends_on:
+                    node.depends_on.append(prev)
+
+        pending = node_list[:]
+        running = {}
+        running_nodes = {}
+        simulated_ops = {}
+        node_load = Counter()
+        n_tries = Counter()
+        halt = False
+
+        def finish_node(node):
+            node.state = 'done'
+            if node.on_completion is not None:
+                if node.on_completion(node.op) is False:
+                    return True
+            return False
+
+        with Timer(log, 'operation graph'):
+            try:
+                while len(pending) > 0 or len(running) > 0:
+                    # Start (or skip) all nodes that are ready, as long as there
+                    # are free slots
+                    started = True
+                    while started and not halt:
+                        started = False
+                        ready = [n for n in pending if n.is_ready()]
+                        if self.longest_first:
+                            # Set up the ops that can run, so that the longest
+                            # can be started first
+                            for node in ready:
+                                if (node.make_op is not None and node.op is None and
+                                    (node.condition is None or node.condition())):
+                                    node.op = node.make_op()
+                            ops = [n.op for n in ready if n.op is not None]
+                            ops = self.sort_by_runtime(ops)
+                            ready.sort(key=lambda n: ops.index(n.op) if n.op in
+                                ops else -1)
+                        for node in ready:
+                            if node.condition is not None and not node.condition():
+                                log.debug('Skipping {0}'.format(node.name))
+                                pending.remove(node)
+                                node.state = 'skipped'
+                                started = True
+                                break
+                            if node.make_op is not None and node.op is None:
+                                node.op = node.make_op()
+                            op = node.op
+                            if op is None or self.dry_run or op.check_completed():
+                                if (self.dry_run and self.simulator is not None and
+                                    op is not None and not op.check_completed()):
+                                    # Record the op that would be run
+                                    simulated_ops[node] = op
+                                # Nothing to run: finalize completed ops (so that
+                                # various attributes are set correctly)
+                                pending.remove(node)
+                                if op is not None:
+                                    op.finalize()
+                                    op.set_completed()
+                                halt = finish_node(node)
+                                started = True
+                                break
+                            if len(running) >= self.max_procs:
+                                continue
+                            hosts, nops_per_node, nslots = self._select_hosts(
+                                op, op.node_list, node_load, len(ready))
+                            if len(hosts) == 0:
+                                continue
+                            self.allocate_node_resources(op, hosts, nops_per_node)
+                            node.slots = dict([(h, nslots) for h in hosts])
+                            node_load.update(node.slots)
+                            pending.remove(node)
+                            node.state = 'running'
+                            self.start_op(op, running)
+                            running_nodes[(op.name, op.job_name)] = node
+                            self.rebalance_resources()
+                            started = True
+                            break
+
+                    if len(running) == 0:
+                        if halt or len([n for n in pending if n.is_ready()]) == 0:
+                            break
+                        continue
+
+                    # Wait for an operation to finish
+                    op_name, job_name, status, usage = self.wait_for_result(running)
+                    node = running_nodes.pop((op_name, job_name))
+                    op = node.op
+                    direction_name = op.direction.name
+                    hosts = self.job_hosts.pop((op_name, job_name))
+                    node_load.subtract(node.slots)
+                    self.rebalance_resources()
+
+                    if status == 0:
+                        log.info('--> Operation {0} completed (direction: '
+                            '{1})'.format(op_name, direction_name))
+                        self.record_usage(op, usage, hosts)
+                        op.finalize()
+                        op.set_completed()
+                        if finish_node(node):
+                            halt = True
+                    else:
+                        op.cleanup()
+                        n_tries[node] += 1
+                        if op.can_restart() and n_tries[node] <= 3:
+                            log.warning('Operation {0} failed due to error (direction: '
+                                '{1}) but will be automatically resumed'.format(op_name,
+                                direction_name))
+                            node.state = 'pending'
+                            pending.insert(0, node)
+                        else:
+                            log.error('Operation {0} failed due to an error (direction: '
+                                '{1}). Exiting...'.format(op_name, direction_name))
+                            self.terminate()
+                            sys.exit(1)
+            except KeyboardInterrupt:
+                log.error("Caught an (Keyboard-)Interrupt, stopping all pipelines.")
+                self.terminate()
+                sys.exit(1)
 
+        if self.dry_run and self.simulator is not None:
+            self.simulator.add_graph(node_list, simulated_ops)
 
+        return not halt
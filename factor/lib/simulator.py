@@ -0,0 +1,349 @@
+"""
+Module defining the makespan simulator and cost model classes
+"""
+import logging
+import datetime
+import heapq
+import numpy as np
+from collections import Counter
+
+log = logging.getLogger('factor:simulator')
+
+
+class CostModel(object):
+    """
+    The CostModel object predicts the run time of an operation
+
+    If the runtime history has a record of a similar operation, its (scaled)
+    run time is used. Otherwise, the run time is estimated from the amount of
+    visibility data each process has to work through and the size of the
+    images made, using the default costs of the type of operation
+
+    Parameters
+    ----------
+    history : RuntimeHistory instance, optional
+        Store of the measured run times of previous operations
+    costs : dict, optional
+        Costs per type of operation, as a tuple of (constant time in s, time
+        in s per hour of data in a file, time in s per million image pixels per
+        channel). Costs not given are taken from self.default_costs
+
+    """
+    default_costs = {'outlierpeel': (300.0, 600.0, 300.0),
+                     'facetpeel': (300.0, 600.0, 300.0),
+                     'facetselfcal': (600.0, 900.0, 600.0),
+                     'facetsub': (120.0, 300.0, 0.0),
+                     'facetsubreset': (120.0, 300.0, 0.0),
+                     'facetimage': (300.0, 300.0, 600.0),
+                     'fieldmosaic': (600.0, 0.0, 0.0)}
+
+    def __init__(self, history=None, costs=None):
+        self.history = history
+        self.costs = self.default_costs.copy()
+        if costs is not None:
+            self.costs.update(costs)
+
+
+    def predict(self, op, nproc):
+        """
+        Predicts the run time of an operation
+
+        Parameters
+        ----------
+        op : Operation instance
+            The operation
+        nproc : int
+            Number of processes the operation may run at once
+
+        Returns
+        -------
+        runtime : float
+            Run time in seconds
+        from_history : bool
+            True if the run time was predicted from the history
+
+        """
+        if self.history is not None:
+            runtime = self.history.predict(op)
+            if runtime is not None:
+                return runtime, True
+
+        op_type = op.name.split('_')[0]
+        const, file_cost, pixel_cost = self.costs.get(op_type, (0.0, 0.0, 0.0))
+        nfiles = sum([len(band.files) for band in op.bands])
+        chunk_hours = op.parset['chunk_size_sec'] / 3600.0
+        if getattr(op.direction, 'facet_imsize', None) is not None:
+            imsize = op.direction.facet_imsize
+        else:
+            imsize = getattr(op.direction, 'cal_imsize', None)
+        if imsize is None:
+            imsize = 0
+        nchannels = getattr(op.direction, 'wsclean_nchannels', 1)
+
+        runtime = (const + file_cost * chunk_hours * np.ceil(nfiles / float(max(1, nproc))) +
+            pixel_cost * nchannels * imsize**2 / 1e6)
+
+        return runtime, False
+
+
+class MakespanSimulator(object):
+    """
+    The MakespanSimulator object predicts the total run time of a dry run
+
+    The operations that the scheduler would run are recorded during a dry run
+    (in the order in which they would be run). The scheduler is then simulated
+    with the run times predicted by a cost model, giving the expected total
+    run time (makespan), the use of the cpus of each node and the critical
+    path (the chain of operations that determines the makespan)
+
+    Parameters
+    ----------
+    scheduler : Scheduler instance
+        Scheduler whose operations are simulated
+    cost_model : CostModel instance
+        Model used to predict the run times of the operations
+
+    """
+    def __init__(self, scheduler, cost_model):
+        self.scheduler = scheduler
+        self.cost_model = cost_model
+        self.stages = []
+
+
+    def add_batch(self, operation_list):
+        """
+        Records a list of operations run by Scheduler.run()
+
+        Parameters
+        ----------
+        operation_list : list of Operation instances
+            Operations, with their resources allocated by
+            Scheduler.allocate_resources()
+
+        """
+        jobs = []
+        for op in operation_list:
+            jobs.append({'op': op, 'hosts': op.direction.hosts[:],
+                'nproc': op.direction.max_proc_per_node})
+        self.stages.append(('batch', jobs))
+
+
+    def add_graph(self, node_list, ops):
+        """
+        Records a graph of operations run by Scheduler.run_dag()
+
+        Parameters
+        ----------
+        node_list : list of OperationNode instances
+            Nodes of the graph, with their dependencies set
+        ops : dict
+            Operation to run for each node (None for nodes that have nothing
+            to run)
+
+        """
+        self.stages.append(('graph', [(node, ops.get(node)) for node in node_list]))
+
+
+    def get_runtime(self, op, hosts, nproc):
+        """
+        Returns the predicted run time of an operation
+
+        Parameters
+        ----------
+        op : Operation instance
+            The operation
+        hosts : list of str
+            Nodes on which the operation runs
+        nproc : int
+            Number of processes per node
+
+        Returns
+        -------
+        runtime : float
+            Run time in seconds
+
+        """
+        runtime, from_history = self.cost_model.predict(op, nproc * len(set(hosts)))
+        if from_history:
+            self.nfrom_history += 1
+        else:
+            self.nfrom_model += 1
+
+        return runtime
+
+
+    def simulate(self):
+        """
+        Simulates the scheduler
+
+        Returns
+        -------
+        result : dict
+            The makespan in seconds (under 'makespan'), the fraction of the cpus
+            of each node that is used (under 'utilisation') and the critical
+            path as a list of (op name, direction name, start, end) tuples
+            (under 'critical_path')
+
+        """
+        self.jobs = []
+        self.nfrom_history = 0
+        self.nfrom_model = 0
+        now = 0.0
+        last_job = None
+        for stage_type, stage in self.stages:
+            if stage_type == 'batch':
+                now, last_job = self._simulate_batch(stage, now, last_job)
+            else:
+                now, last_job = self._simulate_graph(stage, now, last_job)
+
+        # Find the fraction of the cpus of each node that is used
+        if len(self.jobs) > 0:
+            ncpu = self.jobs[0]['op'].parset['cluster_specific']['ncpu']
+        busy = Counter()
+        for job in self.jobs:
+            for h in set(job['hosts']):
+                busy[h] += (job['end'] - job['start']) * min(job['nproc'], ncpu) / float(ncpu)
+        if now > 0.0:
+            utilisation = dict([(h, busy[h] / now) for h in busy])
+        else:
+            utilisation = {}
+
+        # Follow the chain of jobs that determined the start of each job back
+        # from the last one to finish
+        critical_path = []
+        job = last_job
+        while job is not None:
+            critical_path.insert(0, (job['op'].name, job['op'].direction.name,
+                job['start'], job['end']))
+            job = job['pred']
+
+        return {'makespan': now, 'utilisation': utilisation,
+                'critical_path': critical_path}
+
+
+    def _simulate_batch(self, jobs, now, last_job):
+        """
+        Simulates Scheduler.run() for a list of operations
+
+        The first max_procs operations are started at once, and each of the
+        others is started on the nodes of the first operation to finish
+        """
+        max_procs = self.scheduler.max_procs
+        finished = []
+        for i, job in enumerate(jobs):
+            job = job.copy()
+            job['runtime'] = self.get_runtime(job['op'], job['hosts'], job['nproc'])
+            if i < max_procs:
+                job['start'] = now
+                job['pred'] = last_job
+            else:
+                # Start on the nodes of the next operation to finish
+                end, j, prev = heapq.heappop(finished)
+                job['start'] = end
+                job['pred'] = prev
+                job['hosts'] = prev['hosts']
+            job['end'] = job['start'] + job['runtime']
+            self.jobs.append(job)
+            heapq.heappush(finished, (job['end'], len(self.jobs), job))
+
+        while len(finished) > 0:
+            end, j, job = heapq.heappop(finished)
+            now = max(now, end)
+            last_job = job
+
+        return now, last_job
+
+
+    def _simulate_graph(self, nodes, now, last_job):
+        """
+        Simulates Scheduler.run_dag() for a graph of operations
+
+        Each operation is started as soon as its dependencies have finished and
+        a node has a free slot, using the node selection of the scheduler
+        """
+        pending = [node for node, op in nodes]
+        ops = dict(nodes)
+        done = {}
+        running = []
+        node_load = Counter()
+        stage_start_job = last_job
+        while len(pending) > 0 or len(running) > 0:
+            started = True
+            while started:
+                started = False
+                ready = [n for n in pending if all([d in done or d not in ops
+                    for d in n.depends_on])]
+                for node in ready:
+                    op = ops[node]
+                    deps = [done[d] for d in node.depends_on if done.get(d) is not None]
+                    if op is None:
+                        # Nothing to run: the node is done once its
+                        # dependencies are
+                        pending.remove(node)
+                        if len(deps) > 0:
+                            done[node] = max(deps, key=lambda j: j['end'])
+                        else:
+                            done[node] = stage_start_job
+                        started = True
+                        break
+                    if len(running) >= self.scheduler.max_procs:
+                        continue
+                    hosts, nops_per_node, nslots = self.scheduler._select_hosts(
+                        op, op.node_list, node_load, len(ready))
+                    if len(hosts) == 0:
+                        continue
+                    ncpu = op.parset['cluster_specific']['ncpu']
+                    nproc = max(1, int(np.ceil(ncpu / float(nops_per_node))))
+                    job = {'op': op, 'hosts': hosts, 'nproc': nproc, 'start': now,
+                        'slots': dict([(h, nslots) for h in hosts])}
+                    job['runtime'] = self.get_runtime(op, hosts, nproc)
+                    job['end'] = now + job['runtime']
+                    if len(deps) > 0:
+                        job['pred'] = max(deps, key=lambda j: j['end'])
+                    else:
+                        job['pred'] = stage_start_job
+                    if job['pred'] is None or job['pred']['end'] < now:
+                        # The job had to wait for free resources
+                        job['pred'] = last_job
+                    node_load.update(job['slots'])
+                    pending.remove(node)
+                    self.jobs.append(job)
+                    heapq.heappush(running, (job['end'], len(self.jobs), node, job))
+                    started = True
+                    break
+
+            if len(running) == 0:
+                break
+
+            # Advance to the next job to finish
+            end, j, node, job = heapq.heappop(running)
+            now = end
+            last_job = job
+            node_load.subtract(job['slots'])
+            done[node] = job
+
+        return now, last_job
+
+
+    def report(self):
+        """
+        Simulates the scheduler and logs the results
+        """
+        if len(self.stages) == 0:
+            return
+        result = self.simulate()
+
+        def format_time(t):
+            return str(datetime.timedelta(seconds=int(round(t))))
+
+        log.info('Simulated processing of {0} operation(s) (run times of {1} '
+            'predicted from previous runs and of {2} from the default cost '
+            'model):'.format(len(self.jobs), self.nfrom_history, self.nfrom_model))
+        log.info('Expected total run time: {0}'.format(format_time(result['makespan'])))
+        for h in sorted(result['utilisation']):
+            log.info('Expected cpu usage of node {0}: {1:.0f}%'.format(h,
+                result['utilisation'][h] * 100.0))
+        log.info('Critical path:')
+        for op_name, direction_name, start, end in result['critical_path']:
+            log.info('    {0} (direction: {1}): {2} - {3}'.format(op_name,
+                direction_name, format_time(start), format_time(end)))
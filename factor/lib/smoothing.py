@@ -0,0 +1,384 @@
+"""
+Module that holds the spline and median smoothing functions for solutions
+
+The functions are shared by the smooth_amps_spline and
+smooth_amps_phases_spline scripts. The solutions of all stations,
+polarizations and channels are smoothed together: the 1D spline fits are
+distributed in large chunks over a single pool and the 2D median filters are
+applied to all series in one call
+"""
+import math
+import multiprocessing
+import numpy
+import scipy.ndimage
+from scipy.interpolate import LSQUnivariateSpline
+import astropy.convolution
+
+
+def std(inputData, Zero=False, axis=None, dtype=None):
+    """
+    Robust estimator of the standard deviation of a data set.
+
+    Based on the robust_sigma function from the AstroIDL User's Library.
+
+    .. versionchanged:: 1.0.3
+        Added the 'axis' and 'dtype' keywords to make this function more
+        compatible with numpy.std()
+    """
+    epsilon = 1.0e-20
+    if axis is not None:
+        fnc = lambda x: std(x, dtype=dtype)
+        sigma = numpy.apply_along_axis(fnc, axis, inputData)
+    else:
+        data = inputData.ravel()
+        if type(data).__name__ == "MaskedArray":
+            data = data.compressed()
+        if dtype is not None:
+            data = data.astype(dtype)
+
+        if Zero:
+            data0 = 0.0
+        else:
+            data0 = numpy.median(data)
+        maxAbsDev = numpy.median(numpy.abs(data-data0)) / 0.6745
+        if maxAbsDev < epsilon:
+            maxAbsDev = (numpy.abs(data-data0)).mean() / 0.8000
+        if maxAbsDev < epsilon:
+            sigma = 0.0
+            return sigma
+
+        u = (data-data0) / 6.0 / maxAbsDev
+        u2 = u**2.0
+        good = numpy.where( u2 <= 1.0 )
+        good = good[0]
+        if len(good) < 3:
+            print "WARNING:  Distribution is too strange to compute standard deviation"
+            sigma = -1.0
+            return sigma
+
+        numerator = ((data[good]-data0)**2.0 * (1.0-u2[good])**2.0).sum()
+        nElements = (data.ravel()).shape[0]
+        denominator = ((1.0-u2[good])*(1.0-5.0*u2[good])).sum()
+        sigma = nElements*numerator / (denominator*(denominator-1.0))
+        if sigma > 0:
+            sigma = math.sqrt(sigma)
+        else:
+            sigma = 0.0
+
+    return sigma
+
+
+def findscatter(datavector):
+    """
+    Returns the median absolute difference between neighbouring samples
+    """
+    shifted_vec = numpy.roll(datavector, 1)
+    scatter = numpy.median(abs(shifted_vec - datavector))
+    return scatter
+
+
+def findnoisevec(datavector):
+    """
+    Returns the smoothed, normalized local scatter of a series
+    """
+    shifted_vec = numpy.roll(datavector, 1)
+    scatter_vec = (abs(shifted_vec - datavector))
+    scatter_vec = scipy.ndimage.filters.median_filter(scatter_vec,9, mode='mirror')
+
+    # now smooth
+    gauss = astropy.convolution.Gaussian1DKernel(stddev=4.0)
+    scatter_vec = astropy.convolution.convolve(scatter_vec,gauss , boundary='extend')
+
+    # normalize scatter_vec
+    scatter_vec = scatter_vec/numpy.mean(scatter_vec)
+
+    return scatter_vec
+
+
+def mirror_edges(values_orig):
+    """
+    Returns a series extended by its mirror images at both edges
+
+    Parameters
+    ----------
+    values_orig : array
+        Series of length ndata
+
+    Returns
+    -------
+    values : array
+        Series of length 3 * ndata, with the original series in the middle
+
+    """
+    ndata = len(values_orig)
+    left_ind = numpy.minimum(ndata-1, ndata-numpy.arange(ndata))
+    right_ind = numpy.maximum(0, ndata-2-numpy.arange(ndata))
+
+    values = numpy.zeros(ndata+2*ndata)
+    values[0:ndata] = values_orig[left_ind]
+    values[ndata:ndata+ndata] = values_orig
+    values[ndata+ndata:] = values_orig[right_ind]
+
+    return values
+
+
+def spline1D(values_orig, log=True, skip_zeros=False):
+    """
+    Fits a spline to a series and replaces the outliers by the fit
+
+    Parameters
+    ----------
+    values_orig : array or None
+        Series to smooth (e.g., the amplitudes or phases of one channel). If
+        None, all returned values are None
+    log : bool, optional
+        If True, the fit is done to the log10 of the values (as for
+        amplitudes)
+    skip_zeros : bool, optional
+        If True, the values that are zero after the (optional) log (i.e.,
+        amplitudes of 1.0 or phases of 0.0, used for flagged solutions) are not
+        used to determine the scatter
+
+    Returns
+    -------
+    values_clean : array
+        Cleaned values
+    model : array
+        Spline model
+    noisevec : array
+        Normalized local scatter
+    scatter : float
+        Scatter of the (log) values
+    n_knots : int
+        Approximate number of knots
+    idxbad : tuple of arrays
+        Indices of the replaced values
+    weights : array
+        Weights used in the fit
+
+    """
+    # to compute knot points
+    f = lambda m, n: [i*n//m + n//(2*m) for i in range(m)]
+
+    if values_orig is None:
+        return None, None, None, None, None, None, None
+
+    # expand array and mirror full array around edges
+    ndata = len(values_orig)
+    values = mirror_edges(values_orig)
+
+    # work in log-space
+    if log:
+        values = numpy.log10(values)
+    weights = (0.*numpy.copy(values)) + 1 # initialize weights to 1
+
+    # filter bad data and determine average scatter of amplitudes
+    if skip_zeros:
+        idx = numpy.where(values != 0.0)
+        if numpy.any(idx): # so we do not have an empty array
+            scatter = findscatter(values[idx])
+            ngood = len(values[idx])
+        else:
+            scatter = 0.02 # just that we have a value to prevent crashes in case all amplitudes are 1.0
+            ngood = 0
+    else:
+        scatter = findscatter(values)
+        ngood = len(values)
+    if not skip_zeros or ngood > 0:
+        # remove some really bad stuff, by putting weights to zero.
+        idxbadi1 = numpy.where(values > (numpy.median(values) + (35.*std(values))))
+        weights[idxbadi1] = 1e-10 # small value, zero generates NaN in spline
+        idxbadi2 = numpy.where(values < (numpy.median(values) - (35.*std(values))))
+        weights[idxbadi2] = 1e-10  # small value, zero generates NaN in spline
+
+    # make the noisevec
+    if ngood > 30:  # so at least 30/3 = 10 good data points
+        # create noise vector
+        noisevec = findnoisevec(values)
+    else:
+        noisevec = (numpy.copy(values) * 0.) + 1.0 # just make constant noise, if we have too little datapoints
+
+    if scatter < 0.005:
+        #Interior knots t must satisfy Schoenberg-Whitney conditions
+        scatter = 0.005 # otherwise we fit more parameters than we have data points
+    knotfactor = 0.5e3*scatter  # normalize based on trial and error
+
+    timevec = numpy.arange(0,len(values))
+    knotvec = f(int(len(values)/knotfactor),len(values))
+
+    # simple optimization knot selection for vectors that have at least 30 data points
+    # based on the noisevector
+    # removes even numbered knots if the noise is high
+    knotvec_copy = numpy.copy(knotvec) # otherwise tcopy is updated as well
+    if len(timevec) > 30 and len(knotvec) > 2:
+        for counter, knot in enumerate(knotvec_copy):
+            if (counter % 2 == 0) and noisevec[knot] > 1.5: # even index and large noise
+                knotvec.remove(knot)
+
+    # asign midpoint if not enough data points/20
+    if len (knotvec) < 3: # because we are working with a 3x larger mirrored array
+        knotvec = [int(len(timevec)*0.25),int(len(timevec)/2),int(len(timevec)*0.75)]
+
+    splineorder =  5 #  default
+    if len(knotvec) == 3 and scatter > 0.1:
+        splineorder = 3 # reduce order, data is  bad
+        if scatter > 0.2:
+            splineorder = 1 # very bad data
+
+    spl2 = LSQUnivariateSpline(timevec, values, knotvec, w=weights, k=splineorder)
+
+    # now find bad data devatiating from the fit 30 x scatter
+    residual = numpy.abs(spl2(timevec)-values)
+    idx      = numpy.where(residual > 15.*scatter)
+
+    # second iteration
+    if numpy.any(idx):
+        valuescopy = numpy.copy(values)
+        valuescopy[idx] = spl2(timevec[idx]) # replace bad values by model
+        spl2 = LSQUnivariateSpline(timevec, valuescopy, knotvec,  w=weights, k=splineorder)
+
+    residual = numpy.abs(spl2(timevec)-values)
+    idx      = numpy.where(residual > 8.*scatter)
+
+    # third iteration
+    if numpy.any(idx):
+        valuescopy = numpy.copy(values)
+        valuescopy[idx] = spl2(timevec[idx]) # replace bad values by model
+        spl2 = LSQUnivariateSpline(timevec, valuescopy, knotvec,  w=weights, k=splineorder)
+
+    # again look at residual, go back to original values again, find deviating data > 3x scatter
+    residual = numpy.abs(spl2(timevec)-values)
+    idx      = numpy.where(residual > 3.*scatter)
+    # replace the bad data with model
+    model    =spl2(timevec)
+    values[idx] = model[idx]
+
+    # go out of log-space
+    model = model[ndata:ndata + ndata]
+    if log:
+        values = 10**values
+        model = 10**model
+
+    values_clean = values[ndata:ndata + ndata]
+
+    idxbad = numpy.where(values_clean != values_orig)
+    n_knots = int(numpy.ceil(float(len(knotvec))/3.)) # approxmiate, just for plot
+
+    # return cleaned values, model, scatter, number of knots, indices of replaced outliers
+    return values_clean, model, noisevec[ndata:ndata + ndata], scatter, n_knots, idxbad, weights[ndata:ndata + ndata]
+
+
+def spline1D_star(inputs):
+    """
+    Simple helper function for pool.map
+    """
+    return spline1D(*inputs)
+
+
+def smooth_series(series_list, log=True, skip_zeros=False, pool=None):
+    """
+    Smooths a number of series with spline1D()
+
+    Parameters
+    ----------
+    series_list : list of arrays
+        Series to smooth (e.g., one per station, polarization and channel).
+        Entries may be None (see spline1D())
+    log : bool, optional
+        See spline1D()
+    skip_zeros : bool, optional
+        See spline1D()
+    pool : multiprocessing.Pool instance, optional
+        Pool over which the series are distributed (in large chunks). If None,
+        the series are smoothed in this process
+
+    Returns
+    -------
+    results : list of tuples
+        Results of spline1D() for each series
+
+    """
+    inputs = [(series, log, skip_zeros) for series in series_list]
+    if pool is None:
+        return [spline1D_star(i) for i in inputs]
+
+    chunksize = max(1, int(numpy.ceil(len(inputs) / (4.0 * multiprocessing.cpu_count()))))
+    return pool.map(spline1D_star, inputs, chunksize)
+
+
+def median2Dfilter(values_orig, log=True):
+    """
+    Replaces outliers in (chan, time) arrays by their 2D median
+
+    Parameters
+    ----------
+    values_orig : array
+        Values (e.g., amplitudes) with shape (nchan, ntime), or a stack of such
+        arrays with shape (nseries, nchan, ntime). All arrays of a stack are
+        filtered at once, each with its own scatter
+    log : bool, optional
+        If True, the filtering is done to the log10 of the values (as for
+        amplitudes)
+
+    Returns
+    -------
+    values_cleaned : array
+        Cleaned values
+    values_median : array
+        Median-filtered values
+    baddata : array
+        1.0 for the replaced values and 0.0 otherwise
+
+    """
+    values_orig = numpy.asarray(values_orig)
+    is_2d = (values_orig.ndim == 2)
+    if is_2d:
+        values_orig = values_orig[numpy.newaxis]
+    nchan, ntime = values_orig.shape[1:]
+
+    # pad arrays by reflection around axis
+    values = numpy.pad(values_orig, ((0, 0), (nchan, nchan), (ntime, ntime)),
+        mode='reflect')
+
+    # take the log
+    if log:
+        values = numpy.log10(values)
+
+    # create median filtered array
+    values_median = scipy.ndimage.median_filter(values, (1,3,5)) # so a bit more smoothing along the time-axis
+
+    # find scatter of each array: the median over time (freq) of the median
+    # absolute difference between neighbouring samples in freq (time)
+    scatter_freq = numpy.median(numpy.median(numpy.abs(numpy.roll(values, 1, axis=1) -
+        values), axis=1), axis=1)
+    scatter_time = numpy.median(numpy.median(numpy.abs(numpy.roll(values, 1, axis=2) -
+        values), axis=2), axis=1)
+    scatter = 0.5*(scatter_freq+scatter_time) # average x-y scatter
+
+    # just asign some value to arrays without good (nonzero) data
+    idxgood = numpy.any(values != 0.0, axis=(1, 2))
+    scatter = numpy.where(idxgood, scatter, 0.02)
+
+    # find bad data
+    idxbad = numpy.where((numpy.abs(values - values_median)) >
+        scatter[:, numpy.newaxis, numpy.newaxis]*3.)
+    baddata = numpy.copy(values)*0.0
+    baddata[idxbad] = 1.0
+
+    # replace the bad data points
+    values_cleaned = numpy.copy(values)
+    values_cleaned[idxbad] = values_median[idxbad]
+
+    #back to original size
+    values_median = values_median[:, nchan:2*nchan, ntime:2*ntime]
+    baddata = baddata[:, nchan:2*nchan, ntime:2*ntime]
+    values_cleaned = values_cleaned[:, nchan:2*nchan, ntime:2*ntime]
+
+    # raise to the power
+    if log:
+        values_median = 10**values_median
+        values_cleaned = 10**values_cleaned
+
+    if is_2d:
+        return values_cleaned[0], values_median[0], baddata[0]
+    return values_cleaned, values_median, baddata
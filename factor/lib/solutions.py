@@ -0,0 +1,684 @@
+"""
+Module that holds the columnar solution tables and their on-disk cache
+
+A parmdb is read once with getValuesGrid() and converted to one or more
+SolutionTable objects, each holding the values of all parameters on the same
+time and frequency grid as a single (parm type, pol, station, time, freq)
+array. If a cache directory is given, the tables can be cached on disk (keyed
+by the path and modification time of the parmdb), so that later reads of the
+same parmdb are memory-mapped loads instead of a new decoding of the parmdb
+"""
+import os
+import shutil
+import hashlib
+import pickle
+import numpy as np
+import lofar.parmdb
+
+
+def parse_parm_name(name):
+    """
+    Returns the parameter type, polarization and station of a parameter
+
+    Parameters
+    ----------
+    name : str
+        Name of the parameter (e.g., 'Gain:0:0:Real:CS001HBA0' or
+        'TEC:CS001HBA0')
+
+    Returns
+    -------
+    parm_type : str
+        Type of the parameter (e.g., 'Gain:Real' or 'TEC')
+    pol : str
+        Polarization (e.g., '0:0'), or '' for parameters without one
+    station : str
+        Name of the station
+
+    """
+    parts = name.split(':')
+    if len(parts) >= 5 and parts[1].isdigit() and parts[2].isdigit():
+        parm_type = ':'.join([parts[0]] + parts[3:-1])
+        pol = ':'.join(parts[1:3])
+    else:
+        parm_type = ':'.join(parts[:-1])
+        pol = ''
+
+    return parm_type, pol, parts[-1]
+
+
+def make_parm_name(parm_type, pol, station):
+    """
+    Returns the name of a parameter (see parse_parm_name())
+    """
+    if pol == '':
+        return '{0}:{1}'.format(parm_type, station)
+    parts = parm_type.split(':', 1)
+
+    return ':'.join([parts[0], pol] + parts[1:] + [station])
+
+
+class SolutionTable(object):
+    """
+    The SolutionTable object holds the solutions of parameters on a single grid
+
+    Parameters
+    ----------
+    parm_types : list of str
+        Types of the parameters (e.g., ['Gain:Imag', 'Gain:Real'])
+    pols : list of str
+        Polarizations (e.g., ['0:0', '1:1']), with '' for parameters without
+        one
+    stations : list of str
+        Names of the stations
+    times : array
+        Times of the solutions
+    timewidths : array
+        Widths of the time slots
+    freqs : array
+        Frequencies of the solutions
+    freqwidths : array
+        Widths of the frequency channels
+    values : array
+        Values with shape (parm type, pol, station, time, freq)
+    present : array of bool, optional
+        True for the (parm type, pol, station) combinations that are in the
+        parmdb, with shape (parm type, pol, station). If None, all are assumed
+        to be present
+
+    """
+    def __init__(self, parm_types, pols, stations, times, timewidths, freqs,
+        freqwidths, values, present=None):
+        self.parm_types = list(parm_types)
+        self.pols = list(pols)
+        self.stations = list(stations)
+        self.times = np.asarray(times)
+        self.timewidths = np.asarray(timewidths)
+        self.freqs = np.asarray(freqs)
+        self.freqwidths = np.asarray(freqwidths)
+        self.values = values
+        shape = (len(self.parm_types), len(self.pols), len(self.stations),
+            len(self.times), len(self.freqs))
+        if self.values.shape != shape:
+            raise ValueError('Shape of values {0} does not match that of the '
+                'axes {1}.'.format(self.values.shape, shape))
+        if present is None:
+            present = np.ones(shape[:3], dtype=bool)
+        self.present = np.asarray(present, dtype=bool)
+
+
+    def get_index(self, parm_type, pol, station):
+        """
+        Returns the index of a parameter in the values array
+
+        Parameters
+        ----------
+        parm_type : str
+            Type of the parameter
+        pol : str
+            Polarization ('' for parameters without one)
+        station : str
+            Name of the station
+
+        Returns
+        -------
+        index : tuple of int or None
+            Index of the (ntime, nfreq) values of the parameter, or None if the
+            parameter is not present
+
+        """
+        try:
+            index = (self.parm_types.index(parm_type), self.pols.index(pol),
+                self.stations.index(station))
+        except ValueError:
+            return None
+        if not self.present[index]:
+            return None
+
+        return index
+
+
+    def iter_parms(self):
+        """
+        Yields the name and index of each parameter that is present
+        """
+        for i, j, k in zip(*np.where(self.present)):
+            yield (make_parm_name(self.parm_types[i], self.pols[j], self.stations[k]),
+                (i, j, k))
+
+
+    def get_time_segments(self, gap_factor=1.1):
+        """
+        Returns the regularly spaced segments of the time axis
+
+        Parameters
+        ----------
+        gap_factor : float, optional
+            A gap is present where two times are separated by more than this
+            factor times the width of the first
+
+        Returns
+        -------
+        segments : list of slice
+            Slices of the time axis between gaps
+
+        """
+        if len(self.times) < 2:
+            return [slice(0, len(self.times))]
+        delta_times = self.times[1:] - self.times[:-1]
+        gaps_ind = [int(g) for g in np.where(delta_times > self.timewidths[:-1]*gap_factor)[0] + 1]
+        starts = [0] + gaps_ind
+        ends = gaps_ind + [len(self.times)]
+
+        return [slice(s, e) for s, e in zip(starts, ends)]
+
+
+class Solutions(object):
+    """
+    The Solutions object holds the solution tables of a parmdb
+
+    Parameters
+    ----------
+    tables : list of SolutionTable instances
+        Tables of the parmdb (one per time and frequency grid)
+
+    """
+    def __init__(self, tables):
+        self.tables = tables
+
+
+    def get_tables(self, parm_type):
+        """
+        Returns the tables that hold a type of parameter
+
+        Parameters
+        ----------
+        parm_type : str
+            Type of the parameter (e.g., 'Gain:Real')
+
+        Returns
+        -------
+        tables : list of SolutionTable instances
+            Tables with parameters of the given type
+
+        """
+        return [t for t in self.tables if parm_type in t.parm_types and
+            np.any(t.present[t.parm_types.index(parm_type)])]
+
+
+    def get_names(self):
+        """
+        Returns the names of all parameters
+        """
+        return [name for table in self.tables for name, index in table.iter_parms()]
+
+
+    def get_stations(self):
+        """
+        Returns the sorted names of all stations
+        """
+        return sorted(set([parse_parm_name(name)[2] for name in self.get_names()]))
+
+
+    def get_parms(self):
+        """
+        Returns the values of all parameters as a dict
+
+        The dict has the same form as that returned by getValuesGrid('*'), with
+        the values being views of the values of the tables (so that changes to
+        them are written by write_solutions()). A ValueError is raised if a
+        parameter is in more than one table (e.g., after concatenate_solutions()),
+        as its values cannot then be given as a single view
+
+        Returns
+        -------
+        parms : dict
+            Values ('values'), times ('times'), time widths ('timewidths'),
+            frequencies ('freqs') and frequency widths ('freqwidths') of each
+            parameter, keyed by parameter name
+
+        """
+        parms = {}
+        for table in self.tables:
+            for name, index in table.iter_parms():
+                if name in parms:
+                    raise ValueError('Parameter {0} is in more than one solution '
+                        'table.'.format(name))
+                parms[name] = {'values': table.values[index], 'times': table.times,
+                    'timewidths': table.timewidths, 'freqs': table.freqs,
+                    'freqwidths': table.freqwidths}
+
+        return parms
+
+
+def parms_to_solutions(parms):
+    """
+    Converts the values of parameters to solution tables
+
+    Parameters that share the same time and frequency grid are put into the
+    same table
+
+    Parameters
+    ----------
+    parms : dict
+        Values of the parameters (as returned by getValuesGrid('*'))
+
+    Returns
+    -------
+    solutions : Solutions instance
+        Solution tables of the parameters
+
+    """
+    groups = {}
+    for name in sorted(parms):
+        parm = parms[name]
+        grid = tuple([np.asarray(parm[k], dtype=np.float64).tostring() for k in
+            ['times', 'timewidths', 'freqs', 'freqwidths']])
+        groups.setdefault(grid, []).append(name)
+
+    tables = []
+    for grid in sorted(groups):
+        names = groups[grid]
+        keys = [parse_parm_name(name) for name in names]
+        parm_types = sorted(set([k[0] for k in keys]))
+        pols = sorted(set([k[1] for k in keys]))
+        stations = sorted(set([k[2] for k in keys]))
+        parm0 = parms[names[0]]
+        values = np.empty((len(parm_types), len(pols), len(stations),
+            len(parm0['times']), len(parm0['freqs'])))
+        values.fill(np.nan)
+        present = np.zeros(values.shape[:3], dtype=bool)
+        for name, (parm_type, pol, station) in zip(names, keys):
+            index = (parm_types.index(parm_type), pols.index(pol), stations.index(station))
+            values[index] = np.asarray(parms[name]['values']).reshape(values.shape[3:])
+            present[index] = True
+        tables.append(SolutionTable(parm_types, pols, stations, parm0['times'],
+            parm0['timewidths'], parm0['freqs'], parm0['freqwidths'], values,
+            present))
+
+    return Solutions(tables)
+
+
+def concatenate_solutions(solutions_list):
+    """
+    Concatenates solution tables in time
+
+    Tables with the same parameters and frequency grid are joined into a
+    single table, ordered by their first time. Tables without a match (e.g.,
+    of a time chunk in which a station is missing) are kept as they are
+
+    Parameters
+    ----------
+    solutions_list : list of Solutions instances
+        Solution tables to concatenate (e.g., one per time chunk)
+
+    Returns
+    -------
+    solutions : Solutions instance
+        Concatenated solution tables
+
+    """
+    keys = []
+    groups = {}
+    for solutions in solutions_list:
+        for table in solutions.tables:
+            if len(table.times) == 0:
+                continue
+            key = (tuple(table.parm_types), tuple(table.pols), tuple(table.stations),
+                table.present.tostring(), np.asarray(table.freqs, dtype=np.float64).tostring(),
+                np.asarray(table.freqwidths, dtype=np.float64).tostring())
+            if key not in groups:
+                keys.append(key)
+                groups[key] = []
+            groups[key].append(table)
+
+    tables = []
+    for key in keys:
+        group = sorted(groups[key], key=lambda t: t.times[0])
+        table0 = group[0]
+        tables.append(SolutionTable(table0.parm_types, table0.pols, table0.stations,
+            np.concatenate([t.times for t in group]),
+            np.concatenate([t.timewidths for t in group]), table0.freqs,
+            table0.freqwidths, np.concatenate([t.values for t in group], axis=3),
+            table0.present))
+
+    return Solutions(tables)
+
+
+def get_index_map(centers, new_centers):
+    """
+    Returns the index of the nearest cell for each new cell
+
+    Parameters
+    ----------
+    centers : array
+        Sorted centers (times or frequencies) of the cells of a grid
+    new_centers : array
+        Centers of the cells of the new grid
+
+    Returns
+    -------
+    index_map : array of int
+        Index of the cell of the grid nearest to each new cell
+
+    """
+    centers = np.asarray(centers)
+    new_centers = np.asarray(new_centers)
+    if len(centers) == 1:
+        return np.zeros(len(new_centers), dtype=int)
+    ind = np.clip(np.searchsorted(centers, new_centers), 1, len(centers)-1)
+    left_is_nearer = (new_centers - centers[ind-1]) <= (centers[ind] - new_centers)
+
+    return ind - left_is_nearer.astype(int)
+
+
+def resample_solutions(solutions, parm_types, pols, stations, times, timewidths,
+    freqs):
+    """
+    Resamples solutions onto a new time and frequency grid
+
+    Each new cell takes the value of the nearest cell of the solutions. The
+    index maps are computed once per solution table and applied to all its
+    parameters at once
+
+    Parameters
+    ----------
+    solutions : Solutions instance
+        Solution tables to resample
+    parm_types : list of str
+        Types of the parameters to resample
+    pols : list of str
+        Polarizations to resample ('' for parameters without one)
+    stations : list of str
+        Stations to resample
+    times : array
+        Times of the new grid
+    timewidths : array
+        Widths of the time slots of the new grid
+    freqs : array
+        Frequencies of the new grid
+
+    Returns
+    -------
+    values : array
+        Resampled values with shape (parm type, pol, station, time, freq), NaN
+        where not covered
+    covered : array of bool
+        True where a new time slot overlaps the time range of a table that
+        holds the parameter, with shape (parm type, pol, station, time)
+
+    """
+    times = np.asarray(times)
+    timewidths = np.asarray(timewidths)
+    values = np.empty((len(parm_types), len(pols), len(stations), len(times),
+        len(freqs)))
+    values.fill(np.nan)
+    covered = np.zeros(values.shape[:4], dtype=bool)
+
+    for table in solutions.tables:
+        # Find the parameters of the table that are needed
+        ind_out = []
+        ind_in = []
+        for i, parm_type in enumerate(parm_types):
+            if parm_type not in table.parm_types:
+                continue
+            for j, pol in enumerate(pols):
+                if pol not in table.pols:
+                    continue
+                for k, station in enumerate(stations):
+                    index = table.get_index(parm_type, pol, station)
+                    if index is not None:
+                        ind_out.append((i, j, k))
+                        ind_in.append(index)
+        if len(ind_out) == 0:
+            continue
+        ind_out = tuple(np.array(ind_out).T)
+        ind_in = tuple(np.array(ind_in).T)
+
+        # Find the new time slots that overlap the time range of the table
+        start = table.times[0] - table.timewidths[0] / 2.0
+        end = table.times[-1] + table.timewidths[-1] / 2.0
+        overlap = np.where(np.logical_and(times + timewidths / 2.0 > start,
+            times - timewidths / 2.0 < end))[0]
+        if len(overlap) == 0:
+            continue
+
+        time_map = get_index_map(table.times, times[overlap])
+        freq_map = get_index_map(table.freqs, freqs)
+        table_values = np.asarray(table.values[ind_in])
+        values_out = values[ind_out]
+        values_out[:, overlap, :] = table_values[:, time_map, :][:, :, freq_map]
+        values[ind_out] = values_out
+        covered_out = covered[ind_out]
+        covered_out[:, overlap] = True
+        covered[ind_out] = covered_out
+
+    return values, covered
+
+
+def get_parmdb_state(parmdb_file):
+    """
+    Returns the modification state of a parmdb
+
+    Parameters
+    ----------
+    parmdb_file : str
+        Filename of parmdb
+
+    Returns
+    -------
+    state : tuple of float
+        Latest modification time and total size of the files of the parmdb
+
+    """
+    mtime = os.path.getmtime(parmdb_file)
+    size = 0
+    for root, dirs, files in os.walk(parmdb_file):
+        for f in dirs + files:
+            st = os.stat(os.path.join(root, f))
+            mtime = max(mtime, st.st_mtime)
+            size += st.st_size
+
+    return (mtime, size)
+
+
+def read_solutions(parmdb_file, cache_dir=None, max_cache_size_mb=2048.0):
+    """
+    Returns the solution tables of a parmdb, using the cache where possible
+
+    Cached tables are loaded with copy-on-write memory mapping, so changes
+    to their values are not written back to the cache
+
+    Parameters
+    ----------
+    parmdb_file : str
+        Filename of parmdb
+    cache_dir : str, optional
+        Directory in which the tables are cached. If None, the parmdb is read
+        directly and the cache is not used
+    max_cache_size_mb : float, optional
+        Maximum total size of the cache in MB. If 0, the cache is not used
+
+    Returns
+    -------
+    solutions : Solutions instance
+        Solution tables of the parmdb
+
+    """
+    parmdb_file = os.path.abspath(parmdb_file)
+    if cache_dir is None or max_cache_size_mb <= 0.0:
+        return parms_to_solutions(lofar.parmdb.parmdb(parmdb_file).getValuesGrid('*'))
+
+    state = get_parmdb_state(parmdb_file)
+    entry_dir = os.path.join(cache_dir, 'solutions_{0}'.format(
+        hashlib.md5(parmdb_file).hexdigest()))
+
+    solutions = load_cache_entry(entry_dir, parmdb_file, state)
+    if solutions is not None:
+        return solutions
+
+    solutions = parms_to_solutions(lofar.parmdb.parmdb(parmdb_file).getValuesGrid('*'))
+    try:
+        save_cache_entry(entry_dir, parmdb_file, state, solutions)
+        prune_solution_cache(cache_dir, max_cache_size_mb)
+    except (IOError, OSError):
+        # The cache is not essential, so continue without it
+        pass
+
+    return solutions
+
+
+def load_cache_entry(entry_dir, parmdb_file, state):
+    """
+    Returns the cached solution tables of a parmdb
+
+    Parameters
+    ----------
+    entry_dir : str
+        Directory of the cache entry
+    parmdb_file : str
+        Full path of parmdb
+    state : tuple
+        Modification state of the parmdb (see get_parmdb_state())
+
+    Returns
+    -------
+    solutions : Solutions instance or None
+        Solution tables, or None if the entry does not exist or is out of date
+
+    """
+    try:
+        with open(os.path.join(entry_dir, 'meta.pkl'), 'rb') as f:
+            meta = pickle.load(f)
+        if meta['path'] != parmdb_file or meta['state'] != state:
+            return None
+        tables = []
+        for i, axes in enumerate(meta['tables']):
+            values = np.load(os.path.join(entry_dir, 'values_{0}.npy'.format(i)),
+                mmap_mode='c')
+            tables.append(SolutionTable(values=values, **axes))
+        try:
+            # Mark the entry as recently used
+            os.utime(entry_dir, None)
+        except OSError:
+            pass
+        return Solutions(tables)
+    except Exception:
+        return None
+
+
+def save_cache_entry(entry_dir, parmdb_file, state, solutions):
+    """
+    Saves the solution tables of a parmdb to the cache
+
+    Parameters
+    ----------
+    entry_dir : str
+        Directory of the cache entry
+    parmdb_file : str
+        Full path of parmdb
+    state : tuple
+        Modification state of the parmdb (see get_parmdb_state())
+    solutions : Solutions instance
+        Solution tables of the parmdb
+
+    """
+    cache_dir = os.path.dirname(entry_dir)
+    if not os.path.exists(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # Made by another process
+            pass
+
+    # Write the entry to a temporary directory first, so that other processes
+    # never see an incomplete entry
+    temp_dir = '{0}.{1}.tmp'.format(entry_dir, os.getpid())
+    if os.path.exists(temp_dir):
+        shutil.rmtree(temp_dir)
+    os.makedirs(temp_dir)
+    meta = {'path': parmdb_file, 'state': state, 'tables': []}
+    for i, table in enumerate(solutions.tables):
+        np.save(os.path.join(temp_dir, 'values_{0}.npy'.format(i)), table.values)
+        meta['tables'].append({'parm_types': table.parm_types, 'pols': table.pols,
+            'stations': table.stations, 'times': table.times,
+            'timewidths': table.timewidths, 'freqs': table.freqs,
+            'freqwidths': table.freqwidths, 'present': table.present})
+    with open(os.path.join(temp_dir, 'meta.pkl'), 'wb') as f:
+        pickle.dump(meta, f, pickle.HIGHEST_PROTOCOL)
+
+    if os.path.exists(entry_dir):
+        # Out-of-date entry
+        shutil.rmtree(entry_dir, ignore_errors=True)
+    try:
+        os.rename(temp_dir, entry_dir)
+    except OSError:
+        # Saved by another process
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def prune_solution_cache(cache_dir, max_cache_size_mb):
+    """
+    Removes the least recently used entries until the cache fits in the given size
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory in which the tables are cached
+    max_cache_size_mb : float
+        Maximum total size of the cache in MB
+
+    """
+    entries = []
+    for dirname in os.listdir(cache_dir):
+        if not dirname.startswith('solutions_') or dirname.endswith('.tmp'):
+            continue
+        entry_dir = os.path.join(cache_dir, dirname)
+        try:
+            size = sum([os.path.getsize(os.path.join(entry_dir, f)) for f in
+                os.listdir(entry_dir)])
+            entries.append((os.path.getmtime(entry_dir), size, entry_dir))
+        except OSError:
+            # Removed by another process
+            continue
+
+    total_size = sum([e[1] for e in entries])
+    max_size = max_cache_size_mb * 1024.0 * 1024.0
+    for mtime, size, entry_dir in sorted(entries):
+        if total_size <= max_size:
+            break
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        total_size -= size
+
+
+def write_solutions(solutions, parmdb_file, create=True, gap_factor=1.1):
+    """
+    Writes solution tables to a parmdb
+
+    The values of each parameter are written per regularly spaced segment of
+    the time axis
+
+    Parameters
+    ----------
+    solutions : Solutions instance
+        Solution tables to write
+    parmdb_file : str
+        Filename of parmdb
+    create : bool, optional
+        If True, a new parmdb is made. If False, the values are added to an
+        existing parmdb
+    gap_factor : float, optional
+        A gap between segments is present where two times are separated by
+        more than this factor times the width of the first
+
+    """
+    pdb = lofar.parmdb.parmdb(parmdb_file, create=create)
+    for table in solutions.tables:
+        segments = table.get_time_segments(gap_factor)
+        for name, index in table.iter_parms():
+            values = table.values[index]
+            for seg in segments:
+                pdb.addValues(name, np.array(values[seg]), table.freqs,
+                    table.freqwidths, table.times[seg], table.timewidths[seg],
+                    asStartEnd=False)
+    pdb.flush()
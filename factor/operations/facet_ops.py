@@ -110,6 +110,12 @@ class FacetSelfcal(Operation):
             selfcal_caltype = 'diagonal'
             fourpol = False
 
+        # Cache for the solutions of the direction-independent parmDBs, which
+        # are read by the pre-averaging of each direction
+        solution_cache_dir = self.parset['cluster_specific']['dir_solution_cache']
+        if solution_cache_dir is None:
+            solution_cache_dir = os.path.join(self.factor_working_dir, 'solution_cache')
+
         self.parms_dict.update({'ms_files_single': ms_files_single,
                                 'ms_files_grouped': str(ms_files),
                                 'skymodels': skymodels,
@@ -119,7 +125,11 @@ class FacetSelfcal(Operation):
                                 'selfcal_caltype': selfcal_caltype,
                                 'fourpol': fourpol,
                                 'loopcount': loopcount,
-                                'smooth_amps_task': smooth_amps_task})
+                                'smooth_amps_task': smooth_amps_task,
+                                'pre_average_max_memory_mb': self.parset['cluster_specific']['pre_average_max_memory_mb'],
+                                'solution_cache_dir': solution_cache_dir,
+                                'solution_cache_size_mb': self.parset['cluster_specific']['solution_cache_size_mb'],
+                                'preaverage_stddev_bucket_width': self.parset['calibration_specific']['preaverage_stddev_bucket_width']})
 
     def finalize(self):
         """
@@ -331,6 +341,10 @@ class FacetImage(Operation):
         else:
             self.pipeline_parset_template = 'facetimage_noautomask_pipeline.parset'
 
+        # Imaging does not modify the input data, so a copy may be run on
+        # another node if this operation is slow
+        self.allow_speculation = True
+
         # Set flag for full-resolution run (used in finalize() to ensure that averaging
         # of the calibrated data is not too much for use by later imaging runs)
         if cellsize_arcsec == parset['imaging_specific']['selfcal_cellsize_arcsec']:
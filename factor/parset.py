@@ -8,6 +8,7 @@ import logging
 import ConfigParser
 import numpy as np
 from factor._logging import set_log_file
+from factor.cluster import get_total_memory
 
 log = logging.getLogger('factor:parset')
 
@@ -301,6 +302,17 @@ def get_calibration_options(parset):
     else:
         parset_dict['preaverage_flux_jy'] = 1.0
 
+    # Fractional width of the buckets of Gaussian kernel widths used in the
+    # baseline-dependent preaveraging in time (default = 0). Baselines whose
+    # kernel widths fall in the same bucket are smoothed together with a common
+    # width, which is faster but approximate. If 0, each baseline is smoothed
+    # with its exact width
+    if 'preaverage_stddev_bucket_width' in parset_dict:
+        parset_dict['preaverage_stddev_bucket_width'] = parset.getfloat('calibration',
+            'preaverage_stddev_bucket_width')
+    else:
+        parset_dict['preaverage_stddev_bucket_width'] = 0.0
+
     # Use multi-resolution selfcal that starts at 20 arcsec resolution and increases the
     # resolution in stages to the full resolution (default = False). This method may
     # improve convergence, especially when the starting model is poor
@@ -354,7 +366,8 @@ def get_calibration_options(parset):
     # Check for unused options
     allowed_options = ['exit_on_selfcal_failure', 'skip_selfcal_check',
         'preapply_first_cal_phases', 'target_max_selfcal_loops',
-        'max_selfcal_loops', 'preaverage_flux_jy', 'multiscale_selfcal',
+        'max_selfcal_loops', 'preaverage_flux_jy', 'preaverage_stddev_bucket_width',
+        'multiscale_selfcal',
         'multires_selfcal', 'tec_block_mhz', 'peel_flux_jy',
         'solve_min_uv_lambda', 'spline_smooth2d',
         'solve_all_correlations_flux_jy']
@@ -646,6 +659,28 @@ def get_directions_options(parset):
     else:
         parset_dict['minimize_nonuniformity'] = False
 
+    # Strategy used to search for the set of calibrators that minimizes
+    # non-uniformity (default = groups): "groups" (search all combinations of
+    # calibrators in groups of the brightest ones) or "anneal" (select from all
+    # calibrators by greedy seeding followed by simulated annealing, keeping
+    # the best set found within nonuniformity_max_time_min)
+    if 'nonuniformity_search' in parset_dict:
+        parset_dict['nonuniformity_search'] = parset_dict['nonuniformity_search'].lower()
+        if parset_dict['nonuniformity_search'] not in ['groups', 'anneal']:
+            log.error('The option "nonuniformity_search" must be one of "groups" '
+                'or "anneal"')
+            sys.exit(1)
+    else:
+        parset_dict['nonuniformity_search'] = 'groups'
+
+    # Maximum time in minutes to search for the set of calibrators that
+    # minimizes non-uniformity (default = 5)
+    if 'nonuniformity_max_time_min' in parset_dict:
+        parset_dict['nonuniformity_max_time_min'] = parset.getfloat('directions',
+            'nonuniformity_max_time_min')
+    else:
+        parset_dict['nonuniformity_max_time_min'] = 5.0
+
     # Number of internally derived directions can be limited to a maximum number
     # of directions if desired with max_num (default = all).
     if 'ndir_max' in parset_dict:
@@ -755,6 +790,7 @@ def get_directions_options(parset):
     allowed_options = ['faceting_skymodel', 'directions_file', 'max_radius_deg',
         'flux_min_for_merging_jy', 'flux_min_jy', 'size_max_arcmin',
         'separation_max_arcmin', 'max_num', 'ndir_max', 'minimize_nonuniformity',
+        'nonuniformity_search', 'nonuniformity_max_time_min',
         'faceting_radius_deg', 'check_edges', 'ndir_total', 'ndir_process',
         'ndir_selfcal', 'groupings', 'allow_reordering', 'target_ra', 'target_dec',
         'target_radius_arcmin', 'target_has_own_facet']
@@ -875,10 +911,118 @@ def get_cluster_options(parset):
     if 'dir_local_selfcal' not in parset_dict:
         parset_dict['dir_local_selfcal'] = parset_dict['dir_local']
 
+    # Run operations as a dependency graph (default = False). If True, each
+    # operation is started as soon as the data it needs are available, instead
+    # of waiting for all operations of the current group (or imaging setting)
+    # to finish. Operations for different groups and imaging settings can then
+    # run at the same time, sharing the nodes
+    if 'use_dag_scheduler' in parset_dict:
+        parset_dict['use_dag_scheduler'] = parset.getboolean('cluster',
+            'use_dag_scheduler')
+    else:
+        parset_dict['use_dag_scheduler'] = False
+
+    # Rebalance the cpus of each node among the operations running on it
+    # (default = False). If True, the cpus freed by an operation that finishes
+    # early are lent to the operations still running on the node (from their
+    # next pipeline step on) and to newly started operations, instead of staying
+    # idle until all operations of the group are done
+    if 'rebalance_resources' in parset_dict:
+        parset_dict['rebalance_resources'] = parset.getboolean('cluster',
+            'rebalance_resources')
+    else:
+        parset_dict['rebalance_resources'] = False
+
+    # Start the operations with the longest predicted run times first (default =
+    # False). The run times are predicted from those recorded for similar
+    # operations in previous runs (stored in the state directory). The cpus of a
+    # node are also divided among its operations in proportion to their
+    # predicted run times
+    if 'order_by_runtime' in parset_dict:
+        parset_dict['order_by_runtime'] = parset.getboolean('cluster',
+            'order_by_runtime')
+    else:
+        parset_dict['order_by_runtime'] = False
+
+    # Only start an operation on a node if its expected peak memory fits in the
+    # memory of the node that is not expected to be used by the operations
+    # already running there (default = False). The peak memory is taken from
+    # previous runs of similar operations (on a single machine) or estimated
+    # from the size of the data and images
+    if 'limit_memory' in parset_dict:
+        parset_dict['limit_memory'] = parset.getboolean('cluster',
+            'limit_memory')
+    else:
+        parset_dict['limit_memory'] = False
+
+    # Memory per node in GB that operations may use when limit_memory is True
+    # (default = 90% of the memory of the machine on which Factor runs)
+    if 'mem_per_node_gb' in parset_dict:
+        parset_dict['mem_per_node_gb'] = parset.getfloat('cluster',
+            'mem_per_node_gb')
+    else:
+        parset_dict['mem_per_node_gb'] = 0.9 * get_total_memory() / 1024.0
+    if parset_dict['limit_memory']:
+        log.info("Limiting the memory used per node to {0:.1f} GB".format(
+            parset_dict['mem_per_node_gb']))
+
+    # Start a copy of an operation that runs much slower than expected on free
+    # nodes, keeping the run that finishes first (default = False). Currently,
+    # only facet imaging operations may be copied. The expected run time is
+    # taken from previous runs of similar operations or from the operations of
+    # the same batch that have completed
+    if 'speculative_execution' in parset_dict:
+        parset_dict['speculative_execution'] = parset.getboolean('cluster',
+            'speculative_execution')
+    else:
+        parset_dict['speculative_execution'] = False
+
+    # Maximum memory in MB that each pre-averaging process may use (default = 0,
+    # meaning no limit). If > 0, the baseline-dependent averaging in time is done
+    # a few baselines at a time, reading only their rows and writing the results
+    # straight back, instead of reading all the data of a group of time chunks at
+    # once
+    if 'pre_average_max_memory_mb' in parset_dict:
+        parset_dict['pre_average_max_memory_mb'] = parset.getfloat('cluster',
+            'pre_average_max_memory_mb')
+    else:
+        parset_dict['pre_average_max_memory_mb'] = 0.0
+    if parset_dict['pre_average_max_memory_mb'] > 0.0:
+        log.info("Limiting the memory used per pre-averaging process to {0:.0f} "
+            "MB".format(parset_dict['pre_average_max_memory_mb']))
+
+    # Directory in which the solutions of parmdbs that are read more than once
+    # (e.g., the direction-independent parmdbs read by the pre-averaging of each
+    # direction) are cached, and the maximum size in MB of the cache (default =
+    # solution_cache in the working directory and 2048 MB). Set
+    # solution_cache_size_mb = 0 to disable the cache
+    if 'dir_solution_cache' not in parset_dict:
+        parset_dict['dir_solution_cache'] = None
+    else:
+        parset_dict['dir_solution_cache'] = parset_dict['dir_solution_cache'].rstrip('/')
+    if 'solution_cache_size_mb' in parset_dict:
+        parset_dict['solution_cache_size_mb'] = parset.getfloat('cluster',
+            'solution_cache_size_mb')
+    else:
+        parset_dict['solution_cache_size_mb'] = 2048.0
+
+    # Maximum size in MB of the cache of facet masks in the directory of each
+    # facet's vertices file (default = 512 MB). Set mask_cache_size_mb = 0 to
+    # disable the cache
+    if 'mask_cache_size_mb' in parset_dict:
+        parset_dict['mask_cache_size_mb'] = parset.getfloat('cluster',
+            'mask_cache_size_mb')
+    else:
+        parset_dict['mask_cache_size_mb'] = 512.0
+
     # Check for unused options
     allowed_options = ['ncpu', 'fmem', 'wsclean_fmem', 'ndir_per_node',
         'clusterdesc_file', 'cluster_type', 'dir_local', 'dir_local_selfcal',
-        'node_list', 'lofarroot', 'lofarpythonpath', 'nthread_io']
+        'node_list', 'lofarroot', 'lofarpythonpath', 'nthread_io',
+        'use_dag_scheduler', 'rebalance_resources', 'order_by_runtime',
+        'limit_memory', 'mem_per_node_gb', 'speculative_execution',
+        'pre_average_max_memory_mb', 'dir_solution_cache',
+        'solution_cache_size_mb', 'mask_cache_size_mb']
     for option in given_options:
         if option not in allowed_options:
             log.warning('Option "{}" was given in the [cluster] section of the '
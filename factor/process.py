@@ -8,7 +8,7 @@ import numpy as np
 import logging
 import pickle
 import collections
-import casacore.tables as pt
+import functools
 from lofarpipe.support.data_map import DataMap
 import factor
 import factor.directions
@@ -17,9 +17,11 @@ import factor.cluster
 from factor.operations.outlier_ops import *
 from factor.operations.field_ops import *
 from factor.operations.facet_ops import *
-from factor.lib.scheduler import Scheduler
+from factor.lib.scheduler import Scheduler, OperationNode, MemoryAdmission
+from factor.lib.history import RuntimeHistory
+from factor.lib.simulator import MakespanSimulator, CostModel
 from factor.lib.direction import Direction
-from factor.lib.band import Band
+from factor.lib.band import Band, get_ms_metadata_parallel
 
 
 log = logging.getLogger('factor')
@@ -146,82 +148,101 @@ def run(parset_file, logging_level='info', dry_run=False, test_run=False,
 
     if stop_after: log.debug('Will stop after processing {} selfcal-groups.'.format(stop_after))
     # Run selfcal and subtract operations on direction groups
-    for gindx, direction_group in enumerate(direction_groups):
-        if stop_after and gindx >= stop_after:
+    if parset['cluster_specific']['use_dag_scheduler']:
+        # Run all groups as one graph of operations, so that operations start as
+        # soon as the data they need are available
+        if stop_after:
+            direction_groups_to_run = direction_groups[:stop_after]
+        else:
+            direction_groups_to_run = direction_groups
+        _run_direction_groups_dag(scheduler, parset, bands, directions,
+            direction_groups_to_run, reset_operations, set_sub_data_colname,
+            set_preapply_flag, dry_run)
+        if stop_after and len(direction_groups) > stop_after:
             log.warn('Stopping after having processed {} groups.'.format(stop_after))
+            if scheduler.simulator is not None:
+                scheduler.simulator.report()
             log.info('Exiting...')
             sys.exit(0)
+    else:
+        for gindx, direction_group in enumerate(direction_groups):
+            if stop_after and gindx >= stop_after:
+                log.warn('Stopping after having processed {} groups.'.format(stop_after))
+                if scheduler.simulator is not None:
+                    scheduler.simulator.report()
+                log.info('Exiting...')
+                sys.exit(0)
+
+            log.info('Self calibrating {0} direction(s) in Group {1}'.format(
+                len(direction_group), gindx+1))
+
+            # Set up reset of any directions that need it. If the direction has
+            # already been through the facetsub operation, we must undo the
+            # changes with the facetsubreset operation
+            direction_group_reset = [d for d in direction_group if d.do_reset]
+            direction_group_reset_facetsub = [d for d in direction_group_reset if
+                'facetsub' in d.reset_operations]
+            if len(direction_group_reset_facetsub) > 0:
+                for d in direction_group_reset_facetsub:
+                    # Set subtracted data column to ensure we are using the new one
+                    d.subtracted_data_colname = 'CORRECTED_DATA'
+
+                    if ('facetsubreset' in d.completed_operations or
+                        'facetsubreset' in reset_operations):
+                        # Reset a previous reset, but only if it completed successfully
+                        # or is explicitly specified for reset (to allow one to resume
+                        # facetsubreset instead of always resetting and restarting it)
+                        d.reset_state('facetsubreset')
+                ops = [FacetSubReset(parset, bands, d) for d in direction_group_reset_facetsub]
+                for op in ops:
+                    scheduler.run(op)
+            for d in direction_group_reset:
+                d.reset_state(['facetselfcal', 'facetsub'])
+
+            # Set flag for first direction to create preapply parmdb
+            if set_preapply_flag:
+                direction_group[0].create_preapply_parmdb = True
+
+            # Do selfcal on calibrator only
+            ops = [FacetSelfcal(parset, bands, d) for d in direction_group]
+            scheduler.run(ops)
 
-        log.info('Self calibrating {0} direction(s) in Group {1}'.format(
-            len(direction_group), gindx+1))
-
-        # Set up reset of any directions that need it. If the direction has
-        # already been through the facetsub operation, we must undo the
-        # changes with the facetsubreset operation
-        direction_group_reset = [d for d in direction_group if d.do_reset]
-        direction_group_reset_facetsub = [d for d in direction_group_reset if
-            'facetsub' in d.reset_operations]
-        if len(direction_group_reset_facetsub) > 0:
-            for d in direction_group_reset_facetsub:
-                # Set subtracted data column to ensure we are using the new one
-                d.subtracted_data_colname = 'CORRECTED_DATA'
+            if dry_run:
+                # For dryrun, skip selfcal verification
+                for d in direction_group:
+                    d.selfcal_ok = True
+            direction_group_ok = [d for d in direction_group if d.selfcal_ok]
+            if set_sub_data_colname:
+                # Set the name of the subtracted data column for remaining
+                # directions (if needed)
+                if len(direction_group_ok) > 0:
+                    for d in directions:
+                        if d.name != direction_group_ok[0].name:
+                            d.subtracted_data_colname = 'CORRECTED_DATA'
+                    set_sub_data_colname = False
+            if set_preapply_flag:
+                # Set the flag for preapplication of selfcal solutions (if needed)
+                if len(direction_group_ok) > 0:
+                    if parset['calibration_specific']['preapply_first_cal_phases']:
+                        for d in directions:
+                            if d.name != direction_group_ok[0].name:
+                                d.preapply_phase_cal = True
+                                d.preapply_parmdb_mapfile = direction_group_ok[0].preapply_parmdb_mapfile
+                    set_preapply_flag = False
 
-                if ('facetsubreset' in d.completed_operations or
-                    'facetsubreset' in reset_operations):
-                    # Reset a previous reset, but only if it completed successfully
-                    # or is explicitly specified for reset (to allow one to resume
-                    # facetsubreset instead of always resetting and restarting it)
-                    d.reset_state('facetsubreset')
-            ops = [FacetSubReset(parset, bands, d) for d in direction_group_reset_facetsub]
+            # Subtract final model(s) for directions for which selfcal went OK
+            ops = [FacetSub(parset, bands, d) for d in direction_group_ok]
             for op in ops:
                 scheduler.run(op)
-        for d in direction_group_reset:
-            d.reset_state(['facetselfcal', 'facetsub'])
-
-        # Set flag for first direction to create preapply parmdb
-        if set_preapply_flag:
-            direction_group[0].create_preapply_parmdb = True
-
-        # Do selfcal on calibrator only
-        ops = [FacetSelfcal(parset, bands, d) for d in direction_group]
-        scheduler.run(ops)
 
-        if dry_run:
-            # For dryrun, skip selfcal verification
+            # Handle directions in this group for which selfcal failed
+            selfcal_ok = [d.selfcal_ok for d in direction_group]
             for d in direction_group:
-                d.selfcal_ok = True
-        direction_group_ok = [d for d in direction_group if d.selfcal_ok]
-        if set_sub_data_colname:
-            # Set the name of the subtracted data column for remaining
-            # directions (if needed)
-            if len(direction_group_ok) > 0:
-                for d in directions:
-                    if d.name != direction_group_ok[0].name:
-                        d.subtracted_data_colname = 'CORRECTED_DATA'
-                set_sub_data_colname = False
-        if set_preapply_flag:
-            # Set the flag for preapplication of selfcal solutions (if needed)
-            if len(direction_group_ok) > 0:
-                if parset['calibration_specific']['preapply_first_cal_phases']:
-                    for d in directions:
-                        if d.name != direction_group_ok[0].name:
-                            d.preapply_phase_cal = True
-                            d.preapply_parmdb_mapfile = direction_group_ok[0].preapply_parmdb_mapfile
-                set_preapply_flag = False
-
-        # Subtract final model(s) for directions for which selfcal went OK
-        ops = [FacetSub(parset, bands, d) for d in direction_group_ok]
-        for op in ops:
-            scheduler.run(op)
-
-        # Handle directions in this group for which selfcal failed
-        selfcal_ok = [d.selfcal_ok for d in direction_group]
-        for d in direction_group:
-            if not d.selfcal_ok:
-                log.warn('Self calibration failed for direction {0}.'.format(d.name))
-        if not all(selfcal_ok) and parset['calibration_specific']['exit_on_selfcal_failure']:
-            log.info('Exiting...')
-            sys.exit(1)
+                if not d.selfcal_ok:
+                    log.warn('Self calibration failed for direction {0}.'.format(d.name))
+            if not all(selfcal_ok) and parset['calibration_specific']['exit_on_selfcal_failure']:
+                log.info('Exiting...')
+                sys.exit(1)
 
     # Check that at least one direction went through selfcal successfully. If
     # not, exit
@@ -258,79 +279,333 @@ def run(parset_file, logging_level='info', dry_run=False, test_run=False,
         d.converted_parmdb_mapfile = nearest.converted_parmdb_mapfile
         d.save_state()
     if len(dirs_with_selfcal_to_image + dirs_without_selfcal_to_image) > 0:
-        for image_indx, (cellsize_arcsec, taper_arcsec, robust, min_uv_lambda) in enumerate(
-            zip(cellsizes, tapers, robusts, min_uvs)):
+        if parset['cluster_specific']['use_dag_scheduler']:
+            # Image all facets and make all mosaics as one graph of operations,
+            # so that the imaging runs for different settings can overlap
+            _run_imaging_dag(scheduler, parset, bands, dirs_with_selfcal_to_image,
+                dirs_without_selfcal_to_image, reset_directions, reset_operations)
+        else:
+            for image_indx, (cellsize_arcsec, taper_arcsec, robust, min_uv_lambda) in enumerate(
+                zip(cellsizes, tapers, robusts, min_uvs)):
 
-            # Always image directions that did not go through selfcal
-            dirs_to_image = dirs_without_selfcal_to_image[:]
+                # Always image directions that did not go through selfcal
+                dirs_to_image = dirs_without_selfcal_to_image[:]
 
-            # Only reimage facets with selfcal imaging parameters if reimage_selfcal flag is set
-            full_res_im, opname = _get_image_type_and_name(cellsize_arcsec, taper_arcsec,
-                robust, selfcal_robust, min_uv_lambda, parset)
-            if full_res_im:
-                dirs_to_image += dirs_with_selfcal_to_image
-            else:
-                dirs_to_image += dirs_with_selfcal_to_image
-
-            if len(dirs_to_image) > 0:
-                log.info('Imaging with cellsize = {0} arcsec, robust = {1}, '
-                    'taper = {2} arcsec, min_uv = {3} lambda'.format(cellsize_arcsec,
-                    robust, taper_arcsec, min_uv_lambda))
-                log.info('Imaging the following direction(s):')
-                log.info('{0}'.format([d.name for d in dirs_to_image]))
-
-            # Reset facetimage op for any directions that need it
-            directions_reset = [d for d in dirs_to_image if d.do_reset]
-            for d in directions_reset:
-                d.reset_state(opname)
+                # Only reimage facets with selfcal imaging parameters if reimage_selfcal flag is set
+                full_res_im, opname = _get_image_type_and_name(cellsize_arcsec, taper_arcsec,
+                    robust, selfcal_robust, min_uv_lambda, parset)
+                if full_res_im:
+                    dirs_to_image += dirs_with_selfcal_to_image
+                else:
+                    dirs_to_image += dirs_with_selfcal_to_image
+
+                if len(dirs_to_image) > 0:
+                    log.info('Imaging with cellsize = {0} arcsec, robust = {1}, '
+                        'taper = {2} arcsec, min_uv = {3} lambda'.format(cellsize_arcsec,
+                        robust, taper_arcsec, min_uv_lambda))
+                    log.info('Imaging the following direction(s):')
+                    log.info('{0}'.format([d.name for d in dirs_to_image]))
+
+                # Reset facetimage op for any directions that need it
+                directions_reset = [d for d in dirs_to_image if d.do_reset]
+                for d in directions_reset:
+                    d.reset_state(opname)
+
+                # Do facet imaging
+                ops = [FacetImage(parset, bands, d, cellsize_arcsec, robust,
+                    taper_arcsec, min_uv_lambda) for d in dirs_to_image]
+                scheduler.run(ops)
+
+            # Mosaic the final facet images together
+            if parset['imaging_specific']['make_mosaic']:
+                # Make direction object for the field and load previous state (if any)
+                field = Direction('field', bands[0].ra, bands[0].dec,
+                    factor_working_dir=parset['dir_working'])
+                field.load_state()
+                if len(reset_operations) > 0:
+                    field.reset_operations = reset_operations
+                else:
+                    field.reset_operations = (field.completed_operations[:] +
+                        field.started_operations[:])
+
+                # Set averaging for primary beam generation
+                field.avgpb_freqstep = bands[0].nchan
+                field.avgpb_timestep = int(120.0 / bands[0].timepersample)
+
+                for i, (cellsize_arcsec, taper_arcsec, robust, min_uv_lambda) in enumerate(
+                    zip(cellsizes, tapers, robusts, min_uvs)):
+
+                    # Reset the field direction if specified
+                    full_res_im, opname = _get_image_type_and_name(cellsize_arcsec, taper_arcsec,
+                        robust, selfcal_robust, min_uv_lambda, parset, opbase='fieldmosaic')
+                    if 'field' in reset_directions:
+                        field.reset_state(opname)
+
+                    # Specify appropriate image, mask, and vertices file
+                    field.facet_image_filenames = []
+                    field.facet_vertices_filenames = []
+                    full_res_im, opname = _get_image_type_and_name(cellsize_arcsec, taper_arcsec,
+                        robust, selfcal_robust, min_uv_lambda, parset)
+                    for d in dirs_to_image:
+                        if not d.is_patch:
+                            facet_image = DataMap.load(d.facet_image_mapfile[opname])[0].file
+                            field.facet_image_filenames.append(facet_image)
+                            field.facet_vertices_filenames.append(d.save_file)
+
+                    # Do mosaicking
+                    op = FieldMosaic(parset, bands, field, cellsize_arcsec, robust,
+                            taper_arcsec, min_uv_lambda)
+                    scheduler.run(op)
+
+    if scheduler.simulator is not None:
+        scheduler.simulator.report()
+    scheduler.close()
+    log.info("Factor has finished :)")
 
-            # Do facet imaging
-            ops = [FacetImage(parset, bands, d, cellsize_arcsec, robust,
-                taper_arcsec, min_uv_lambda) for d in dirs_to_image]
-            scheduler.run(ops)
 
-        # Mosaic the final facet images together
-        if parset['imaging_specific']['make_mosaic']:
-            # Make direction object for the field and load previous state (if any)
-            field = Direction('field', bands[0].ra, bands[0].dec,
-                factor_working_dir=parset['dir_working'])
-            field.load_state()
-            if len(reset_operations) > 0:
-                field.reset_operations = reset_operations
-            else:
-                field.reset_operations = (field.completed_operations[:] +
-                    field.started_operations[:])
+def _run_direction_groups_dag(scheduler, parset, bands, directions,
+    direction_groups, reset_operations, set_sub_data_colname, set_preapply_flag,
+    dry_run=False):
+    """
+    Runs the selfcal and subtract operations on direction groups as a graph
 
-            # Set averaging for primary beam generation
-            field.avgpb_freqstep = bands[0].nchan
-            field.avgpb_timestep = int(120.0 / bands[0].timepersample)
+    The operations are linked by the data they share: selfcal reads the
+    subtracted-data column, which facetsub and facetsubreset write, and the
+    selfcal operations of later groups read the preapply parmdb and the name of
+    the subtracted-data column, which are set once the previous group has
+    finished selfcal. Operations start as soon as these data are available
+    instead of at fixed group boundaries
 
-            for i, (cellsize_arcsec, taper_arcsec, robust, min_uv_lambda) in enumerate(
-                zip(cellsizes, tapers, robusts, min_uvs)):
+    Parameters
+    ----------
+    scheduler : Scheduler instance
+        The operation scheduler
+    parset : dict
+        Parset containing processing parameters
+    bands : list of Band instances
+        Vis data
+    directions : list of Direction instances
+        All directions
+    direction_groups : list of lists of Direction instances
+        Groups of directions to selfcal
+    reset_operations : list of str
+        List of operations to be reset
+    set_sub_data_colname : bool
+        If True, the name of the subtracted-data column has yet to be set
+    set_preapply_flag : bool
+        If True, the flag for preapplication of the selfcal solutions has yet
+        to be set
+    dry_run : bool, optional
+        If True, do not run pipelines. All parsets, etc. are made as normal
 
-                # Reset the field direction if specified
-                full_res_im, opname = _get_image_type_and_name(cellsize_arcsec, taper_arcsec,
-                    robust, selfcal_robust, min_uv_lambda, parset, opbase='fieldmosaic')
-                if 'field' in reset_directions:
-                    field.reset_state(opname)
+    """
+    # Flags that are updated as the groups finish selfcal
+    flags = {'set_sub_data_colname': set_sub_data_colname,
+             'set_preapply_flag': set_preapply_flag}
+    started_groups = set()
+
+    def make_selfcal_op(d, is_first, gindx, direction_group):
+        if gindx not in started_groups:
+            # Log the start of the group when its first selfcal op is started
+            log.info('Self calibrating {0} direction(s) in Group {1}'.format(
+                len(direction_group), gindx+1))
+            started_groups.add(gindx)
+        if d.do_reset:
+            d.reset_state(['facetselfcal', 'facetsub'])
+        if is_first and flags['set_preapply_flag']:
+            # Set flag for first direction to create preapply parmdb
+            d.create_preapply_parmdb = True
+        return FacetSelfcal(parset, bands, d)
+
+    def make_group_check(direction_group):
+        def check_group(op):
+            if dry_run:
+                # For dryrun, skip selfcal verification
+                for d in direction_group:
+                    d.selfcal_ok = True
+            direction_group_ok = [d for d in direction_group if d.selfcal_ok]
+            if flags['set_sub_data_colname'] and len(direction_group_ok) > 0:
+                # Set the name of the subtracted data column for remaining
+                # directions
+                for d in directions:
+                    if d.name != direction_group_ok[0].name:
+                        d.subtracted_data_colname = 'CORRECTED_DATA'
+                flags['set_sub_data_colname'] = False
+            if flags['set_preapply_flag'] and len(direction_group_ok) > 0:
+                # Set the flag for preapplication of selfcal solutions
+                if parset['calibration_specific']['preapply_first_cal_phases']:
+                    for d in directions:
+                        if d.name != direction_group_ok[0].name:
+                            d.preapply_phase_cal = True
+                            d.preapply_parmdb_mapfile = direction_group_ok[0].preapply_parmdb_mapfile
+                flags['set_preapply_flag'] = False
 
-                # Specify appropriate image, mask, and vertices file
-                field.facet_image_filenames = []
-                field.facet_vertices_filenames = []
-                full_res_im, opname = _get_image_type_and_name(cellsize_arcsec, taper_arcsec,
-                    robust, selfcal_robust, min_uv_lambda, parset)
-                for d in dirs_to_image:
-                    if not d.is_patch:
-                        facet_image = DataMap.load(d.facet_image_mapfile[opname])[0].file
-                        field.facet_image_filenames.append(facet_image)
-                        field.facet_vertices_filenames.append(d.save_file)
-
-                # Do mosaicking
-                op = FieldMosaic(parset, bands, field, cellsize_arcsec, robust,
-                        taper_arcsec, min_uv_lambda)
-                scheduler.run(op)
+            return True
+        return check_group
 
-    log.info("Factor has finished :)")
+    def make_group_failure_check(direction_group):
+        def check_group_failures(op):
+            # Handle directions in this group for which selfcal failed
+            for d in direction_group:
+                if not d.selfcal_ok:
+                    log.warn('Self calibration failed for direction {0}.'.format(d.name))
+            if (not all([d.selfcal_ok for d in direction_group]) and
+                parset['calibration_specific']['exit_on_selfcal_failure']):
+                return False
+            return True
+        return check_group_failures
+
+    nodes = []
+    group_done = []
+    for gindx, direction_group in enumerate(direction_groups):
+        # Set up reset of any directions that need it. If the direction has
+        # already been through the facetsub operation, we must undo the
+        # changes with the facetsubreset operation
+        direction_group_reset_facetsub = [d for d in direction_group if
+            d.do_reset and 'facetsub' in d.reset_operations]
+        for d in direction_group_reset_facetsub:
+            # Set subtracted data column to ensure we are using the new one
+            d.subtracted_data_colname = 'CORRECTED_DATA'
+
+            if ('facetsubreset' in d.completed_operations or
+                'facetsubreset' in reset_operations):
+                # Reset a previous reset, but only if it completed successfully
+                # or is explicitly specified for reset
+                d.reset_state('facetsubreset')
+            nodes.append(OperationNode(functools.partial(FacetSubReset, parset,
+                bands, d), writes=['subtracted_data', 'direction:'+d.name],
+                name='facetsubreset_{0}'.format(d.name)))
+
+        # Do selfcal on calibrator only
+        for i, d in enumerate(direction_group):
+            nodes.append(OperationNode(functools.partial(make_selfcal_op, d, i == 0,
+                gindx, direction_group),
+                reads=['subtracted_data', 'subtracted_data_colname', 'preapply_parmdb'],
+                writes=['direction:'+d.name], depends_on=group_done,
+                name='facetselfcal_{0}'.format(d.name)))
+
+        # Check the results of the group's selfcal once all directions are done
+        nodes.append(OperationNode(None, writes=['subtracted_data_colname',
+            'preapply_parmdb'], on_completion=make_group_check(direction_group),
+            name='group_{0}'.format(gindx+1)))
+
+        # Subtract final model(s) for directions for which selfcal went OK
+        sub_nodes = [OperationNode(functools.partial(FacetSub, parset, bands, d),
+            reads=['subtracted_data_colname'], writes=['subtracted_data',
+            'direction:'+d.name], condition=lambda d=d: d.selfcal_ok,
+            name='facetsub_{0}'.format(d.name)) for d in direction_group]
+        nodes.extend(sub_nodes)
+
+        # Stop here if selfcal failed and we should exit on failure. The
+        # next group is not started before this check is done
+        group_done = [OperationNode(None, depends_on=sub_nodes,
+            on_completion=make_group_failure_check(direction_group),
+            name='group_{0}_done'.format(gindx+1))]
+        nodes.extend(group_done)
+
+    if not scheduler.run_dag(nodes):
+        log.info('Exiting...')
+        sys.exit(1)
+
+
+def _run_imaging_dag(scheduler, parset, bands, dirs_with_selfcal_to_image,
+    dirs_without_selfcal_to_image, reset_directions, reset_operations):
+    """
+    Runs the facet imaging and mosaicking operations as a graph
+
+    The facetimage operations for all image settings are run together, as they
+    only read the subtracted data. Each fieldmosaic operation starts as soon as
+    the facet images for its setting are done
+
+    Parameters
+    ----------
+    scheduler : Scheduler instance
+        The operation scheduler
+    parset : dict
+        Parset containing processing parameters
+    bands : list of Band instances
+        Vis data
+    dirs_with_selfcal_to_image : list of Direction instances
+        Directions to image that went through selfcal
+    dirs_without_selfcal_to_image : list of Direction instances
+        Directions to image with the solutions of the nearest direction
+    reset_directions : list of str
+        List of names of directions to be reset
+    reset_operations : list of str
+        List of operations to be reset
+
+    """
+    cellsizes = parset['imaging_specific']['facet_cellsize_arcsec']
+    tapers = parset['imaging_specific']['facet_taper_arcsec']
+    robusts = parset['imaging_specific']['facet_robust']
+    min_uvs = parset['imaging_specific']['facet_min_uv_lambda']
+    selfcal_robust = parset['imaging_specific']['selfcal_robust']
+    dirs_to_image = dirs_without_selfcal_to_image + dirs_with_selfcal_to_image
+
+    if parset['imaging_specific']['make_mosaic']:
+        # Make direction object for the field and load previous state (if any)
+        field = Direction('field', bands[0].ra, bands[0].dec,
+            factor_working_dir=parset['dir_working'])
+        field.load_state()
+        if len(reset_operations) > 0:
+            field.reset_operations = reset_operations
+        else:
+            field.reset_operations = (field.completed_operations[:] +
+                field.started_operations[:])
+
+        # Set averaging for primary beam generation
+        field.avgpb_freqstep = bands[0].nchan
+        field.avgpb_timestep = int(120.0 / bands[0].timepersample)
+
+    def make_mosaic_op(cellsize_arcsec, taper_arcsec, robust, min_uv_lambda, opname):
+        # Specify appropriate image and vertices file
+        field.facet_image_filenames = []
+        field.facet_vertices_filenames = []
+        for d in dirs_to_image:
+            if not d.is_patch:
+                facet_image = DataMap.load(d.facet_image_mapfile[opname])[0].file
+                field.facet_image_filenames.append(facet_image)
+                field.facet_vertices_filenames.append(d.save_file)
+        return FieldMosaic(parset, bands, field, cellsize_arcsec, robust,
+            taper_arcsec, min_uv_lambda)
+
+    nodes = []
+    for cellsize_arcsec, taper_arcsec, robust, min_uv_lambda in zip(cellsizes,
+        tapers, robusts, min_uvs):
+        full_res_im, opname = _get_image_type_and_name(cellsize_arcsec, taper_arcsec,
+            robust, selfcal_robust, min_uv_lambda, parset)
+        if len(dirs_to_image) > 0:
+            log.info('Imaging with cellsize = {0} arcsec, robust = {1}, '
+                'taper = {2} arcsec, min_uv = {3} lambda'.format(cellsize_arcsec,
+                robust, taper_arcsec, min_uv_lambda))
+            log.info('Imaging the following direction(s):')
+            log.info('{0}'.format([d.name for d in dirs_to_image]))
+
+        # Reset facetimage op for any directions that need it
+        for d in dirs_to_image:
+            if d.do_reset:
+                d.reset_state(opname)
+
+        # Do facet imaging
+        image_nodes = [OperationNode(functools.partial(FacetImage, parset, bands,
+            d, cellsize_arcsec, robust, taper_arcsec, min_uv_lambda),
+            reads=['subtracted_data'], writes=['direction:'+d.name],
+            name='{0}_{1}'.format(opname, d.name)) for d in dirs_to_image]
+        nodes.extend(image_nodes)
+
+        # Mosaic the final facet images together
+        if parset['imaging_specific']['make_mosaic']:
+            full_res_im, mosaic_opname = _get_image_type_and_name(cellsize_arcsec,
+                taper_arcsec, robust, selfcal_robust, min_uv_lambda, parset,
+                opbase='fieldmosaic')
+            if 'field' in reset_directions:
+                field.reset_state(mosaic_opname)
+            nodes.append(OperationNode(functools.partial(make_mosaic_op,
+                cellsize_arcsec, taper_arcsec, robust, min_uv_lambda, opname),
+                writes=['direction:field'], depends_on=image_nodes,
+                name=mosaic_opname))
+
+    scheduler.run_dag(nodes)
 
 
 def _set_up_compute_parameters(parset, dry_run=False):
@@ -418,8 +693,20 @@ def _set_up_compute_parameters(parset, dry_run=False):
             'simultaneously ({0}) is less than the number of directions in the '
             'largest group ({1}). For best performance, these values should be '
             'equal'.format(ndir_simul, ngroup_max))
+    history = RuntimeHistory(parset['dir_working'])
+    if cluster_parset['limit_memory']:
+        admission = MemoryAdmission(cluster_parset['mem_per_node_gb'] * 1024.0,
+            history=history)
+    else:
+        admission = None
     scheduler = Scheduler(parset['genericpipeline_executable'], max_procs=ndir_simul,
-        dry_run=dry_run)
+        dry_run=dry_run, ndir_per_node=cluster_parset['ndir_per_node'],
+        rebalance=cluster_parset['rebalance_resources'], history=history,
+        longest_first=cluster_parset['order_by_runtime'], admission=admission,
+        speculate=cluster_parset['speculative_execution'])
+    if dry_run:
+        # Simulate the processing to predict its run time
+        scheduler.simulator = MakespanSimulator(scheduler, CostModel(history))
 
     return scheduler
 
@@ -444,16 +731,29 @@ def _set_up_bands(parset, test_run=False):
 
     """
     log.info('Checking input bands...')
+    metadata_dir = os.path.join(parset['dir_working'], 'state', 'ms_metadata')
+    ncpu = parset['cluster_specific']['ncpu']
     msdict = {}
-    for ms in parset['mss']:
+    metadata = get_ms_metadata_parallel(parset['mss'], metadata_dir, ['frequency'],
+        ncpu=ncpu)
+    for ms, ms_metadata in zip(parset['mss'], metadata):
         # group all found MSs by frequency
-        sw = pt.table(ms+'::SPECTRAL_WINDOW', ack=False)
-        msfreq = int(sw.col('REF_FREQUENCY')[0])
-        sw.close()
+        msfreq = int(ms_metadata['freq'])
         if msfreq in msdict:
             msdict[msfreq].append(ms)
         else:
             msdict[msfreq] = [ms]
+
+    # Read the metadata needed by bands without a saved state for all their
+    # files at once, so that the files of different bands are read in parallel
+    new_mss = []
+    for ms, ms_metadata in zip(parset['mss'], metadata):
+        band_name = 'Band_{0:.2f}MHz'.format(ms_metadata['freq']/1e6)
+        if not os.path.exists(os.path.join(parset['dir_working'], 'state',
+            band_name+'_save.pkl')):
+            new_mss.append(ms)
+    get_ms_metadata_parallel(new_mss, metadata_dir, ['frequency', 'phase_center',
+        'station', 'elevation', 'columns', 'time'], ncpu=ncpu)
     bands = []
     for MSkey in msdict.keys():
         # Check for any sky models specified by user
@@ -796,7 +1096,9 @@ def _initialize_directions(parset, initial_skymodel, ref_band, max_radius_deg=No
                     dir_parset['separation_max_arcmin'],
                     directions_max_num=dir_parset['ndir_max'],
                     interactive=parset['interactive'], ncpu=parset['cluster_specific']['ncpu'],
-                    flux_min_for_merging_Jy=dir_parset['flux_min_for_merging_jy'])
+                    flux_min_for_merging_Jy=dir_parset['flux_min_for_merging_jy'],
+                    maxTime=dir_parset['nonuniformity_max_time_min'],
+                    search=dir_parset['nonuniformity_search'])
             else:
                 dir_parset['directions_file'] = factor.directions.make_directions_file_from_skymodel(
                     s, dir_parset['flux_min_jy'], dir_parset['size_max_arcmin'],
@@ -10,6 +10,7 @@ import os
 import pickle
 import glob
 from factor.lib.polygon import Polygon
+from factor.lib.mask_cache import get_mask
 from astropy.io import fits as pyfits
 from astropy import wcs
 
@@ -24,7 +25,7 @@ def read_vertices(filename):
 
 
 def main(input_image_file, vertices_file, output_image_file, blank_value='zero',
-    image_is_wsclean_model=False):
+    image_is_wsclean_model=False, mask_cache_size_mb=512.0):
     """
     Blank a region in an image
 
@@ -42,6 +43,9 @@ def main(input_image_file, vertices_file, output_image_file, blank_value='zero',
     image_is_wsclean_model : bool, optional
         If True, the input and output image files are treated as the root name
         of a WSClean model image (or images)
+    mask_cache_size_mb : float (str), optional
+        Maximum size in MB of the cache of facet masks (see
+        factor.lib.mask_cache.get_mask())
 
     """
     if type(image_is_wsclean_model) is str:
@@ -49,6 +53,7 @@ def main(input_image_file, vertices_file, output_image_file, blank_value='zero',
             image_is_wsclean_model = True
         else:
             image_is_wsclean_model = False
+    mask_cache_size_mb = float(mask_cache_size_mb)
 
     if image_is_wsclean_model:
         input_image_files = glob.glob(input_image_file+'*-model.fits')
@@ -82,30 +87,21 @@ def main(input_image_file, vertices_file, output_image_file, blank_value='zero',
         xvert.append(w.wcs_world2pix(ra_dec, 0)[0][Decind])
         yvert.append(w.wcs_world2pix(ra_dec, 0)[0][RAind])
     poly = Polygon(xvert, yvert)
+    mask_cache_dir = os.path.join(os.path.dirname(os.path.abspath(vertices_file)),
+        'facet_masks')
 
+    facet_mask = None
     for input_image, output_image in zip(input_image_files, output_image_files):
         hdu = pyfits.open(input_image, memmap=False)
         data = hdu[0].data
 
-        # Find limits of facet poly and blank pixels outside them
-        xmin = max(int(np.min(xvert)) - 2, 0)
-        xmax = min(int(np.max(xvert)) + 2, data.shape[2])
-        ymin = max(int(np.min(yvert)) - 2, 0)
-        ymax = min(int(np.max(yvert)) + 2, data.shape[3])
-        data[0, 0, :, :ymin] = blank_val
-        data[0, 0, :, ymax:] = blank_val
-        data[0, 0, :xmin, :] = blank_val
-        data[0, 0, xmax:, :] = blank_val
-
-        # Find distance to nearest poly edge and blank those that
-        # are outside the facet (dist < 0)
-        pix_ind = np.indices((xmax-xmin, ymax-ymin))
-        pix_ind[0] += xmin
-        pix_ind[1] += ymin
-        dist = poly.is_inside(pix_ind[0], pix_ind[1])
-        outside_ind = np.where(dist < 0.0)
-        if len(outside_ind[0]) > 0:
-            data[0, 0, pix_ind[0][outside_ind], pix_ind[1][outside_ind]] = blank_val
+        # Blank pixels outside the facet poly (those on its edge are kept). The
+        # mask is made once, as all images have the same geometry, and is
+        # cached for later calls with the same facet and image geometry
+        if facet_mask is None or facet_mask.shape != data.shape[2:]:
+            facet_mask = get_mask(mask_cache_dir, [poly], data.shape[2:],
+                include_sides=True, max_cache_size_mb=mask_cache_size_mb)
+        data[0, 0, ~facet_mask] = blank_val
 
         hdu[0].data = data
         hdu.writeto(output_image, clobber=True)
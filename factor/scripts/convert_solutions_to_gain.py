@@ -4,11 +4,12 @@ Script to convert selfcal solutions to single gain table
 """
 import argparse
 from argparse import RawTextHelpFormatter
-import lofar.parmdb as lp
 import shutil
 import numpy as np
 import sys
 import os
+from factor.lib.solutions import (SolutionTable, Solutions, read_solutions,
+    write_solutions, resample_solutions)
 
 
 def main(fast_parmdb, slow_parmdb, output_file, freqstep=1, preapply_parmdb=None,
@@ -46,17 +47,16 @@ def main(fast_parmdb, slow_parmdb, output_file, freqstep=1, preapply_parmdb=None
         shutil.copytree(fast_parmdb_orig, fast_parmdb)
         shutil.copytree(slow_parmdb_orig, slow_parmdb)
 
-    fast_pdb = lp.parmdb(fast_parmdb)
-    fast_soldict = fast_pdb.getValuesGrid('*')
-    slow_pdb = lp.parmdb(slow_parmdb)
-    slow_soldict = slow_pdb.getValuesGrid('*')
-    output_pdb = lp.parmdb(output_file, create=True)
+    fast_solutions = read_solutions(fast_parmdb)
+    fast_soldict = fast_solutions.get_parms()
+    slow_solutions = read_solutions(slow_parmdb)
+    slow_soldict = slow_solutions.get_parms()
     if preapply_parmdb is not None:
-        preapply_pdb = lp.parmdb(preapply_parmdb)
-        preapply_soldict = preapply_pdb.getValuesGrid('*')
+        preapply_solutions = read_solutions(preapply_parmdb)
+        preapply_soldict = preapply_solutions.get_parms()
 
     # Get various quantities over which we must iterate
-    station_names = list(set([s.split(':')[-1] for s in fast_pdb.getNames()]))
+    station_names = fast_solutions.get_stations()
     fast_times = fast_soldict['CommonScalarPhase:{s}'.format(s=station_names[0])]['times']
     fast_timewidths = fast_soldict['CommonScalarPhase:{s}'.format(s=station_names[0])]['timewidths']
     fast_timestep = np.mean(fast_timewidths)
@@ -92,81 +92,68 @@ def main(fast_parmdb, slow_parmdb, output_file, freqstep=1, preapply_parmdb=None
     # Determine final time and frequency grid. This step is not needed if a
     # preapply_parmdb is specified, as it will already be made on the final grids
     if freqstep > 1 and preapply_parmdb is None:
-        final_freqs = []
-        final_freqwidths = []
-        for freq, freqwidth in zip(slow_freqs, slow_freqwidths):
-            final_freqwidth = freqwidth / freqstep
-            low_freq = freq - freqwidth / 2
-            for i in range(freqstep):
-                final_freqs.append(low_freq + final_freqwidth * (i + 0.5))
-                final_freqwidths.append(final_freqwidth)
-        final_freqs = np.array(final_freqs)
-        final_freqwidths = np.array(final_freqwidths)
+        final_freqwidths = np.repeat(slow_freqwidths / freqstep, freqstep)
+        low_freqs = np.repeat(slow_freqs - slow_freqwidths / 2, freqstep)
+        final_freqs = low_freqs + final_freqwidths * (np.tile(np.arange(freqstep),
+            len(slow_freqs)) + 0.5)
     else:
         final_freqs = slow_freqs
         final_freqwidths = slow_freqwidths
 
-    # Identify any gaps in time (frequency gaps are not allowed), as we need to handle
-    # each section separately if gaps are present
-    delta_times = fast_times[1:] - fast_times[:-1]
-    gaps = np.where(delta_times > fast_timewidths[:-1]*2.)
-    gaps_ind = gaps[0] + 1
-    gaps_ind = np.append(gaps_ind, np.array([len(fast_times)]))
-
-    # Get values on the final time and frequency grid
-    g_start = 0
-    for g in gaps_ind:
-        if preapply_parmdb is not None:
-            preapply_soldict = preapply_pdb.getValues('*', final_freqs, final_freqwidths,
-                fast_times[g_start:g], fast_timewidths[g_start:g], asStartEnd=False)
-        fast_soldict = fast_pdb.getValues('*', final_freqs, final_freqwidths,
-            fast_times[g_start:g], fast_timewidths[g_start:g], asStartEnd=False)
-        slow_soldict = slow_pdb.getValues('*', final_freqs, final_freqwidths,
-            fast_times[g_start:g], fast_timewidths[g_start:g], asStartEnd=False)
-
-        # Add various phase and amp corrections together
-        for station in station_names:
-            try:
-                fast_phase = np.copy(fast_soldict['CommonScalarPhase:{s}'.format(s=station)]['values'])
-                tec = np.copy(fast_soldict['TEC:{s}'.format(s=station)]['values'])
-                tec_phase =  -8.44797245e9 * tec / final_freqs
-
-                for pol in pol_list:
-                    slow_real = np.copy(slow_soldict['Gain:'+pol+':Real:{s}'.format(s=station)]['values'])
-                    slow_imag = np.copy(slow_soldict['Gain:'+pol+':Imag:{s}'.format(s=station)]['values'])
-                    slow_amp = np.sqrt((slow_real**2) + (slow_imag**2))
-                    slow_phase = np.arctan2(slow_imag, slow_real)
-
-                    total_amp = slow_amp
-                    if preapply_parmdb is not None:
-                        fast_phase_preapply = np.copy(preapply_soldict['Gain:'+pol+':Phase:{s}'.format(s=station)]['values'])
-                        total_phase = np.mod(fast_phase + tec_phase + slow_phase +
-                            fast_phase_preapply + np.pi, 2*np.pi) - np.pi
-
-                        # Identify zero phase solutions and set the corresponding entries in total_phase and total_amp to NaN
-                        total_phase = np.where(fast_phase_preapply == 0.0, np.nan, total_phase)
-                        total_amp = np.where(fast_phase_preapply == 0.0, np.nan, total_amp)
-                    else:
-                        total_phase = np.mod(fast_phase + tec_phase + slow_phase + np.pi, 2*np.pi) - np.pi
-
-                    # Identify zero phase solutions and set the corresponding entries in total_phase and total_amp to NaN
-                    total_phase = np.where(np.logical_or(fast_phase == 0.0, tec_phase == 0.0), np.nan, total_phase)
-                    total_amp = np.where(np.logical_or(fast_phase == 0.0, tec_phase == 0.0), np.nan, total_amp)
-
-                    output_pdb.addValues('Gain:'+pol+':Phase:{}'.format(station),
-                        total_phase, final_freqs, final_freqwidths,
-                        fast_times[g_start:g], fast_timewidths[g_start:g], asStartEnd=False)
-                    output_pdb.addValues('Gain:'+pol+':Ampl:{}'.format(station),
-                        total_amp, final_freqs, final_freqwidths,
-                        fast_times[g_start:g], fast_timewidths[g_start:g], asStartEnd=False)
-            except KeyError:
-                # The station in question does not have solutions for this
-                # time period
-                continue
-        g_start = g
-
-    # Write values
-    output_pdb.flush()
+    # Get values on the final time and frequency grid as (parm type, pol,
+    # station, time, freq) arrays. Time slots in which a station has no
+    # solutions (e.g., in gaps) are not covered and are not written
+    fast_values, fast_covered = resample_solutions(fast_solutions,
+        ['CommonScalarPhase', 'TEC'], [''], station_names, fast_times,
+        fast_timewidths, final_freqs)
+    fast_phase = fast_values[0, 0]
+    tec_phase = -8.44797245e9 * fast_values[1, 0] / final_freqs
+    slow_values, slow_covered = resample_solutions(slow_solutions,
+        ['Gain:Real', 'Gain:Imag'], pol_list, station_names, fast_times,
+        fast_timewidths, final_freqs)
+    slow_amp = np.sqrt((slow_values[0]**2) + (slow_values[1]**2))
+    slow_phase = np.arctan2(slow_values[1], slow_values[0])
+    covered = np.logical_and(np.all(fast_covered[:, 0], axis=0),
+        np.all(slow_covered, axis=0))
+
+    # Add various phase and amp corrections together
+    total_amp = slow_amp
+    if preapply_parmdb is not None:
+        preapply_values, preapply_covered = resample_solutions(preapply_solutions,
+            ['Gain:Phase'], pol_list, station_names, fast_times, fast_timewidths,
+            final_freqs)
+        fast_phase_preapply = preapply_values[0]
+        total_phase = np.mod(fast_phase + tec_phase + slow_phase +
+            fast_phase_preapply + np.pi, 2*np.pi) - np.pi
+        covered = np.logical_and(covered, preapply_covered[0])
+
+        # Identify zero phase solutions and set the corresponding entries in total_phase and total_amp to NaN
+        total_phase = np.where(fast_phase_preapply == 0.0, np.nan, total_phase)
+        total_amp = np.where(fast_phase_preapply == 0.0, np.nan, total_amp)
+    else:
+        total_phase = np.mod(fast_phase + tec_phase + slow_phase + np.pi, 2*np.pi) - np.pi
+
+    # Identify zero phase solutions and set the corresponding entries in total_phase and total_amp to NaN
+    zero_phase = np.logical_or(fast_phase == 0.0, tec_phase == 0.0)
+    total_phase = np.where(zero_phase, np.nan, total_phase)
+    total_amp = np.where(zero_phase, np.nan, total_amp)
+
+    # Write values in one go, with one table per run of time slots in which
+    # the same stations are covered
+    values = np.array([total_amp, total_phase])
+    coverage = covered.reshape((-1, len(fast_times)))
+    changes = np.where(np.any(coverage[:, 1:] != coverage[:, :-1], axis=0))[0] + 1
+    run_starts = np.append([0], changes)
+    run_ends = np.append(changes, [len(fast_times)])
+    tables = []
+    for s, e in zip(run_starts, run_ends):
+        present = covered[:, :, s]
+        if not np.any(present):
+            continue
+        tables.append(SolutionTable(['Gain:Ampl', 'Gain:Phase'], pol_list,
+            station_names, fast_times[s:e], fast_timewidths[s:e], final_freqs,
+            final_freqwidths, values[:, :, :, s:e, :], np.array([present, present])))
+    write_solutions(Solutions(tables), output_file)
 
     # Copy output to original path and delete copies if scratch directory is specified
     if scratch_dir is not None:
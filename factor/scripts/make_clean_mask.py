@@ -15,7 +15,8 @@ import pickle
 import numpy as np
 import sys
 import os
-from factor.lib.polygon import Polygon
+from factor.lib.polygon import Polygon, rasterize
+from factor.lib.mask_cache import get_mask
 from factor.scripts import blank_image
 
 
@@ -276,7 +277,7 @@ def main(image_name, mask_name, atrous_do=False, threshisl=0.0, threshpix=0.0, r
          pad_to_size=None, skip_source_detection=False, region_file=None, nsig=1.0,
          reference_ra_deg=None, reference_dec_deg=None, cellsize_deg=0.000417,
          use_adaptive_threshold=False, make_blank_image=False, adaptive_thresh=150.0,
-         exclude_cal_region=False, dilate=0):
+         exclude_cal_region=False, dilate=0, mask_cache_size_mb=512.0):
     """
     Make a clean mask and return clean threshold
 
@@ -345,6 +346,9 @@ def main(image_name, mask_name, atrous_do=False, threshisl=0.0, threshpix=0.0, r
         exclude from the output mask
     dilate : int, optional
         Number of dilation iterations for PyBDSF mask
+    mask_cache_size_mb : float, optional
+        Maximum size in MB of the cache of facet masks (see
+        factor.lib.mask_cache.get_mask())
 
     Returns
     -------
@@ -411,6 +415,7 @@ def main(image_name, mask_name, atrous_do=False, threshisl=0.0, threshpix=0.0, r
             exclude_cal_region = False
 
     dilate = int(dilate)
+    mask_cache_size_mb = float(mask_cache_size_mb)
 
     if make_blank_image:
         print('Making empty template image...')
@@ -565,16 +570,12 @@ def main(image_name, mask_name, atrous_do=False, threshisl=0.0, threshpix=0.0, r
         if region_file is not None and region_file != '[]':
             # Merge the CASA regions with the mask
             casa_polys = read_casa_polys(region_file.strip('[]"'), new_mask)
-            for poly in casa_polys:
-                # Find unmasked regions
-                unmasked_ind = np.where(data[0, 0] == 0)
 
-                # Find distance to nearest poly edge and mask those that
-                # are inside the casa region (dist > 0)
-                dist = poly.is_inside(unmasked_ind[0], unmasked_ind[1])
-                inside_ind = np.where(dist > 0.0)
-                if len(inside_ind[0]) > 0:
-                    data[0, 0, unmasked_ind[0][inside_ind], unmasked_ind[1][inside_ind]] = 1
+            # Mask the pixels that are inside the casa regions (those on their
+            # edges are not masked)
+            if len(casa_polys) > 0:
+                inside = rasterize(casa_polys, data[0, 0].shape)
+                data[0, 0, inside] = 1
 
         if vertices_file is not None:
             # Modify the clean mask to exclude regions outside of the polygon
@@ -584,22 +585,20 @@ def main(image_name, mask_name, atrous_do=False, threshisl=0.0, threshpix=0.0, r
                 cal_vertices = read_vertices(vertices_file, cal_only=True)
                 cal_poly = vertices_to_poly(cal_vertices, new_mask)
 
-            # Find masked regions
-            masked_ind = np.where(data[0, 0])
-
-            # Find distance to nearest poly edge and unmask those that
-            # are outside the facet (dist < 0) and inside the calibrator region
-            # (cal_dist > 0)
-            dist = poly.is_inside(masked_ind[0], masked_ind[1])
-            outside_ind = np.where(dist < 0.0)
-            if len(outside_ind[0]) > 0:
-                data[0, 0, masked_ind[0][outside_ind], masked_ind[1][outside_ind]] = 0
+            # Unmask the pixels that are outside the facet (those on its edge
+            # are kept) and inside the calibrator region (those on its edge are
+            # kept). The facet mask is cached for later calls with the same
+            # facet and image geometry
+            mask_cache_dir = os.path.join(os.path.dirname(os.path.abspath(
+                vertices_file)), 'facet_masks')
             if exclude_cal_region:
-                masked_ind = np.where(data[0, 0])
-                cal_dist = cal_poly.is_inside(masked_ind[0], masked_ind[1])
-                inside_ind = np.where(cal_dist > 0.0)
-                if len(inside_ind[0]) > 0:
-                    data[0, 0, masked_ind[0][inside_ind], masked_ind[1][inside_ind]] = 0
+                facet_mask = get_mask(mask_cache_dir, [poly], data[0, 0].shape,
+                    holes=[cal_poly], include_sides=True,
+                    max_cache_size_mb=mask_cache_size_mb)
+            else:
+                facet_mask = get_mask(mask_cache_dir, [poly], data[0, 0].shape,
+                    include_sides=True, max_cache_size_mb=mask_cache_size_mb)
+            data[0, 0, ~facet_mask] = 0
 
         if trim_by > 0.0:
             sh = np.shape(data)
@@ -7,9 +7,10 @@ from argparse import RawTextHelpFormatter
 import os
 import casacore.tables as pt
 import shutil
-import lofar.parmdb as pdb
 import sys
+import multiprocessing
 import numpy as np
+from factor.lib.solutions import read_solutions, write_solutions, concatenate_solutions
 
 
 def main(input_mslist, parmdb_name, outparmdb, clobber=True, scratch_dir=None):
@@ -17,7 +18,9 @@ def main(input_mslist, parmdb_name, outparmdb, clobber=True, scratch_dir=None):
     Merges parmdbs in time into a single parmdb
 
     The parmdbs are assumed to be located in the input MS with name
-    parmdb_name
+    parmdb_name. The inputs are read in parallel, concatenated in time and
+    written in one go, so that each parameter is written once per regularly
+    spaced segment of the merged time axis
 
     Parameters
     ----------
@@ -30,7 +33,8 @@ def main(input_mslist, parmdb_name, outparmdb, clobber=True, scratch_dir=None):
     clobber : bool, optional
         If True, overwrite existing output file
     scratch_dir : str, optional
-        Scratch directory for temp storage
+        Scratch directory for temp storage. Inputs that are already on the
+        same filesystem are not copied to it
 
     """
     if type(input_mslist) is str:
@@ -51,40 +55,38 @@ def main(input_mslist, parmdb_name, outparmdb, clobber=True, scratch_dir=None):
             return
 
     # Copy to scratch directory if specified
+    scratch_copies = []
     if scratch_dir is not None:
-        inparmdbs_orig = inparmdbs
-        inparmdbs = [os.path.join(scratch_dir, os.path.basename(inp)+'_{}'.format(i))
-            for i, inp in enumerate(inparmdbs_orig)]
+        scratch_dev = os.stat(scratch_dir).st_dev
+        for i, inp in enumerate(inparmdbs):
+            if os.stat(inp).st_dev != scratch_dev:
+                scratch_copy = os.path.join(scratch_dir, os.path.basename(inp)+'_{}'.format(i))
+                shutil.copytree(inp, scratch_copy)
+                inparmdbs[i] = scratch_copy
+                scratch_copies.append(scratch_copy)
         outparmdb_orig = outparmdb
         outparmdb = os.path.join(scratch_dir, os.path.basename(outparmdb_orig))
-        for inp_orig, inp in zip(inparmdbs_orig, inparmdbs):
-            shutil.copytree(inp_orig, inp)
 
-    pdb_concat = pdb.parmdb(outparmdb, create=True)
+    # Read the inputs in parallel
+    if len(inparmdbs) > 1:
+        pool = multiprocessing.Pool(min(len(inparmdbs), multiprocessing.cpu_count()))
+        solutions_list = pool.map(read_solutions, inparmdbs)
+        pool.close()
+        pool.join()
+    else:
+        solutions_list = [read_solutions(inp) for inp in inparmdbs]
+    solutions = concatenate_solutions(solutions_list)
 
-    for i, inparmdb in enumerate(inparmdbs):
-        pdb_add = pdb.parmdb(inparmdb)
-        parms = pdb_add.getValuesGrid('*')
-        for parmname in pdb_add.getNames():
-            flagged = np.where(np.logical_or(parms[parmname]['values'] == 0.0,
-                np.isnan(parms[parmname]['values'])))
-            parms[parmname]['values'][flagged] = np.nan
-            ValueHolder = pdb_concat.makeValue(values=parms[parmname]['values'],
-                                               sfreq=parms[parmname]['freqs'],
-                                               efreq=parms[parmname]['freqwidths'],
-                                               stime=parms[parmname]['times'],
-                                               etime=parms[parmname]['timewidths'],
-                                               asStartEnd=False)
-            pdb_concat.addValues(parmname, ValueHolder)
-        pdb_concat.flush()
-        pdb_add = False
-    pdb_concat = False
+    # Set flagged solutions to NaN
+    for table in solutions.tables:
+        table.values[table.values == 0.0] = np.nan
+    write_solutions(solutions, outparmdb)
 
     # Copy output to original path and delete copies if scratch directory is specified
     if scratch_dir is not None:
         shutil.copytree(outparmdb, outparmdb_orig)
         shutil.rmtree(outparmdb)
-        for inp in inparmdbs:
+        for inp in scratch_copies:
             shutil.rmtree(inp)
 
 
@@ -5,10 +5,10 @@ Script to merge selfcal parmdbs
 import argparse
 from argparse import RawTextHelpFormatter
 import os
-import lofar.parmdb as pdb
 import casacore.tables as pt
 import shutil
 import numpy as np
+from factor.lib.solutions import read_solutions, write_solutions
 
 
 def main(parmdb_p, parmdb_a, parmdb_out, clobber=True, scratch_dir=None):
@@ -55,23 +55,11 @@ def main(parmdb_p, parmdb_a, parmdb_out, clobber=True, scratch_dir=None):
     shutil.copytree(parmdb_p, parmdb_out)
 
     ## Copy over the Gains
-    pdb_out = pdb.parmdb(parmdb_out)
-    pdb_a = pdb.parmdb(parmdb_a)
-    parms = pdb_a.getValuesGrid('*')
-    for parmname in pdb_a.getNames():
+    solutions = read_solutions(parmdb_a)
+    for table in solutions.tables:
         # Set flagged solutions to NaN
-        flagged = np.where(np.logical_or(parms[parmname]['values'] == 0.0,
-            np.isnan(parms[parmname]['values'])))
-        parms[parmname]['values'][flagged] = np.nan
-        ValueHolder = pdb_out.makeValue(values=parms[parmname]['values'],
-                                        sfreq=parms[parmname]['freqs'],
-                                        efreq=parms[parmname]['freqwidths'],
-                                        stime=parms[parmname]['times'],
-                                        etime=parms[parmname]['timewidths'],
-                                        asStartEnd=False)
-
-        pdb_out.addValues(parmname,ValueHolder)
-    pdb_out.flush()
+        table.values[table.values == 0.0] = np.nan
+    write_solutions(solutions, parmdb_out, create=False)
 
     # Copy output to original path and delete copies if scratch directory is specified
     if scratch_dir is not None:
@@ -2,7 +2,7 @@
 """
 Script to apply a primary-beam correction to a mosaic image
 """
-import lofar.parmdb as lp
+from factor.lib.solutions import read_solutions
 import numpy as np
 import sys, os
 import matplotlib as mpl
@@ -55,10 +55,9 @@ def scaletimes(t):
     return t
 
 
-def solplot_scalarphase(parmdb, imageroot, refstationi, plot_international=False):
-    parmdbmtable = lp.parmdb(parmdb)
-    soldict = parmdbmtable.getValuesGrid('*')
-    names = parmdbmtable.getNames()
+def solplot_scalarphase(solutions, imageroot, refstationi, plot_international=False):
+    soldict = solutions.get_parms()
+    names = solutions.get_names()
 
     'Gain:1:1:Phase:RS508HBA'
     stationsnames = np.array([name.split(':')[-1] for name in names])
@@ -99,15 +98,13 @@ def solplot_scalarphase(parmdb, imageroot, refstationi, plot_international=False
 
         f.savefig(imageroot+"_scalarphase_channel{}.png".format(chan_indx),dpi=100)
         plt.close(f)
-    parmdbmtable = False
     del(soldict)
 
 
-def solplot_tec(parmdb, imageroot, refstationi, plot_international=False, freq=None):
-    parmdbmtable = lp.parmdb(parmdb)
-    soldict = parmdbmtable.getValuesGrid('*')
+def solplot_tec(solutions, imageroot, refstationi, plot_international=False, freq=None):
+    soldict = solutions.get_parms()
 
-    names = parmdbmtable.getNames()
+    names = solutions.get_names()
     stationsnames = np.array([name.split(':')[-1] for name in names])
     stationsnames = np.unique(stationsnames)
     if not plot_international:
@@ -166,15 +163,13 @@ def solplot_tec(parmdb, imageroot, refstationi, plot_international=False, freq=N
             f.savefig(imageroot+"_tec_channel{0}{1}.png".format(chan_indx, infix),dpi=100)
             plt.close(f)
         g_start = g
-    parmdbmtable = False
     del(soldict)
 
 
-def solplot_tec_scalarphase(parmdb, imageroot, refstationi, plot_international=False, freq=None):
-    parmdbmtable = lp.parmdb(parmdb)
-    soldict = parmdbmtable.getValuesGrid('*')
+def solplot_tec_scalarphase(solutions, imageroot, refstationi, plot_international=False, freq=None):
+    soldict = solutions.get_parms()
 
-    names = parmdbmtable.getNames()
+    names = solutions.get_names()
     stationsnames = np.array([name.split(':')[-1] for name in names])
     stationsnames = np.unique(stationsnames)
     if not plot_international:
@@ -242,14 +237,12 @@ def solplot_tec_scalarphase(parmdb, imageroot, refstationi, plot_international=F
             f.savefig(imageroot+"_tec_scalarphase_channel{0}{1}.png".format(chan_indx, infix),dpi=100)
             plt.close(f)
         g_start = g
-    parmdbmtable = False
     del(soldict)
 
 
-def solplot_clock(parmdb, imageroot, refstationi, plot_international=False):
-    parmdbmtable = lp.parmdb(parmdb)
-    soldict = parmdbmtable.getValuesGrid('*')
-    names = parmdbmtable.getNames()
+def solplot_clock(solutions, imageroot, refstationi, plot_international=False):
+    soldict = solutions.get_parms()
+    names = solutions.get_names()
 
     'Gain:1:1:Phase:RS508HBA'
     stationsnames = np.array([name.split(':')[-1] for name in names])
@@ -291,13 +284,11 @@ def solplot_clock(parmdb, imageroot, refstationi, plot_international=False):
 
     f.savefig(imageroot+"_clock.png",dpi=100)
     plt.close(f)
-    parmdbmtable = False
     del(soldict)
 
-def solplot_phase_phasors(parmdb, imageroot, refstationi, plot_international=False, fourpol=False):
-    parmdbmtable = lp.parmdb(parmdb)
-    soldict = parmdbmtable.getValuesGrid('*')
-    names = parmdbmtable.getNames()
+def solplot_phase_phasors(solutions, imageroot, refstationi, plot_international=False, fourpol=False):
+    soldict = solutions.get_parms()
+    names = solutions.get_names()
 
     'Gain:1:1:Phase:RS508HBA'
     stationsnames = np.array([name.split(':')[-1] for name in names])
@@ -362,16 +353,14 @@ def solplot_phase_phasors(parmdb, imageroot, refstationi, plot_international=Fal
 
         f.savefig(imageroot+"_phase_channel{}.png".format(chan_indx),dpi=100)
         plt.close(f)
-    parmdbmtable = False
     del(soldict)
 
 
-def solplot_phase(parmdb, imageroot, refstationi, norm_amp_lim=False, median_amp=False, plot_international=False, fourpol=False):
+def solplot_phase(solutions, imageroot, refstationi, norm_amp_lim=False, median_amp=False, plot_international=False, fourpol=False):
 
-    parmdbmtable = lp.parmdb(parmdb)
 
-    soldict = parmdbmtable.getValuesGrid('*')
-    names = parmdbmtable.getNames()
+    soldict = solutions.get_parms()
+    names = solutions.get_names()
 
     'Gain:1:1:Phase:RS508HBA'
     stationsnames = np.array([name.split(':')[-1] for name in names])
@@ -495,15 +484,13 @@ def solplot_phase(parmdb, imageroot, refstationi, norm_amp_lim=False, median_amp
             fp.savefig(imageroot+"_phase_channel{0}{1}.png".format(chan_indx, infix),dpi=100)
             plt.close(fp)
         g_start = g
-    parmdbmtable = False
     del(soldict)
 
 
-def solplot_amp(parmdb, imageroot, refstationi, norm_amp_lim=False, median_amp=False, plot_international=False, fourpol=False):
+def solplot_amp(solutions, imageroot, refstationi, norm_amp_lim=False, median_amp=False, plot_international=False, fourpol=False):
 
-    parmdbmtable = lp.parmdb(parmdb)
-    soldict = parmdbmtable.getValuesGrid('*')
-    names = parmdbmtable.getNames()
+    soldict = solutions.get_parms()
+    names = solutions.get_names()
 
     'Gain:1:1:Phase:RS508HBA'
     stationsnames = np.array([name.split(':')[-1] for name in names])
@@ -667,7 +654,6 @@ def solplot_amp(parmdb, imageroot, refstationi, norm_amp_lim=False, median_amp=F
             fa.savefig(imageroot+"_amp_channel{0}{1}.png".format(chan_indx, infix),dpi=100)
             plt.close(fa)
         g_start = g
-    parmdbmtable = False
     del(soldict)
 
 
@@ -696,26 +682,29 @@ def main(parmdb, imageroot, freq=150.0, plot_tec=True, plot_tec_scalarphase=True
     plot_international = input2bool(plot_international)
     fourpol = input2bool(fourpol)
 
+    # Read the parmdb once for all plots
+    solutions = read_solutions(parmdb)
+
     if plot_scalarphase:
-        solplot_scalarphase(parmdb, imageroot, refstation, plot_international=plot_international)
+        solplot_scalarphase(solutions, imageroot, refstation, plot_international=plot_international)
 
     if plot_phase:
         if phasors:
-            solplot_phase_phasors(parmdb, imageroot, refstation, plot_international=plot_international)
+            solplot_phase_phasors(solutions, imageroot, refstation, plot_international=plot_international)
         else:
-            solplot_phase(parmdb, imageroot, refstation, plot_international=plot_international, fourpol=fourpol)
+            solplot_phase(solutions, imageroot, refstation, plot_international=plot_international, fourpol=fourpol)
 
     if plot_amp:
-        solplot_amp(parmdb, imageroot, refstation, norm_amp_lim=norm_amp_lim, median_amp=median_amp, plot_international=plot_international, fourpol=fourpol)
+        solplot_amp(solutions, imageroot, refstation, norm_amp_lim=norm_amp_lim, median_amp=median_amp, plot_international=plot_international, fourpol=fourpol)
 
     if plot_tec:
-        solplot_tec(parmdb, imageroot, refstation, plot_international=plot_international, freq=reffreq)
+        solplot_tec(solutions, imageroot, refstation, plot_international=plot_international, freq=reffreq)
 
     if plot_tec_scalarphase:
-        solplot_tec_scalarphase(parmdb, imageroot, refstation, plot_international=plot_international, freq=reffreq)
+        solplot_tec_scalarphase(solutions, imageroot, refstation, plot_international=plot_international, freq=reffreq)
 
     if plot_clock:
-        solplot_clock(parmdb, imageroot, refstation, plot_international=plot_international)
+        solplot_clock(solutions, imageroot, refstation, plot_international=plot_international)
 
 
 if __name__ == "__main__":
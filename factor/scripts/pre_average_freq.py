@@ -11,7 +11,7 @@ from scipy.ndimage.filters import gaussian_filter1d as gfilter
 from scipy.special import erf
 import casacore.tables as pt
 import pickle
-import itertools
+from factor.lib.baselines import BaselineIndex
 
 
 def main(ms_input, input_colname, output_data_colname, output_weights_colname,
@@ -72,16 +72,18 @@ def main(ms_input, input_colname, output_data_colname, output_weights_colname,
     # Weight data and set bad data to 0 so nans do not propagate
     data_all = np.nan_to_num(data_all*weights_all)
 
+    # Sort the rows by baseline, so that the rows of each baseline form a
+    # contiguous block
+    bl_index = BaselineIndex(ant1_list, ant2_list)
+    data_sorted = bl_index.sort(data_all)
+    weights_sorted = bl_index.sort(weights_all)
+
     # Iteration on baseline combination
-    for ant in itertools.product(set(ant1_list), set(ant2_list)):
+    for ant, bl_slice in zip(bl_index.baselines, bl_index.slices):
         if ant[0] >= ant[1]:
             continue
-        sel1 = np.where(ant1_list == ant[0])[0]
-        sel2 = np.where(ant2_list == ant[1])[0]
-        sel_list = sorted(list(frozenset(sel1).intersection(sel2)))
-
-        data = data_all[sel_list,:,:]
-        weights = weights_all[sel_list,:,:]
+        data = data_sorted[bl_slice]
+        weights = weights_sorted[bl_slice]
 
         # compute the Gaussian sigma from the max bandwidth over which we
         # can average and avoid significant bandwidth smearing but limited to
@@ -101,8 +103,13 @@ def main(ms_input, input_colname, output_data_colname, output_weights_colname,
         # re-create data
         data = (dataR + 1j * dataI)
         data[(weights != 0)] /= weights[(weights != 0)] # avoid divbyzero
-        data_all[sel_list,:,:] = data
-        weights_all[sel_list,:,:] = weights
+        data_sorted[bl_slice] = data
+        weights_sorted[bl_slice] = weights
+
+    # Put the rows back in MS order
+    bl_index.unsort(data_sorted, out=data_all)
+    bl_index.unsort(weights_sorted, out=weights_all)
+    del data_sorted, weights_sorted
 
     # Add the output columns if needed
     if output_data_colname not in ms.colnames():
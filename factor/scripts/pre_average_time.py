@@ -8,16 +8,19 @@ import numpy as np
 import glob
 import sys
 import os
-import itertools
+import logging
 import pickle
 from scipy.ndimage.filters import gaussian_filter1d as gfilter
 import casacore.tables as pt
-import lofar.parmdb
 from astropy.stats import median_absolute_deviation
+from factor.lib.baselines import BaselineIndex
+from factor.lib.solutions import read_solutions
 
 
 def main(ms_input, parmdb_input, input_colname, output_data_colname, output_weights_colname,
-    target_rms_rad, baseline_file, minutes_per_block=10.0, verbose=True):
+    target_rms_rad, baseline_file, minutes_per_block=10.0, verbose=True,
+    max_memory_mb=0, solution_cache_dir=None, solution_cache_size_mb=2048.0,
+    stddev_bucket_width=0.0):
     """
     Pre-average data using a sliding Gaussian kernel in time
 
@@ -38,6 +41,24 @@ def main(ms_input, parmdb_input, input_colname, output_data_colname, output_weig
         The target RMS for the phase noise in the input parmDBs. (Or whatever???)
     baseline_file : str
         Filename of pickled baseline lengths
+    minutes_per_block : float, optional
+        Length in minutes of the time blocks used to find the ionfactor
+    verbose : bool, optional
+        If True, print progress messages
+    max_memory_mb : float (str), optional
+        Maximum memory in MB to use for the averaging. If > 0, the data are
+        processed a few baselines at a time to stay below this limit.
+        Otherwise, all data of a group of MSs are read at once
+    solution_cache_dir : str, optional
+        Directory in which the solutions of the parmdbs are cached, as they
+        are read by the pre-averaging of each direction. If None, the parmdbs
+        are read directly
+    solution_cache_size_mb : float (str), optional
+        Maximum size in MB of the solution cache
+    stddev_bucket_width : float (str), optional
+        Fractional width of the buckets of kernel widths within which
+        baselines are smoothed together with a common width. If 0, each
+        baseline is smoothed with its exact width
 
     """
 
@@ -50,6 +71,14 @@ def main(ms_input, parmdb_input, input_colname, output_data_colname, output_weig
 
     if type(target_rms_rad) is str:
         target_rms_rad = float(target_rms_rad)
+    if type(max_memory_mb) is str:
+        max_memory_mb = float(max_memory_mb)
+    if solution_cache_dir == 'None':
+        solution_cache_dir = None
+    if type(solution_cache_size_mb) is str:
+        solution_cache_size_mb = float(solution_cache_size_mb)
+    if type(stddev_bucket_width) is str:
+        stddev_bucket_width = float(stddev_bucket_width)
     if os.path.exists(baseline_file):
         f = open(baseline_file, 'r')
         baseline_dict = pickle.load(f)
@@ -62,6 +91,7 @@ def main(ms_input, parmdb_input, input_colname, output_data_colname, output_weig
     start_times = []
     end_times = []
     ionfactors = []
+    parmdb_cache = {}
     if verbose:
         print('Determining ionfactors...')
     for msind in xrange(len(ms_list)):
@@ -82,7 +112,10 @@ def main(ms_input, parmdb_input, input_colname, output_data_colname, output_weig
 
             # Find ionfactor for this period
             ionfactors.append(find_ionfactor(parmdb_list[msind], baseline_dict, t1+start_time,
-                                             t1+start_time+t_delta, target_rms_rad=target_rms_rad))
+                                             t1+start_time+t_delta, target_rms_rad=target_rms_rad,
+                                             parmdb_cache=parmdb_cache,
+                                             solution_cache_dir=solution_cache_dir,
+                                             solution_cache_size_mb=solution_cache_size_mb))
             if verbose:
                 print('    ionfactor (for timerange {0}-{1} sec) = {2}'.format(t1,
                       t1+t_delta, ionfactors[-1]))
@@ -99,18 +132,62 @@ def main(ms_input, parmdb_input, input_colname, output_data_colname, output_weig
         print('Using ionfactor = {}'.format(ionfactor_min))
         print('Averaging...')
     BLavg_multi(sorted_ms_dict, baseline_dict, input_colname, output_data_colname,
-        output_weights_colname, ionfactor_min)
+        output_weights_colname, ionfactor_min, max_memory_mb=max_memory_mb,
+        stddev_bucket_width=stddev_bucket_width)
 
 
-def find_ionfactor(parmdb_file, baseline_dict, t1, t2, target_rms_rad=0.2):
+def read_parmdb(parmdb_file, parmdb_cache=None, solution_cache_dir=None,
+    solution_cache_size_mb=2048.0):
+    """
+    Returns the values and station names of a parmdb
+
+    Parameters
+    ----------
+    parmdb_file : str
+        Filename of parmdb
+    parmdb_cache : dict, optional
+        Cache of parmdbs already read, keyed by filename. If given, the parmdb
+        is read only if it is not in the cache, and is then added to it
+    solution_cache_dir : str, optional
+        Directory of the on-disk solution cache (see
+        factor.lib.solutions.read_solutions()). If None, it is not used
+    solution_cache_size_mb : float, optional
+        Maximum size in MB of the on-disk solution cache
+
+    Returns
+    -------
+    parms : dict
+        Values of all parameters, in the form returned by getValuesGrid('*')
+        (see factor.lib.solutions.Solutions.get_parms())
+    stations : set of str
+        Names of the stations in the parmdb
+
+    """
+    if parmdb_cache is not None and parmdb_file in parmdb_cache:
+        return parmdb_cache[parmdb_file]
+
+    solutions = read_solutions(parmdb_file, cache_dir=solution_cache_dir,
+        max_cache_size_mb=solution_cache_size_mb)
+    parms = solutions.get_parms()
+    stations = set(solutions.get_stations())
+    if parmdb_cache is not None:
+        parmdb_cache[parmdb_file] = (parms, stations)
+
+    return parms, stations
+
+
+def find_ionfactor(parmdb_file, baseline_dict, t1, t2, target_rms_rad=0.2,
+    parmdb_cache=None, solution_cache_dir=None, solution_cache_size_mb=2048.0):
     """
     Finds ionospheric scaling factor
+
+    The parmdb is read with read_parmdb(), so that it is read only once when a
+    cache is given
     """
-    pdb_in = lofar.parmdb.parmdb(parmdb_file)
-    parms = pdb_in.getValuesGrid('*')
+    parms, stations_pbd = read_parmdb(parmdb_file, parmdb_cache,
+        solution_cache_dir, solution_cache_size_mb)
 
     # Filter any stations not in both the instrument table and the ms
-    stations_pbd = set([s.split(':')[-1] for s in pdb_in.getNames()])
     stations_ms = set([s for s in baseline_dict.itervalues() if type(s) is str])
     stations = sorted(list(stations_pbd.intersection(stations_ms)))
 
@@ -131,8 +208,8 @@ def find_ionfactor(parmdb_file, baseline_dict, t1, t2, target_rms_rad=0.2):
                     ant2.append(s2_name)
                     dist.append(v)
 
-    # Find correlation times
-    rmstimes = []
+    # Find the unwrapped phase differences of the baselines
+    ph_list = []
     dists = []
     freq = None
     for a1, a2, d in zip(ant1, ant2, dist):
@@ -141,31 +218,20 @@ def find_ionfactor(parmdb_file, baseline_dict, t1, t2, target_rms_rad=0.2):
             times = np.copy(parms['Gain:0:0:Phase:{}'.format(a1)]['times'])
             time_ind = np.where((times >= t1) & (times < t2))[0]
             timepersolution = np.copy(parms['Gain:0:0:Phase:{}'.format(a1)]['timewidths'])[0]
-        ph1 = np.copy(parms['Gain:0:0:Phase:{}'.format(a1)]['values'])[time_ind]
-        ph2 = np.copy(parms['Gain:0:0:Phase:{}'.format(a2)]['values'])[time_ind]
+        ph1 = parms['Gain:0:0:Phase:{}'.format(a1)]['values'][time_ind]
+        ph2 = parms['Gain:0:0:Phase:{}'.format(a2)]['values'][time_ind]
 
         # Filter flagged solutions
         good = np.where((~np.isnan(ph1)) & (~np.isnan(ph2)))[0]
         if len(good) == 0:
             continue
 
-        rmstime = None
-        ph = unwrap_fft(ph2[good] - ph1[good])
-
-        step = 1
-        for i in range(1, len(ph)/2, step):
-            p1 = ph[i:]
-            p2 = ph[:-i]
-            rms = np.linalg.norm(p1-p2) / np.sqrt(len(p1))
-            mean = np.mean(p1-p2)
-            if rms + mean > target_rms_rad:
-                rmstime = i
-                break
-        if rmstime is None:
-            rmstime = len(ph)/2
-        rmstimes.append(rmstime)
+        ph_list.append(unwrap_fft(ph2[good] - ph1[good]))
         dists.append(d)
 
+    # Find correlation times
+    rmstimes = get_correlation_times(ph_list, target_rms_rad)
+
     # Find the mean ionfactor assuming that the correlation time goes as
     # t_corr ~ 1/sqrt(BL). The ionfactor is defined in BLavg() as:
     #
@@ -177,11 +243,89 @@ def find_ionfactor(parmdb_file, baseline_dict, t1, t2, target_rms_rad=0.2):
     return ionfactor
 
 
+def get_correlation_times(ph_list, target_rms_rad, max_elements=10000000):
+    """
+    Returns the correlation times of a number of phase series
+
+    The correlation time of a series is the smallest lag (in samples) at which
+    the rms plus the mean of the phase differences over that lag exceeds
+    target_rms_rad, or half the length of the series if there is no such lag.
+    The phase structure function is computed for all lags and series at once
+    (in blocks of series of at most max_elements differences)
+
+    Parameters
+    ----------
+    ph_list : list of arrays
+        Phase series, each with time along the first axis and frequency along
+        the second
+    target_rms_rad : float
+        Target rms in rad
+    max_elements : int, optional
+        Maximum number of phase differences computed at once
+
+    Returns
+    -------
+    rmstimes : list of int
+        Correlation time of each series in samples
+
+    """
+    rmstimes = [len(ph)//2 for ph in ph_list]
+    if len(ph_list) == 0:
+        return rmstimes
+    nfreqs = ph_list[0].shape[1]
+    nmax = max([len(ph) for ph in ph_list])
+    nlags = nmax//2 - 1
+    if nlags < 1:
+        return rmstimes
+
+    # Indices of the samples k + i and k for lag i (along axis 0) and sample k
+    # (along axis 1), with those past the end of the series pointing to a
+    # padding value of zero
+    lags = np.arange(1, nlags+1)[:, np.newaxis]
+    samples = np.arange(nmax)[np.newaxis, :]
+    ind_later = np.minimum(samples + lags, nmax)
+
+    block_size = max(1, int(max_elements / (nlags * nmax * nfreqs)))
+    for b in xrange(0, len(ph_list), block_size):
+        block = ph_list[b:b+block_size]
+        nsamples = np.array([len(ph) for ph in block])
+        padded = np.zeros((len(block), nmax+1, nfreqs))
+        for j, ph in enumerate(block):
+            padded[j, :len(ph)] = ph
+
+        # Differences p1 - p2 = ph[k+i] - ph[k] for all series, lags and
+        # samples, with shape (nseries, nlags, nsamples, nfreqs)
+        diff = padded[:, ind_later, :] - padded[:, np.newaxis, :nmax, :]
+        npairs = nsamples[:, np.newaxis] - lags.T
+        valid = (samples[np.newaxis, :, :] < npairs[:, :, np.newaxis])
+        diff *= valid[:, :, :, np.newaxis]
+        # Only lags below half the length of each series are searched
+        searched = lags.T < nsamples[:, np.newaxis]//2
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rms = np.sqrt(np.sum(diff**2, axis=(2, 3))) / np.sqrt(npairs)
+            mean = np.sum(diff, axis=(2, 3)) / (npairs * nfreqs)
+            exceeded = (rms + mean > target_rms_rad) & searched
+        for j in np.where(np.any(exceeded, axis=1))[0]:
+            rmstimes[b+j] = int(np.argmax(exceeded[j])) + 1
+
+    return rmstimes
+
+
 def BLavg_multi(sorted_ms_dict, baseline_dict, input_colname, output_data_colname,
         output_weights_colname, ionfactor, clobber=True, maxgap_sec=1800,
-        check_files = True):
+        check_files = True, max_memory_mb=0, stddev_bucket_width=0.0):
     """
     Averages data using a sliding Gaussian kernel on the weights
+
+    If max_memory_mb > 0, the data of each group of MSs are processed a few
+    baselines at a time (see BLavg_group_streaming()), so that the memory used
+    stays below roughly max_memory_mb. Otherwise, all data of a group are read
+    at once
+
+    Baselines whose kernel widths agree to within a fraction
+    stddev_bucket_width are smoothed together with a common width (see
+    average_baselines()). By default (stddev_bucket_width = 0), each baseline
+    is smoothed with its exact width
     """
 
     #### sort msnames into groups with gaps < maxgap_sec
@@ -205,12 +349,6 @@ def BLavg_multi(sorted_ms_dict, baseline_dict, input_colname, output_data_colnam
         freq = freqtab.getcell('REF_FREQUENCY',0)
         freqtab.close()
         timepersample = None
-        ant1_list        = []
-        ant2_list        = []
-        all_time_list    = []
-        all_data_list    = []
-        all_weights_list = []
-        all_flags_list   = []
         for msfile in ms_names:
             if not os.path.exists(msfile):
                 print("Cannot find MS file: {0}.".format(msfile))
@@ -230,98 +368,360 @@ def BLavg_multi(sorted_ms_dict, baseline_dict, input_colname, output_data_colnam
                 if timepersample != ms.getcell('INTERVAL',0):
                     print("Different INTERVALs: {0} and: {1} in {2}.".format(timepersample,ms.getcell('INTERVAL',0),msfile))
                     sys.exit(1)
-            all_time_list.append( ms.getcol('TIME_CENTROID') )
-            ant1_list.append( ms.getcol('ANTENNA1') )
-            ant2_list.append( ms.getcol('ANTENNA2') )
-            all_data_list.append( ms.getcol(input_colname) )
-            all_weights_list.append( ms.getcol('WEIGHT_SPECTRUM') )
-            all_flags_list.append( ms.getcol('FLAG') )
+            ms.close()
 
-            all_flags_list[-1][ np.isnan(all_data_list[-1]) ] = True # flag NaNs
-            all_weights_list[-1] = all_weights_list[-1] * ~all_flags_list[-1] # set weight of flagged data to 0
+        if max_memory_mb > 0:
+            BLavg_group_streaming(ms_names, baseline_dict, input_colname,
+                output_data_colname, output_weights_colname, ionfactor, freq,
+                timepersample, max_memory_mb, stddev_bucket_width)
+        else:
+            BLavg_group(ms_names, baseline_dict, input_colname,
+                output_data_colname, output_weights_colname, ionfactor, freq,
+                timepersample, stddev_bucket_width)
+        print "BLavg_multi: Finished one group of measurement sets."
+
+
+def BLavg_group(ms_names, baseline_dict, input_colname, output_data_colname,
+        output_weights_colname, ionfactor, freq, timepersample, stddev_bucket_width):
+    """
+    Averages the data of a group of MSs, reading all of them at once
+    """
+    ant1_list        = []
+    ant2_list        = []
+    all_time_list    = []
+    all_data_list    = []
+    all_weights_list = []
+    all_flags_list   = []
+    for msfile in ms_names:
+        ms = pt.table(msfile, readonly=True, ack=False)
+        all_time_list.append( ms.getcol('TIME_CENTROID') )
+        ant1_list.append( ms.getcol('ANTENNA1') )
+        ant2_list.append( ms.getcol('ANTENNA2') )
+        all_data_list.append( ms.getcol(input_colname) )
+        all_weights_list.append( ms.getcol('WEIGHT_SPECTRUM') )
+        all_flags_list.append( ms.getcol('FLAG') )
+        ms.close()
+
+        all_flags_list[-1][ np.isnan(all_data_list[-1]) ] = True # flag NaNs
+        all_weights_list[-1] = all_weights_list[-1] * ~all_flags_list[-1] # set weight of flagged data to 0
+
+        # Check that all NaNs are flagged
+        if np.count_nonzero(np.isnan(all_data_list[-1][~all_flags_list[-1]])) > 0:
+            logging.error('NaNs in unflagged data in {0}!'.format(msfile))
+            sys.exit(1)
+
+    ### sort the rows of each MS by baseline, so that the rows of each
+    ### baseline form a contiguous block
+    bl_index_list = []
+    for msindex in xrange(len(ms_names)):
+        bl_index = BaselineIndex(ant1_list[msindex], ant2_list[msindex])
+        all_data_list[msindex] = bl_index.sort(all_data_list[msindex])
+        all_weights_list[msindex] = bl_index.sort(all_weights_list[msindex])
+        bl_index_list.append(bl_index)
+    nfill_list = get_gap_lengths(all_time_list, timepersample)
+
+    ### average the baselines (positions of their rows are in the sorted arrays)
+    ant_list = [ant for ant in bl_index_list[0].baselines if ant[0] < ant[1]]
+    pos_lists = []
+    for ant in ant_list:
+        pos_list = []
+        for bl_index in bl_index_list:
+            bl_slice = bl_index.get_slice(ant[0], ant[1])
+            pos_list.append(np.arange(bl_slice.start, bl_slice.stop))
+        pos_lists.append(pos_list)
+    stddevs = [get_stddev(baseline_dict['{0}-{1}'.format(ant[0], ant[1])],
+        ionfactor, freq, timepersample) for ant in ant_list]
+    average_baselines(all_data_list, all_weights_list, pos_lists, stddevs,
+        nfill_list, stddev_bucket_width)
+
+    ### write the data back to the files (in MS row order)
+    for msindex in xrange(len(ms_names)):
+        all_data_list[msindex] = bl_index_list[msindex].unsort(all_data_list[msindex])
+        all_weights_list[msindex] = bl_index_list[msindex].unsort(all_weights_list[msindex])
+        ms = pt.table(ms_names[msindex], readonly=False, ack=False)
+        add_output_columns(ms, input_colname, output_data_colname, output_weights_colname)
+        ms.putcol(output_data_colname, all_data_list[msindex])
+        ms.putcol('FLAG', all_flags_list[msindex]) # this saves flags of nans, which is always good
+        ms.putcol(output_weights_colname, all_weights_list[msindex])
+        ms.close()
+
+
+def BLavg_group_streaming(ms_names, baseline_dict, input_colname, output_data_colname,
+        output_weights_colname, ionfactor, freq, timepersample, max_memory_mb,
+        stddev_bucket_width):
+    """
+    Averages the data of a group of MSs, a few baselines at a time
+
+    Only the antenna and time columns are read for all rows. The baselines are
+    then processed in batches that are as large as possible while keeping the
+    estimated memory use below max_memory_mb: the rows of the baselines of a
+    batch are read from all MSs, averaged and written straight back. The
+    baselines are ordered by kernel width, so that those that are smoothed
+    together (see average_baselines()) tend to fall in the same batch
+    """
+    ms_list = []
+    bl_index_list = []
+    all_time_list = []
+    for msfile in ms_names:
+        ms = pt.table(msfile, readonly=False, ack=False)
+        add_output_columns(ms, input_colname, output_data_colname, output_weights_colname)
+        all_time_list.append( ms.getcol('TIME_CENTROID') )
+        bl_index_list.append( BaselineIndex(ms.getcol('ANTENNA1'), ms.getcol('ANTENNA2')) )
+        ms_list.append(ms)
+    nfill_list = get_gap_lengths(all_time_list, timepersample)
+    del all_time_list
+
+    # Estimate the memory needed per row read (the data, weights and flags as
+    # read) and per padded row averaged (the double-precision arrays used in
+    # the averaging)
+    nelements = np.prod(ms_list[0].getcell(input_colname, 0).shape)
+    batch_bytes_per_row = 13.0 * nelements
+    baseline_bytes_per_row = 64.0 * nelements
+    max_bytes = max_memory_mb * 1024.0 * 1024.0
+
+    # Only baselines of the first MS are averaged, but the rows of all
+    # baselines are processed, as their NaNs must be flagged and the output
+    # columns filled
+    averaged_baselines = set([ant for ant in bl_index_list[0].baselines if ant[0] < ant[1]])
+    all_baselines = set([ant for bl_index in bl_index_list for ant in
+        bl_index.baselines])
+    stddev_dict = {}
+    for ant in averaged_baselines:
+        stddev_dict[ant] = get_stddev(baseline_dict['{0}-{1}'.format(ant[0], ant[1])],
+            ionfactor, freq, timepersample)
+    all_baselines = sorted(all_baselines, key=lambda ant: (stddev_dict.get(ant, 0.0), ant))
+    nrows = []
+    for ant in all_baselines:
+        nrows.append([len(bl_index.get_rows(ant[0], ant[1])) for bl_index in bl_index_list])
+    nrows = np.array(nrows)
+    padded_nrows = np.sum(nrows, axis=1) + sum(nfill_list)
+
+    batches = []
+    batch = []
+    batch_rows = 0
+    batch_padded_rows = 0
+    for i, ant in enumerate(all_baselines):
+        new_rows = batch_rows + np.sum(nrows[i])
+        new_padded_rows = batch_padded_rows + padded_nrows[i]
+        if (len(batch) > 0 and batch_bytes_per_row * new_rows +
+            baseline_bytes_per_row * new_padded_rows > max_bytes):
+            batches.append(batch)
+            batch = []
+            new_rows = np.sum(nrows[i])
+            new_padded_rows = padded_nrows[i]
+        batch.append(ant)
+        batch_rows = new_rows
+        batch_padded_rows = new_padded_rows
+    if len(batch) > 0:
+        batches.append(batch)
+
+    for batch in batches:
+        # Read the rows of the baselines of this batch from all MSs
+        sel_tab_list = []
+        rows_list = []
+        data_list = []
+        weights_list = []
+        flags_list = []
+        for msindex in xrange(len(ms_names)):
+            rows = np.sort(np.concatenate([bl_index_list[msindex].get_rows(ant[0], ant[1])
+                for ant in batch]))
+            sel_tab = ms_list[msindex].selectrows(rows)
+            data = sel_tab.getcol(input_colname)
+            weights = sel_tab.getcol('WEIGHT_SPECTRUM')
+            flags = sel_tab.getcol('FLAG')
+            flags[ np.isnan(data) ] = True # flag NaNs
+            weights = weights * ~flags # set weight of flagged data to 0
 
             # Check that all NaNs are flagged
-            if np.count_nonzero(np.isnan(all_data_list[-1][~all_flags_list[-1]])) > 0:
-                logging.error('NaNs in unflagged data in {0}!'.format(msfile))
+            if np.count_nonzero(np.isnan(data[~flags])) > 0:
+                logging.error('NaNs in unflagged data in {0}!'.format(ms_names[msindex]))
                 sys.exit(1)
-
-        ### iteration on baseline combination
-        for ant in itertools.product(set(ant1_list[0]), set(ant2_list[0])):
-            if ant[0] >= ant[1]:
-                continue
-            sel_list = []
-            weights_list = []
-            data_list = []
-            # select data from all MSs
-            for msindex in xrange(len(ms_names)):
-                sel1 = np.where(ant1_list[msindex] == ant[0])[0]
-                sel2 = np.where(ant2_list[msindex] == ant[1])[0]
-                sel_list.append( sorted(list(frozenset(sel1).intersection(sel2))) )
-
-                # # get weights and data
-                # weights_list.append( all_weights[sel_list[msindex],:,:] )
-                # data_list.append( all_data[sel_list[msindex],:,:] )
-            # combine data and weights into one array
-            data = all_data_list[0][sel_list[0],:,:]
-            weights = all_weights_list[0][sel_list[0],:,:]
-            fillshape = list(data.shape)
-            startidx = [0]
-            endidx = [data.shape[0]]
-            for msindex in xrange(1,len(ms_names)):
-                #pad gap between obs
-                filltimes = np.arange(np.max(all_time_list[msindex-1]),np.min(all_time_list[msindex]),timepersample)
-                fillshape[0] = len(filltimes)
-                data = np.concatenate( (data,np.zeros(fillshape)), axis=0 )
-                weights = np.concatenate( (weights,np.zeros(fillshape)), axis=0  )
-                startidx.append(data.shape[0])
-                data = np.concatenate( (data,all_data_list[msindex][sel_list[msindex],:,:]), axis=0  )
-                weights = np.concatenate( (weights,all_weights_list[msindex][sel_list[msindex],:,:]), axis=0  )
-                endidx.append(data.shape[0])
-
-            # compute the FWHM
-            dist = baseline_dict['{0}-{1}'.format(ant[0], ant[1])]
-            stddev = 30.0 * ionfactor * np.sqrt((25.0 / dist)) * (freq / 60.e6) # in sec
-            stddev = stddev/timepersample # in samples
-
-            # Multiply every element of the data by the weights, convolve both
-            # the scaled data and the weights, and then divide the convolved data
-            # by the convolved weights (translating flagged data into weight=0).
-            # That's basically the equivalent of a running weighted average with
-            # a Gaussian window function.
-
-            # weigth data and set bad data to 0 so nans do not propagate
-            data = np.nan_to_num(data*weights)
-
-            # smear weighted data and weights
-            dataR = gfilter(np.real(data), stddev, axis=0)
-            dataI = gfilter(np.imag(data), stddev, axis=0)
-            weights = gfilter(weights, stddev, axis=0)
-
-            # re-create data
-            data = (dataR + 1j * dataI)
-            data[(weights != 0)] /= weights[(weights != 0)] # avoid divbyzero
-            for msindex in xrange(len(ms_names)):
-                all_data_list[msindex][sel_list[msindex],:,:] = data[startidx[msindex]:endidx[msindex],:,:]
-                all_weights_list[msindex][sel_list[msindex],:,:] = weights[startidx[msindex]:endidx[msindex],:,:]
-
-        ### write the data back to the files
+            sel_tab_list.append(sel_tab)
+            rows_list.append(rows)
+            data_list.append(data)
+            weights_list.append(weights)
+            flags_list.append(flags)
+
+        # Average the baselines (positions of their rows are in the rows read)
+        ant_list = [ant for ant in batch if ant in averaged_baselines]
+        pos_lists = [[np.searchsorted(rows_list[msindex],
+            bl_index_list[msindex].get_rows(ant[0], ant[1])) for msindex
+            in xrange(len(ms_names))] for ant in ant_list]
+        average_baselines(data_list, weights_list, pos_lists,
+            [stddev_dict[ant] for ant in ant_list], nfill_list, stddev_bucket_width)
+
+        # Write the results straight back
         for msindex in xrange(len(ms_names)):
-            ms = pt.table(ms_names[msindex], readonly=False, ack=False)
-            # Add the output columns if needed
-            if output_data_colname not in ms.colnames():
-                desc = ms.getcoldesc(input_colname)
-                desc['name'] = output_data_colname
-                ms.addcols(desc)
-            if output_weights_colname not in ms.colnames():
-                desc = ms.getcoldesc('WEIGHT_SPECTRUM')
-                desc['name'] = output_weights_colname
-                ms.addcols(desc)
-
-            ms.putcol(output_data_colname, all_data_list[msindex])
-            ms.putcol('FLAG', all_flags_list[msindex]) # this saves flags of nans, which is always good
-            ms.putcol(output_weights_colname, all_weights_list[msindex])
-            ms.close()
-        print "BLavg_multi: Finished one group of measurement sets."
+            sel_tab = sel_tab_list[msindex]
+            sel_tab.putcol(output_data_colname, data_list[msindex])
+            sel_tab.putcol('FLAG', flags_list[msindex]) # this saves flags of nans, which is always good
+            sel_tab.putcol(output_weights_colname, weights_list[msindex])
+            sel_tab.close()
+
+    for ms in ms_list:
+        ms.close()
+
+
+def average_baselines(data_list, weights_list, pos_lists, stddevs, nfill_list,
+        stddev_bucket_width=0.0):
+    """
+    Averages the data of a number of baselines from a group of MSs in time
+
+    The baselines are grouped by kernel width and by number of rows in each
+    MS. The data of each group are stacked, so that they are smoothed together
+    with one call per array. Kernel widths are grouped into buckets of
+    logarithmic width stddev_bucket_width, with the central width of a bucket
+    used for all of its baselines
+
+    Parameters
+    ----------
+    data_list : list of arrays
+        Data of each MS (with flagged data given zero weight). The averaged
+        data are written into these arrays
+    weights_list : list of arrays
+        Weights of each MS. The averaged weights are written into these arrays
+    pos_lists : list of lists of arrays
+        For each baseline, the positions of its rows (in time order) in the
+        arrays of each MS
+    stddevs : list of float
+        Kernel width in samples of each baseline (see get_stddev())
+    nfill_list : list of int
+        Number of samples in the gap before each MS (see get_gap_lengths())
+    stddev_bucket_width : float, optional
+        Fractional width of the buckets of kernel widths. If 0, only baselines
+        with identical kernel widths are smoothed together
+
+    """
+    if len(pos_lists) == 0:
+        return
+    stddevs = np.array(stddevs, dtype=float)
+    if stddev_bucket_width > 0.0:
+        log_width = np.log1p(stddev_bucket_width)
+        bucket_ind = np.floor(np.log(stddevs) / log_width).astype(int)
+        bucket_stddevs = np.exp((bucket_ind + 0.5) * log_width)
+    else:
+        unique_stddevs, bucket_ind = np.unique(stddevs, return_inverse=True)
+        bucket_stddevs = unique_stddevs[bucket_ind]
+
+    groups = {}
+    for i, pos_list in enumerate(pos_lists):
+        key = (bucket_ind[i], tuple([len(pos) for pos in pos_list]))
+        groups.setdefault(key, []).append(i)
+
+    nms = len(data_list)
+    for key in sorted(groups):
+        members = groups[key]
+        stddev = bucket_stddevs[members[0]]
+
+        # Positions of the rows of the baselines, with shape (nbaselines, nrows)
+        pos = [np.array([pos_lists[i][msindex] for i in members],
+            dtype=np.int64).reshape(len(members), key[1][msindex]) for msindex
+            in xrange(nms)]
+
+        # combine data and weights into one array, with time along axis 1
+        data = data_list[0][pos[0]]
+        weights = weights_list[0][pos[0]]
+        fillshape = list(data.shape)
+        startidx = [0]
+        endidx = [data.shape[1]]
+        for msindex in xrange(1,nms):
+            #pad gap between obs
+            fillshape[1] = nfill_list[msindex]
+            data = np.concatenate( (data,np.zeros(fillshape)), axis=1 )
+            weights = np.concatenate( (weights,np.zeros(fillshape)), axis=1  )
+            startidx.append(data.shape[1])
+            data = np.concatenate( (data,data_list[msindex][pos[msindex]]), axis=1  )
+            weights = np.concatenate( (weights,weights_list[msindex][pos[msindex]]), axis=1  )
+            endidx.append(data.shape[1])
+
+        # Multiply every element of the data by the weights, convolve both
+        # the scaled data and the weights, and then divide the convolved data
+        # by the convolved weights (translating flagged data into weight=0).
+        # That's basically the equivalent of a running weighted average with
+        # a Gaussian window function.
+
+        # weigth data and set bad data to 0 so nans do not propagate
+        data = np.nan_to_num(data*weights)
+
+        # smear weighted data and weights
+        dataR = gfilter(np.real(data), stddev, axis=1)
+        dataI = gfilter(np.imag(data), stddev, axis=1)
+        weights = gfilter(weights, stddev, axis=1)
+
+        # re-create data
+        data = (dataR + 1j * dataI)
+        data[(weights != 0)] /= weights[(weights != 0)] # avoid divbyzero
+        for msindex in xrange(nms):
+            data_list[msindex][pos[msindex]] = data[:, startidx[msindex]:endidx[msindex]]
+            weights_list[msindex][pos[msindex]] = weights[:, startidx[msindex]:endidx[msindex]]
+
+
+def get_stddev(dist, ionfactor, freq, timepersample):
+    """
+    Returns the width of the Gaussian kernel used to average a baseline
+
+    Parameters
+    ----------
+    dist : float
+        Length of the baseline in km
+    ionfactor : float
+        Ionospheric scaling factor
+    freq : float
+        Reference frequency in Hz
+    timepersample : float
+        Time per sample in sec
+
+    Returns
+    -------
+    stddev : float
+        Standard deviation of the kernel in samples
+
+    """
+    # compute the FWHM
+    stddev = 30.0 * ionfactor * np.sqrt((25.0 / dist)) * (freq / 60.e6) # in sec
+    stddev = stddev/timepersample # in samples
+
+    return stddev
+
+
+def get_gap_lengths(all_time_list, timepersample):
+    """
+    Returns the number of samples in the gap before each MS of a group
+
+    Parameters
+    ----------
+    all_time_list : list of arrays
+        Times of each MS of the group, in time order
+    timepersample : float
+        Time per sample in sec
+
+    Returns
+    -------
+    nfill_list : list of int
+        Number of samples used to pad the gap between each MS and the previous
+        one (0 for the first MS)
+
+    """
+    nfill_list = [0]
+    for msindex in xrange(1,len(all_time_list)):
+        filltimes = np.arange(np.max(all_time_list[msindex-1]),np.min(all_time_list[msindex]),timepersample)
+        nfill_list.append(len(filltimes))
+
+    return nfill_list
+
+
+def add_output_columns(ms, input_colname, output_data_colname, output_weights_colname):
+    """
+    Adds the output columns to an MS if needed
+    """
+    if output_data_colname not in ms.colnames():
+        desc = ms.getcoldesc(input_colname)
+        desc['name'] = output_data_colname
+        ms.addcols(desc)
+    if output_weights_colname not in ms.colnames():
+        desc = ms.getcoldesc('WEIGHT_SPECTRUM')
+        desc['name'] = output_weights_colname
+        ms.addcols(desc)
 
 
 def unwrap_fft(phase, iterations=3):
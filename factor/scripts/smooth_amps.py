@@ -7,83 +7,144 @@ from argparse import RawTextHelpFormatter
 import casacore.tables as pt
 import numpy
 import os
-import lofar.parmdb
 import math
 import scipy.signal
 import shutil
-import multiprocessing
-import itertools
+from factor.lib.solutions import read_solutions, write_solutions
 
 
 def median_window_filter(ampl, half_window, threshold):
+    """
+    Replaces outliers with the median of a sliding window
+
+    Parameters
+    ----------
+    ampl : array
+        Series to filter, with shape (ndata,) or (nseries, ndata). All series
+        are filtered at once
+    half_window : int
+        Half size of the window
+    threshold : float
+        Samples that are more than 1.4826 * threshold * the median distance
+        away from the median of their window are replaced
+
+    Returns
+    -------
+    ampl_filtered : array
+        Filtered series, with the shape of ampl
 
-    ampl_tot_copy = numpy.copy(ampl)
-    ndata = len(ampl)
-    flags = numpy.zeros(ndata, dtype=bool)
-    sol = numpy.zeros(ndata+2*half_window)
-    sol[half_window:half_window+ndata] = ampl
-
-    for i in range(0, half_window):
-        # Mirror at left edge.
-        idx = min(ndata-1, half_window-i)
-        sol[i] = ampl[idx]
+    """
+    ampl = numpy.asarray(ampl)
+    is_1d = (ampl.ndim == 1)
+    ampl = numpy.atleast_2d(ampl)
+    nseries, ndata = ampl.shape
 
-        # Mirror at right edge
-        idx = max(0, ndata-2-i)
-        sol[ndata+half_window+i] = ampl[idx]
+    ampl_tot_copy = numpy.copy(ampl)
+    sol = numpy.zeros((nseries, ndata+2*half_window))
+    sol[:, half_window:half_window+ndata] = ampl
 
-    median_array  = scipy.signal.medfilt(sol,half_window*2-1)
+    # Mirror at left and right edges
+    left_ind = [min(ndata-1, half_window-i) for i in range(half_window)]
+    right_ind = [max(0, ndata-2-i) for i in range(half_window)]
+    sol[:, 0:half_window] = ampl[:, left_ind]
+    sol[:, ndata+half_window:] = ampl[:, right_ind]
 
-    sol_flag = numpy.zeros(ndata+2*half_window, dtype=bool)
-    sol_flag_val = numpy.zeros(ndata+2*half_window, dtype=bool)
+    median_array  = scipy.signal.medfilt(sol, [1, half_window*2-1])
 
+    # The samples are flagged in order, as the flags of the earlier samples in
+    # a window affect the statistics of the window
+    sol_flag = numpy.zeros((nseries, ndata+2*half_window), dtype=bool)
+    min_unflagged = math.sqrt(2*half_window+1)
     for i in range(half_window, half_window + ndata):
         # Compute median of the absolute distance to the median.
-        window = sol[i-half_window:i+half_window+1]
-        window_flag = sol_flag[i-half_window:i+half_window+1]
-        window_masked = window[~window_flag]
+        window = sol[:, i-half_window:i+half_window+1]
+        window_unflagged = ~sol_flag[:, i-half_window:i+half_window+1]
 
-        if len(window_masked) < math.sqrt(len(window)):
-            # Not enough data to get accurate statistics.
-            continue
+        # Skip series without enough data to get accurate statistics.
+        has_data = numpy.sum(window_unflagged, axis=1) >= min_unflagged
 
-        median = numpy.median(window_masked)
-        q = 1.4826 * numpy.median(numpy.abs(window_masked - median))
+        median = masked_median(window, window_unflagged)
+        q = 1.4826 * masked_median(numpy.abs(window - median[:, numpy.newaxis]),
+            window_unflagged)
 
         # Flag sample if it is more than 1.4826 * threshold * the
         # median distance away from the median.
-        if abs(sol[i] - median) > (threshold * q):
-            sol_flag[i] = True
+        with numpy.errstate(invalid='ignore'):
+            sol_flag[:, i] = has_data & (numpy.abs(sol[:, i] - median) > (threshold * q))
 
-        idx = numpy.where(sol == 0.0) # to remove 1.0 amplitudes
-        sol[idx] = True
+        sol[sol == 0.0] = True # to remove 1.0 amplitudes
 
-    mask = sol_flag[half_window:half_window + ndata]
+    mask = sol_flag[:, half_window:half_window + ndata]
+    ampl_tot_copy[mask] = median_array[:, half_window:half_window + ndata][mask] # fixed 2012
 
-    for i in range(len(mask)):
-        if mask[i]:
-           ampl_tot_copy[i] = median_array[half_window+i] # fixed 2012
+    if is_1d:
+        return ampl_tot_copy[0]
     return ampl_tot_copy
 
 
-def smooth_star(inputs):
+def masked_median(values, unmasked):
     """
-    Simple helper function for pool.map
+    Returns the median of the unmasked values of each row
+
+    Parameters
+    ----------
+    values : array
+        Values, with shape (nrows, ncols)
+    unmasked : array of bool
+        True for the values to use
+
+    Returns
+    -------
+    median : array
+        Median of each row (undefined for rows without unmasked values)
+
     """
-    return smooth(*inputs)
+    nrows = values.shape[0]
+    nunmasked = numpy.sum(unmasked, axis=1)
+    sorted_values = numpy.sort(numpy.where(unmasked, values, numpy.inf), axis=1)
+    rows = numpy.arange(nrows)
+    low = sorted_values[rows, numpy.maximum(0, (nunmasked-1)//2)]
+    high = sorted_values[rows, nunmasked//2]
+
+    return (low + high) / 2.0
 
 
-def smooth(chan, real, imag, window):
+def smooth(real, imag, window):
     """
-    Smooth solutions for a single channel
+    Smooth solutions
+
+    Parameters
+    ----------
+    real : array
+        Real parts of the solutions, with shape (nseries, ntimes). All series
+        (e.g., each channel of each antenna and polarization) are smoothed at
+        once
+    imag : array
+        Imaginary parts of the solutions
+    window : int
+        Half size of the window of the first median filters
+
+    Returns
+    -------
+    real_smoothed, imag_smoothed : arrays
+        Smoothed real and imaginary parts
+
     """
     phase = numpy.arctan2(imag, real)
     allamp = numpy.sqrt(imag**2 + real**2)
 
+    # Series are filtered together if they have the same number of unflagged
+    # solutions
     goodmask = numpy.isfinite(allamp)
-    amp = allamp[goodmask]
+    ngood = numpy.sum(goodmask, axis=1)
+    for n in numpy.unique(ngood):
+        if n <= 7:
+            continue
+        series_ind = numpy.where(ngood == n)[0]
+        series_goodmask = goodmask[series_ind]
+        series_amp = allamp[series_ind]
+        amp = series_amp[series_goodmask].reshape(len(series_ind), n)
 
-    if len(amp)>7:
         amp = numpy.log10(amp)
         amp = median_window_filter(amp, window, 6)
         amp = median_window_filter(amp, window, 6)
@@ -94,10 +155,10 @@ def smooth(chan, real, imag, window):
 
         # Clip extremely high amplitude solutions to prevent biasing the
         # normalization done later
-        high_ind = numpy.where(amp > 5.0)
-        amp[high_ind] = 5.0
+        amp[amp > 5.0] = 5.0
 
-        allamp[goodmask] = amp
+        series_amp[series_goodmask] = amp.ravel()
+        allamp[series_ind] = series_amp
 
     real_smoothed = allamp * numpy.cos(phase)
     imag_smoothed = allamp * numpy.sin(phase)
@@ -123,71 +184,67 @@ def main(instrument_name, instrument_name_smoothed, normalize=True, scratch_dir=
         instrument_name_smoothed = os.path.join(scratch_dir, os.path.basename(instrument_name_smoothed_orig))
         shutil.copytree(instrument_name_orig, instrument_name)
 
-    pdb = lofar.parmdb.parmdb(instrument_name)
-    parms = pdb.getValuesGrid('*')
-
-    key_names = parms.keys()
-    nchans = len(parms[key_names[0]]['freqs'])
-
-    # Get station names
-    antenna_list = set([s.split(':')[-1] for s in pdb.getNames()])
+    solutions = read_solutions(instrument_name)
     window = 4
 
-    # Smooth
-    for pol in pol_list:
-        for antenna in antenna_list:
-            channel_parms_real = [parms[gain + ':' + pol + ':Real:'+ antenna]['values'][:, chan] for chan in range(nchans)]
-            channel_parms_imag = [parms[gain + ':' + pol + ':Imag:'+ antenna]['values'][:, chan] for chan in range(nchans)]
-            pool = multiprocessing.Pool()
-            results = pool.map(smooth_star, itertools.izip(range(nchans),
-                channel_parms_real, channel_parms_imag, itertools.repeat(window)))
-            pool.close()
-            pool.join()
-
-            for chan, (real, imag) in enumerate(results):
-                parms[gain + ':' + pol + ':Real:' + antenna]['values'][:, chan] = real
-                parms[gain + ':' + pol + ':Imag:' + antenna]['values'][:, chan] = imag
+    # Find the gains of each time and frequency grid (solution table), so that
+    # they can be smoothed together. Stations on an odd grid (e.g., one that
+    # is missing from a time chunk) have a table of their own and are thus
+    # processed per station. Each group holds the real and imaginary values of
+    # a table and the index of its gains in them
+    real_type = gain + ':Real'
+    imag_type = gain + ':Imag'
+    groups = []
+    for table in solutions.tables:
+        if real_type not in table.parm_types or imag_type not in table.parm_types:
+            continue
+        ireal = table.parm_types.index(real_type)
+        iimag = table.parm_types.index(imag_type)
+        ind = [(p, a) for p, pol in enumerate(table.pols) if pol in pol_list
+            for a in range(len(table.stations)) if table.present[ireal, p, a] and
+            table.present[iimag, p, a]]
+        if len(ind) == 0:
+            continue
+        p_ind, a_ind = [numpy.array(i) for i in zip(*ind)]
+        groups.append((table.values[ireal], table.values[iimag], (p_ind, a_ind)))
+
+    # Smooth all (pol, antenna, chan) series of each group along time at once
+    gains = []
+    for real_all, imag_all, index in groups:
+        real = real_all[index]
+        imag = imag_all[index]
+        nseries, ntimes, nchans = real.shape
+        real, imag = smooth(real.transpose(0, 2, 1).reshape(nseries*nchans, ntimes),
+            imag.transpose(0, 2, 1).reshape(nseries*nchans, ntimes), window)
+        gains.append((real.reshape(nseries, nchans, ntimes).transpose(0, 2, 1),
+            imag.reshape(nseries, nchans, ntimes).transpose(0, 2, 1)))
 
     # Normalize the amplitude solutions to a mean of one across all channels
     if normalize:
         # First find the normalization factor
-        amplist = []
-        for chan in range(nchans):
-            for pol in pol_list:
-                for antenna in antenna_list:
-                    real = numpy.copy(parms[gain + ':' + pol + ':Real:'+ antenna]['values'][:, chan])
-                    imag = numpy.copy(parms[gain + ':' + pol + ':Imag:'+ antenna]['values'][:, chan])
-                    amp = numpy.ma.masked_invalid(numpy.copy(numpy.sqrt(real**2 + imag**2))).compressed()
-                    amplist.append(amp)
-        norm_factor = 1.0/(numpy.mean(numpy.concatenate(amplist)))
+        amps = [numpy.sqrt(real**2 + imag**2) for real, imag in gains]
+        norm_factor = 1.0/(numpy.mean(numpy.concatenate([amp[numpy.isfinite(amp)]
+            for amp in amps])))
         print "smooth_amps.py: Normalization-Factor is:", norm_factor
 
         # Now do the normalization
-        for chan in range(nchans):
-            for pol in pol_list:
-                for antenna in antenna_list:
-                    real = numpy.copy(parms[gain + ':' + pol + ':Real:'+ antenna]['values'][:, chan])
-                    imag = numpy.copy(parms[gain + ':' + pol + ':Imag:'+ antenna]['values'][:, chan])
-                    phase = numpy.arctan2(imag, real)
-                    amp  = numpy.copy(numpy.sqrt(real**2 + imag**2))
-
-                    # Clip extremely low amplitude solutions to prevent very high
-                    # amplitudes in the corrected data
-                    # First get a copy and fill all NANs with dummy values
-                    amp_nonan = numpy.copy(amp)
-                    amp_nonan[~numpy.isfinite(amp)] = 1.
-                    low_ind = numpy.where( amp_nonan < 0.2)
-                    amp[low_ind] = 0.2
-
-                    parms[gain + ':' + pol + ':Real:'+ antenna]['values'][:, chan] = numpy.copy(amp *
-                        numpy.cos(phase) * norm_factor)
-                    parms[gain + ':' + pol + ':Imag:'+ antenna]['values'][:, chan] = numpy.copy(amp *
-                        numpy.sin(phase) * norm_factor)
+        for i, ((real, imag), amp) in enumerate(zip(gains, amps)):
+            phase = numpy.arctan2(imag, real)
+
+            # Clip extremely low amplitude solutions to prevent very high
+            # amplitudes in the corrected data
+            amp[numpy.isfinite(amp) & (amp < 0.2)] = 0.2
+
+            gains[i] = (amp * numpy.cos(phase) * norm_factor,
+                amp * numpy.sin(phase) * norm_factor)
+
+    for (real_all, imag_all, index), (real, imag) in zip(groups, gains):
+        real_all[index] = real
+        imag_all[index] = imag
+
     if os.path.exists(instrument_name_smoothed):
         shutil.rmtree(instrument_name_smoothed)
-    pdbnew = lofar.parmdb.parmdb(instrument_name_smoothed, create=True)
-    pdbnew.addValues(parms)
-    pdbnew.flush()
+    write_solutions(solutions, instrument_name_smoothed)
 
     # Copy output to original path and delete copies if scratch directory is specified
     if scratch_dir is not None:
@@ -8,478 +8,11 @@ from argparse import RawTextHelpFormatter
 import casacore.tables as pt
 import numpy
 import os
-import lofar.parmdb
-import math
 import shutil
 import multiprocessing
-from scipy.interpolate import LSQUnivariateSpline
 import sys
-import scipy.ndimage
-import astropy.convolution
-
-
-def std(inputData, Zero=False, axis=None, dtype=None):
-	"""
-	Robust estimator of the standard deviation of a data set.
-
-	Based on the robust_sigma function from the AstroIDL User's Library.
-
-	.. versionchanged:: 1.0.3
-		Added the 'axis' and 'dtype' keywords to make this function more
-		compatible with numpy.std()
-	"""
-	epsilon = 1.0e-20
-	if axis is not None:
-		fnc = lambda x: std(x, dtype=dtype)
-		sigma = numpy.apply_along_axis(fnc, axis, inputData)
-	else:
-		data = inputData.ravel()
-		if type(data).__name__ == "MaskedArray":
-			data = data.compressed()
-		if dtype is not None:
-			data = data.astype(dtype)
-
-		if Zero:
-			data0 = 0.0
-		else:
-			data0 = numpy.median(data)
-		maxAbsDev = numpy.median(numpy.abs(data-data0)) / 0.6745
-		if maxAbsDev < epsilon:
-			maxAbsDev = (numpy.abs(data-data0)).mean() / 0.8000
-		if maxAbsDev < epsilon:
-			sigma = 0.0
-			return sigma
-
-		u = (data-data0) / 6.0 / maxAbsDev
-		u2 = u**2.0
-		good = numpy.where( u2 <= 1.0 )
-		good = good[0]
-		if len(good) < 3:
-			print "WARNING:  Distribution is too strange to compute standard deviation"
-			sigma = -1.0
-			return sigma
-
-		numerator = ((data[good]-data0)**2.0 * (1.0-u2[good])**2.0).sum()
-		nElements = (data.ravel()).shape[0]
-		denominator = ((1.0-u2[good])*(1.0-5.0*u2[good])).sum()
-		sigma = nElements*numerator / (denominator*(denominator-1.0))
-		if sigma > 0:
-			sigma = math.sqrt(sigma)
-		else:
-			sigma = 0.0
-
-	return sigma
-
-def findscatter(datavector):
-    shifted_vec = numpy.roll(datavector, 1)
-    #scatter = sum(abs(shifted_vec - datavector))/numpy.float(len(datavector))
-    scatter = numpy.median(abs(shifted_vec - datavector))
-    return scatter
-
-
-def findscatter_time(dataarray):
-    scattervec = []
-    for freq in range(0,len(dataarray[:,0])):
-      #print 'findscatter_time', freq
-      scatter = findscatter(dataarray[freq,:])
-      scattervec.append(scatter)
-    return numpy.median(scattervec)
-
-
-def findscatter_freq(dataarray):
-    scattervec = []
-    for time in range(0,len(dataarray[0,:])):
-      #print 'findscatter_freq', time
-      scatter = findscatter(dataarray[:,time])
-      scattervec.append(scatter)
-    return numpy.median(scattervec)
-
-
-def findnoisevec(datavector):
-    shifted_vec = numpy.roll(datavector, 1)
-    scatter_vec = (abs(shifted_vec - datavector))
-    #scatter_vec = medfilt(scatter_vec,21)
-    scatter_vec = scipy.ndimage.filters.median_filter(scatter_vec,9, mode='mirror')
-
-    # now smooth
-    gauss = astropy.convolution.Gaussian1DKernel(stddev=4.0)
-    scatter_vec = astropy.convolution.convolve(scatter_vec,gauss , boundary='extend')
-
-    # normalize scatter_vec
-    scatter_vec = scatter_vec/numpy.mean(scatter_vec)
-
-    return scatter_vec
-
-
-def spline1D_amp(amp_orig):
-    # to compute knot points
-    f = lambda m, n: [i*n//m + n//(2*m) for i in range(m)]
-
-    # expand array and mirror full array around edges
-    ndata = len(amp_orig)
-    amp = numpy.zeros(ndata+2*ndata)
-    amp[ndata:ndata+ndata] = amp_orig
-
-    for i in range(0, ndata):
-        # Mirror at left edge.
-        idx = min(ndata-1, ndata-i)
-        amp[i] = amp_orig[idx]
-        # Mirror at right edge
-        idx = max(0, ndata-2-i)
-        amp[ndata+ndata+i] = amp_orig[idx]
-
-    # work in log-sapce
-    amp_orig_ext = numpy.copy(amp)
-    amp = numpy.log10(amp)
-    weights = (0.*numpy.copy(amp)) + 1 # initialize weights to 1
-
-    # filter bad data and determine average scatter of amplitudes
-    idx = numpy.where(amp != 0.0) # log10(1.0) = 0.0
-    #print idx, 'idx'
-    if numpy.any(idx): # so we do not have an empty array
-        scatter = findscatter(amp[idx])
-        # remove some really bad stuff, by putting weights to zero.
-        idxbadi1 = numpy.where(amp > (numpy.median(amp) + (35.*std(amp))))
-        weights[idxbadi1] = 1e-10 # small value, zero generates NaN in spline
-        idxbadi2 = numpy.where(amp < (numpy.median(amp) - (35.*std(amp))))
-        weights[idxbadi2] = 1e-10  # small value, zero generates NaN in spline
-    else:
-        scatter = 0.02 # just that we have a value to prevent crashes in case all amplitudes are 1.0
-        #print 'No valid data for found for this anntenna: ', antenna
-
-
-    # make the noisevec
-    if numpy.any(idx): # at least 1 good data point
-        if len(amp[idx]) > 30:  # so at least 30/3 = 10 good data points
-            # create noise vector
-            noisevec = findnoisevec(amp)
-        else:
-            noisevec = (numpy.copy(amp) * 0.) + 1.0 # just make constant noise, if we have too little datapoints
-    else:
-        noisevec = (numpy.copy(amp) * 0.) + 1.0 # just make constant noise, if we have too little datapoints
-
-
-    #print scatter, antenna
-
-    if scatter < 0.005:
-        #Interior knots t must satisfy Schoenberg-Whitney conditions
-        scatter = 0.005 # otherwise we fit more parameters than we have data points
-    knotfactor = 0.5e3*scatter  # normalize based on trial and error
-
-    #print scatter, antenna, len(amp), knotfactor
-
-    timevec = numpy.arange(0,len(amp))
-    knotvec = f(numpy.int(len(amp)/knotfactor),len(amp))
-    #print antenna, 'knots', knotvec, noisevec[knotvec]
-
-    #print 'knots OR', knotvec
-
-    # simple optimization knot selection for vectors that have at least 30 data points
-    # based on the noisevector
-    # removes even numbered knots if the noise is high
-    knotvec_copy = numpy.copy(knotvec) # otherwise tcopy is updated as well
-    if len(timevec) > 30 and len(knotvec) > 2:
-        for counter, knot in enumerate(knotvec_copy):
-            #print counter, knot, noisevec[knot]
-            if (counter % 2 == 0) and noisevec[knot] > 1.5: # even index and large noise
-                knotvec.remove(knot)
-              #print 'Removing knot because of local increase in noise'
-
-    #print antenna, 'cleaned knots', knotvec, noisevec[knotvec]
-
-    # asign midpoint if not enough data points/20
-    if len (knotvec) < 3: # because we are working with a 3x larger mirrored array
-        knotvec = [numpy.int(len(timevec)*0.25),numpy.int(len(timevec)/2),numpy.int(len(timevec)*0.75)]
-        #print 'extending to', knotvec
-
-    splineorder =  5 #  default
-    if len(knotvec) == 3 and scatter > 0.1:
-        splineorder = 3 # reduce order, data is  bad
-        if scatter > 0.2:
-            splineorder = 1 # very bad data
-
-    #print 'knots CL', knotvec
-    spl2 = LSQUnivariateSpline(timevec, amp, knotvec, w=weights, k=splineorder)
-
-    # now find bad data devatiating from the fit 30 x scatter
-    residual = numpy.abs(spl2(timevec)-amp)
-    idx      = numpy.where(residual > 15.*scatter)
-
-    # second iteration
-    if numpy.any(idx):
-        ampcopy = numpy.copy(amp)
-        ampcopy[idx] = spl2(timevec[idx]) # replace bad amplitudes by model
-        spl2 = LSQUnivariateSpline(timevec, ampcopy, knotvec,  w=weights, k=splineorder)
-
-    residual = numpy.abs(spl2(timevec)-amp)
-    idx      = numpy.where(residual > 8.*scatter)
-
-    # third iteration
-    if numpy.any(idx):
-        ampcopy = numpy.copy(amp)
-        ampcopy[idx] = spl2(timevec[idx]) # replace bad amplitudes by model
-        spl2 = LSQUnivariateSpline(timevec, ampcopy, knotvec,  w=weights, k=splineorder)
-
-    # again look at residual, go back to original amp again, find deviating data > 3x scatter
-    residual = numpy.abs(spl2(timevec)-amp)
-    idx      = numpy.where(residual > 3.*scatter)
-    # replace the bad data with model
-    model    =spl2(timevec)
-
-    #if len(idx) != 0:
-    amp[idx] = model[idx]
-
-    # go out of log-space
-    #idxnodata = numpy.where(amp_orig_ext == 1.0)
-    #amp[idxnodata] = 0.0 # to avoid problem with amplitudes that are 1.0
-    amp = 10**amp
-
-    amp_clean = amp[ndata:ndata + ndata]
-
-    idxbad = numpy.where(amp_clean != amp_orig)
-    n_knots = numpy.int(numpy.ceil(numpy.float(len(knotvec))/3.)) # approxmiate, just for plot
-
-    # return cleaned amplitudes, model, scatter, number of knots, indices of replaced outliers
-    return amp_clean, 10**(model[ndata:ndata + ndata]), noisevec[ndata:ndata + ndata], scatter, n_knots, idxbad, weights[ndata:ndata + ndata]
-
-
-def spline1D_phase(phase_orig):
-    # to compute knot points
-    f = lambda m, n: [i*n//m + n//(2*m) for i in range(m)]
-
-    # expand array and mirror full array around edges
-    ndata = len(phase_orig)
-    phase = numpy.zeros(ndata+2*ndata)
-    phase[ndata:ndata+ndata] = phase_orig
-
-    for i in range(0, ndata):
-        # Mirror at left edge.
-        idx = min(ndata-1, ndata-i)
-        phase[i] = phase_orig[idx]
-        # Mirror at right edge
-        idx = max(0, ndata-2-i)
-        phase[ndata+ndata+i] = phase_orig[idx]
-
-    weights = (0.*numpy.copy(phase)) + 1 # initialize weights to 1
-
-    # filter bad data and determine average scatter of amplitudes
-    idx = numpy.where(phase != 0.0)
-    #print idx, 'idx'
-    if numpy.any(idx): # so we do not have an empty array
-        scatter = findscatter(phase[idx])
-        # remove some really bad stuff, by putting weights to zero.
-        idxbadi1 = numpy.where(phase > (numpy.median(phase) + (35.*std(phase))))
-        weights[idxbadi1] = 1e-10 # small value, zero generates NaN in spline
-        idxbadi2 = numpy.where(phase < (numpy.median(phase) - (35.*std(phase))))
-        weights[idxbadi2] = 1e-10  # small value, zero generates NaN in spline
-    else:
-        scatter = 0.02 # just that we have a value to prevent crashes in case all amplitudes are 1.0
-        #print 'No valid data for found for this anntenna: ', antenna
-
-
-    # make the noisevec
-    if numpy.any(idx): # at least 1 good data point
-        if len(phase[idx]) > 30:  # so at least 30/3 = 10 good data points
-            # create noise vector
-            noisevec = findnoisevec(phase)
-        else:
-            noisevec = (numpy.copy(phase) * 0.) + 1.0 # just make constant noise, if we have too little datapoints
-    else:
-        noisevec = (numpy.copy(phase) * 0.) + 1.0 # just make constant noise, if we have too little datapoints
-
-
-    #print scatter, antenna
-
-    if scatter < 0.005:
-        #Interior knots t must satisfy Schoenberg-Whitney conditions
-        scatter = 0.005 # otherwise we fit more parameters than we have data points
-    knotfactor = 0.5e3*scatter  # normalize based on trial and error
-
-    timevec = numpy.arange(0,len(phase))
-    knotvec = f(numpy.int(len(phase)/knotfactor),len(phase))
-    #print antenna, 'knots', knotvec, noisevec[knotvec]
-
-    #print 'knots OR', knotvec
-
-    # simple optimization knot selection for vectors that have at least 30 data points
-    # based on the noisevector
-    # removes even numbered knots if the noise is high
-    knotvec_copy = numpy.copy(knotvec) # otherwise tcopy is updated as well
-    if len(timevec) > 30 and len(knotvec) > 2:
-        for counter, knot in enumerate(knotvec_copy):
-            #print counter, knot, noisevec[knot]
-            if (counter % 2 == 0) and noisevec[knot] > 1.5: # even index and large noise
-                knotvec.remove(knot)
-              #print 'Removing knot because of local increase in noise'
-
-    #print antenna, 'cleaned knots', knotvec, noisevec[knotvec]
-
-    # asign midpoint if not enough data points/20
-    if len (knotvec) < 3: # because we are working with a 3x larger mirrored array
-        knotvec = [numpy.int(len(timevec)*0.25),numpy.int(len(timevec)/2),numpy.int(len(timevec)*0.75)]
-        #print 'extending to', knotvec
-
-    splineorder =  5 #  default
-    if len(knotvec) == 3 and scatter > 0.1:
-        splineorder = 3 # reduce order, data is  bad
-        if scatter > 0.2:
-            splineorder = 1 # very bad data
-
-    #print 'knots CL', knotvec
-    spl2 = LSQUnivariateSpline(timevec, phase, knotvec, w=weights, k=splineorder)
-
-    # now find bad data devatiating from the fit 30 x scatter
-    residual = numpy.abs(spl2(timevec)-phase)
-    idx      = numpy.where(residual > 15.*scatter)
-
-    # second iteration
-    if numpy.any(idx):
-        phasecopy = numpy.copy(phase)
-        phasecopy[idx] = spl2(timevec[idx]) # replace bad amplitudes by model
-        spl2 = LSQUnivariateSpline(timevec, phasecopy, knotvec,  w=weights, k=splineorder)
-
-    residual = numpy.abs(spl2(timevec)-phase)
-    idx      = numpy.where(residual > 8.*scatter)
-
-    # third iteration
-    if numpy.any(idx):
-        phasecopy = numpy.copy(phase)
-        phasecopy[idx] = spl2(timevec[idx]) # replace bad amplitudes by model
-        spl2 = LSQUnivariateSpline(timevec, phasecopy, knotvec,  w=weights, k=splineorder)
-
-    # again look at residual, go back to original amp again, find deviating data > 3x scatter
-    residual = numpy.abs(spl2(timevec)-phase)
-    idx      = numpy.where(residual > 3.*scatter)
-    # replace the bad data with model
-    model    =spl2(timevec)
-
-    #if len(idx) != 0:
-    phase[idx] = model[idx]
-    phase_clean = phase[ndata:ndata + ndata]
-
-    idxbad = numpy.where(phase_clean != phase_orig)
-    n_knots = numpy.int(numpy.ceil(numpy.float(len(knotvec))/3.)) # approxmiate, just for plot
-
-    # return cleaned phases, model, scatter, number of knots, indices of replaced outliers
-    return phase_clean, model[ndata:ndata + ndata], noisevec[ndata:ndata + ndata], scatter, n_knots, idxbad, weights[ndata:ndata + ndata]
-
-
-def pad_2Darray(a, width, mode):
-    pad_shape = (a.shape[0]*3, a.shape[1]*3)
-    pad_a = numpy.zeros(pad_shape)
-
-    # center
-    pad_a[a.shape[0]:2*a.shape[0], a.shape[1]:2*a.shape[1]] = a
-
-    # four corners
-    pad_a[0:a.shape[0], 0:a.shape[1]] = a[::-1, ::-1]
-    pad_a[0:a.shape[0], 2*a.shape[1]:3*a.shape[1]] = a[::-1, ::-1]
-    pad_a[2*a.shape[0]:3*a.shape[0], 2*a.shape[1]:3*a.shape[1]] = a[::-1, ::-1]
-    pad_a[2*a.shape[0]:3*a.shape[0], 0:a.shape[1]] = a[::-1, ::-1]
-
-    # middle edges
-    pad_a[0:a.shape[0], a.shape[1]:2*a.shape[1]] = a[:, ::-1]
-    pad_a[a.shape[0]:2*a.shape[0], 2*a.shape[1]:3*a.shape[1]] = a[::-1, :]
-    pad_a[2*a.shape[0]:3*a.shape[0], a.shape[1]:2*a.shape[1]] = a[:, ::-1]
-    pad_a[a.shape[0]:2*a.shape[0], 0:a.shape[1]] = a[::-1, :]
-
-    return pad_a
-
-
-def median2Dampfilter(amp_orig):
-    try:
-        from numpy import pad
-    except ImportError:
-        pad = pad_2Darray
-
-    orinal_size = numpy.shape(amp_orig)
-    # padd array by reflection around axis
-
-    amp = pad(amp_orig, ((numpy.shape(amp_orig)[0],numpy.shape(amp_orig)[0]),
-        (numpy.shape(amp_orig)[1],numpy.shape(amp_orig)[1])), mode='reflect')
-
-    # take the log
-    amp = numpy.log10(amp)
-
-    # create median filtered array
-    amp_median = scipy.ndimage.median_filter(amp, (3,5)) # so a bit more smoothing along the time-axis
-
-    # find scatter
-    idxgood = numpy.where(amp != 0.0)
-    if numpy.any(idxgood):
-        scatter_freq = findscatter_freq(amp)
-        scatter_time = findscatter_time(amp)
-    else:
-        scatter_freq  = 0.02 # just asign some value
-        scatter_time =  0.02 # just asign some value
-        #print 'scatter (freq,time)', scatter_freq, scatter_time, antenna, pol
-
-    scatter = 0.5*(scatter_freq+scatter_time) # average x-y scatter
-
-    # find bad data
-    idxbad = numpy.where((numpy.abs(amp - amp_median)) > scatter*3.)
-    baddata = numpy.copy(amp)*0.0
-    baddata[idxbad] = 1.0
-
-    # replace the bad data points
-    amp_cleaned = numpy.copy(amp)
-    amp_cleaned[idxbad] = amp_median[idxbad]
-
-    # raise to the power
-    amp = 10**amp
-    amp_median = 10**amp_median
-    amp_cleaned = 10**amp_cleaned
-
-    #back to original size
-    amp_median = amp_median[orinal_size[0]:2*orinal_size[0],orinal_size[1]:2*orinal_size[1]]
-    baddata   = baddata[orinal_size[0]:2*orinal_size[0],orinal_size[1]:2*orinal_size[1]]
-    amp_cleaned = amp_cleaned[orinal_size[0]:2*orinal_size[0],orinal_size[1]:2*orinal_size[1]]
-
-    return amp_cleaned, amp_median, baddata
-
-
-def median2Dphasefilter(phase_orig):
-    try:
-        from numpy import pad
-    except ImportError:
-        pad = pad_2Darray
-
-    orinal_size = numpy.shape(phase_orig)
-    # padd array by reflection around axis
-
-    phase = pad(phase_orig, ((numpy.shape(phase_orig)[0],numpy.shape(phase_orig)[0]),
-        (numpy.shape(phase_orig)[1],numpy.shape(phase_orig)[1])), mode='reflect')
-
-    # create median filtered array
-    phase_median = scipy.ndimage.median_filter(phase, (3,5)) # so a bit more smoothing along the time-axis
-
-    # find scatter
-    idxgood = numpy.where(phase != 0.0)
-    if numpy.any(idxgood):
-        scatter_freq = findscatter_freq(phase)
-        scatter_time = findscatter_time(phase)
-    else:
-        scatter_freq  = 0.02 # just asign some value
-        scatter_time =  0.02 # just asign some value
-        #print 'scatter (freq,time)', scatter_freq, scatter_time, antenna, pol
-
-    scatter = 0.5*(scatter_freq+scatter_time) # average x-y scatter
-
-    # find bad data
-    idxbad = numpy.where((numpy.abs(phase - phase_median)) > scatter*3.)
-    baddata = numpy.copy(phase)*0.0
-    baddata[idxbad] = 0.0
-
-    # replace the bad data points
-    phase_cleaned = numpy.copy(phase)
-    phase_cleaned[idxbad] = amp_median[idxbad]
-
-    #back to original size
-    phase_median = phase_median[orinal_size[0]:2*orinal_size[0],orinal_size[1]:2*orinal_size[1]]
-    baddata   = baddata[orinal_size[0]:2*orinal_size[0],orinal_size[1]:2*orinal_size[1]]
-    phase_cleaned = phase_cleaned[orinal_size[0]:2*orinal_size[0],orinal_size[1]:2*orinal_size[1]]
-
-    return phase_cleaned, phase_median, baddata
+from factor.lib.smoothing import smooth_series, median2Dfilter
+from factor.lib.solutions import read_solutions, write_solutions
 
 
 def main(instrument_name, instrument_name_smoothed, normalize=True, plotting=False,
@@ -505,8 +38,8 @@ def main(instrument_name, instrument_name_smoothed, normalize=True, plotting=Fal
         instrument_name_smoothed = os.path.join(scratch_dir, os.path.basename(instrument_name_smoothed_orig))
         shutil.copytree(instrument_name_orig, instrument_name)
 
-    pdb = lofar.parmdb.parmdb(instrument_name)
-    parms = pdb.getValuesGrid('*')
+    solutions = read_solutions(instrument_name)
+    parms = solutions.get_parms()
 
     key_names = parms.keys()
     nchans = len(parms[key_names[0]]['freqs'])
@@ -524,7 +57,7 @@ def main(instrument_name, instrument_name_smoothed, normalize=True, plotting=Fal
     times = (times - numpy.min(times))/24. #so we get an axis in hrs
 
     # Get station names
-    antenna_list = set([s.split(':')[-1] for s in pdb.getNames()])
+    antenna_list = set(solutions.get_stations())
 
     # for plotting
     Nr = int(numpy.ceil(numpy.sqrt(len(antenna_list))))
@@ -543,168 +76,176 @@ def main(instrument_name, instrument_name_smoothed, normalize=True, plotting=Fal
             fa2, axa2 = plt.subplots(Nr, Nc, sharex=True, sharey=True, figsize=(8,108),)
             axsa2 = axa2.reshape((Nr*Nc,1))
 
+    # some plotting setup
+    if len(times) > 500:
+        fmt = ','
+    else:
+        fmt = 'o'
+    ls='none'
+
+    # Collect the amplitudes and phases of all polarizations, stations and
+    # channels, so that they can be smoothed together in a single pool
+    series_keys = []
+    series_amp_orig = []
+    series_phase_orig = []
     for pol in pol_list:
         for istat,antenna in enumerate(sorted(antenna_list)[::-1]):
-            channel_parms_real = [parms[gain + ':' + pol + ':Real:'+ antenna]['values'][:, chan]
-                for chan in range(nchans)]
-            channel_parms_imag = [parms[gain + ':' + pol + ':Imag:'+ antenna]['values'][:, chan]
-                for chan in range(nchans)]
-
-            # some plotting setup
-            if len(channel_parms_real[0]) > 500:
-                fmt = ','
-            else:
-                fmt = 'o'
-            ls='none'
-
-            channel_amp_orig = [numpy.sqrt(channel_parms_real[chan]**2 +
-                channel_parms_imag[chan]**2) for chan in range(nchans)]
-            channel_phase_orig = [numpy.arctan2(channel_parms_imag[chan],
-                channel_parms_real[chan]) for chan in range(nchans)]
-
-            # Check for NaNs. If found, set amps to 1 and phases to 0.0
+            parms_real = parms[gain + ':' + pol + ':Real:'+ antenna]['values']
+            parms_imag = parms[gain + ':' + pol + ':Imag:'+ antenna]['values']
             for chan in range(nchans):
-                flagged_indx = numpy.where(numpy.isnan(channel_amp_orig[chan]))
-                if len(flagged_indx[0]) > 0:
-                    channel_amp_orig[chan][flagged_indx] = 1.0
-                flagged_indx = numpy.where(numpy.isnan(channel_phase_orig[chan]))
-                if len(flagged_indx[0]) > 0:
-                    channel_phase_orig[chan][flagged_indx] = 0.0
-
-            # now find the bad data
-            pool = multiprocessing.Pool()
-            amp_results = pool.map(spline1D_amp, channel_amp_orig)
-            pool.close()
-            pool.join()
-            pool = multiprocessing.Pool()
-            phase_results = pool.map(spline1D_phase, channel_phase_orig)
-            pool.close()
-            pool.join()
-
-            for chan, ((amp_cleaned, model, noisevec, scatter, n_knots, idxbad, weights),
-                (phase_cleaned, phase_model, phase_noisevec, phase_scatter, phase_n_knots,
-                phase_idxbad, phase_weights)) in enumerate(zip(amp_results, phase_results)):
-                # put back the results
-                parms[gain + ':' + pol + ':Real:' + antenna]['values'][:, chan] = numpy.copy(amp_cleaned*numpy.cos(phase_cleaned))
-                parms[gain + ':' + pol + ':Imag:' + antenna]['values'][:, chan] = numpy.copy(amp_cleaned*numpy.sin(phase_cleaned))
+                amp_orig = numpy.sqrt(parms_real[:, chan]**2 + parms_imag[:, chan]**2)
+                phase_orig = numpy.arctan2(parms_imag[:, chan], parms_real[:, chan])
+
+                # Check for NaNs. If found, set amps to 1 and phases to 0.0
+                amp_orig[numpy.isnan(amp_orig)] = 1.0
+                phase_orig[numpy.isnan(phase_orig)] = 0.0
+
+                series_keys.append((pol, istat, antenna, chan))
+                series_amp_orig.append(amp_orig)
+                series_phase_orig.append(phase_orig)
+
+    # now find the bad data
+    pool = multiprocessing.Pool()
+    amp_results = smooth_series(series_amp_orig, log=True, skip_zeros=True, pool=pool)
+    phase_results = smooth_series(series_phase_orig, log=False, skip_zeros=True, pool=pool)
+    pool.close()
+    pool.join()
+
+    for (pol, istat, antenna, chan), amp_orig, phase_orig, amp_result, phase_result in zip(
+        series_keys, series_amp_orig, series_phase_orig, amp_results, phase_results):
+        amp_cleaned, model, noisevec, scatter, n_knots, idxbad, weights = amp_result
+        (phase_cleaned, phase_model, phase_noisevec, phase_scatter, phase_n_knots,
+            phase_idxbad, phase_weights) = phase_result
+
+        # put back the results
+        parms[gain + ':' + pol + ':Real:' + antenna]['values'][:, chan] = amp_cleaned*numpy.cos(phase_cleaned)
+        parms[gain + ':' + pol + ':Imag:' + antenna]['values'][:, chan] = amp_cleaned*numpy.sin(phase_cleaned)
+
+        if pol in pol_list[0]:
+            cc = 'blue'
+            ccf = 'orange'
+        else:
+            cc = 'green'
+            ccf= 'red'
+
+        timevec = numpy.arange(0,len(amp_orig))
+
+        # only plot one channel, just to verify code works
+        if plot_phases:
+            if plotting and chan == nchans-1: # plot last channel
+                axsa[istat][0].plot(timevec,numpy.mod(phase_cleaned+numpy.pi, 2*numpy.pi) - numpy.pi , marker=fmt, ls=ls,
+                    markersize=500/len(phase_cleaned), c=cc,mec=cc)
+                axsa[istat][0].plot(timevec,phase_noisevec, c=cc, lw=0.75, ls='--')
 
                 if pol in pol_list[0]:
-                    cc = 'blue'
-                    ccf = 'orange'
+                    axsa[istat][0].annotate('scatter=' +'{:.2g}'.format(phase_scatter),
+                        xy=(0.5,0.15), color=cc,textcoords='axes fraction')
+                    axsa[istat][0].annotate('#knots=' +'{:d}'.format(phase_n_knots),
+                        xy=(0.01,0.15), color=cc,textcoords='axes fraction') # we divded by three beucase we mirrored the array
                 else:
-                    cc = 'green'
-                    ccf= 'red'
-
-                timevec = numpy.arange(0,len(channel_amp_orig[chan]))
-
-                # only plot one channel, just to verify code works
-                if plot_phases:
-                    if plotting and chan == nchans-1: # plot last channel
-                        axsa[istat][0].plot(timevec,numpy.mod(phase_cleaned+numpy.pi, 2*numpy.pi) - numpy.pi , marker=fmt, ls=ls,
-                            markersize=500/len(phase_cleaned), c=cc,mec=cc)
-                        axsa[istat][0].plot(timevec,phase_noisevec, c=cc, lw=0.75, ls='--')
-
-                        if pol in pol_list[0]:
-                            axsa[istat][0].annotate('scatter=' +'{:.2g}'.format(phase_scatter),
-                                xy=(0.5,0.15), color=cc,textcoords='axes fraction')
-                            axsa[istat][0].annotate('#knots=' +'{:d}'.format(phase_n_knots),
-                                xy=(0.01,0.15), color=cc,textcoords='axes fraction') # we divded by three beucase we mirrored the array
-                        else:
-                            axsa[istat][0].annotate('scatter=' +'{:.2g}'.format(phase_scatter),
-                                xy=(0.5,0.02), color=cc, textcoords='axes fraction')
-                            axsa[istat][0].annotate('#knots=' +'{:d}'.format(phase_n_knots),
-                                xy=(0.01,0.02), color=cc,textcoords='axes fraction')
-
-                        if numpy.any(phase_idxbad):
-                            axsa[istat][0].plot(timevec[phase_idxbad],channel_phase_orig[chan][phase_idxbad],
-                                marker='o', c=ccf, ls=ls, markersize=4)
-
-                        idxbadi = numpy.where(phase_weights < 1.0)
-                        if numpy.any(idxbadi):
-                            axsa[istat][0].plot(timevec[idxbadi],numpy.mod(channel_phase_orig[chan][idxbadi]+numpy.pi, 2*numpy.pi) - numpy.pi,
-                                marker='o', c='black', ls=ls, markersize=4, mec='black')
-
-                        axsa[istat][0].plot(timevec, numpy.mod(phase_model+numpy.pi, 2*numpy.pi) - numpy.pi, c=ccf, lw=1.0)
-                        axsa[istat][0].set_title(antenna)
-                        axsa[istat][0].set_ylim(-3.14, 3.14)
-                        axsa[istat][0].set_xlim(0, max(timevec))
-                else:
-                    if plotting and chan == nchans-1: # plot last channel
-                        axsa[istat][0].plot(timevec, amp_cleaned, marker=fmt, ls=ls,
-                            markersize=0.1*len(amp_cleaned), c=cc,mec=cc)
-                        axsa[istat][0].plot(timevec,noisevec, c=cc, lw=0.75, ls='--')
-
-                        if pol in pol_list[0]:
-                            axsa[istat][0].annotate('scatter=' +'{:.2g}'.format(scatter),
-                                xy=(0.5,0.15), color=cc,textcoords='axes fraction')
-                            axsa[istat][0].annotate('#knots=' +'{:d}'.format(n_knots),
-                                xy=(0.01,0.15), color=cc,textcoords='axes fraction') # we divded by three beucase we mirrored the array
-                        else:
-                            axsa[istat][0].annotate('scatter=' +'{:.2g}'.format(scatter),
-                                xy=(0.5,0.02), color=cc, textcoords='axes fraction')
-                            axsa[istat][0].annotate('#knots=' +'{:d}'.format(n_knots),
-                                xy=(0.01,0.02), color=cc,textcoords='axes fraction')
-
-                        if numpy.any(idxbad):
-                            axsa[istat][0].plot(timevec[idxbad],channel_amp_orig[chan][idxbad],
-                                marker='o', c=ccf, ls=ls, markersize=4)
-
-                        idxbadi = numpy.where(weights < 1.0)
-                        if numpy.any(idxbadi):
-                            axsa[istat][0].plot(timevec[idxbadi],channel_amp_orig[chan][idxbadi],
-                                marker='o', c='black', ls=ls, markersize=4, mec='black')
-
-                        axsa[istat][0].plot(timevec, model, c=ccf, lw=1.0)
-                        axsa[istat][0].set_title(antenna)
-                        axsa[istat][0].set_ylim(-0.3, 2)
-                        axsa[istat][0].set_xlim(0, max(timevec))
-
-            if nchans > 5: # Do 2D smooth
-                channel_parms_real = [parms[gain + ':' + pol + ':Real:'+ antenna]['values'][:, chan]
-                    for chan in range(nchans)]
-                channel_parms_imag = [parms[gain + ':' + pol + ':Imag:'+ antenna]['values'][:, chan]
-                    for chan in range(nchans)]
-                channel_parms_real =  numpy.asarray(channel_parms_real)
-                channel_parms_imag =  numpy.asarray(channel_parms_imag)
-                channel_amp_orig = [numpy.sqrt(channel_parms_real[chan]**2 +
-                    channel_parms_imag[chan]**2) for chan in range(nchans)]
-                amp_orig = numpy.sqrt(channel_parms_real[:]**2 + channel_parms_imag[:]**2)
-                phase_orig = numpy.arctan2(channel_parms_imag[:], channel_parms_real[:]**2)
-
-                amp_cleaned, amp_median, baddata = median2Dampfilter(numpy.copy(amp_orig))
-                phase_cleaned, phase_median, phase_baddata = median2Dphasefilter(numpy.copy(phase_orig))
-
-                for chan in range(nchans):
-                    # put back the results
-                    parms[gain + ':' + pol + ':Real:' + antenna]['values'][:, chan] = numpy.copy((amp_cleaned[chan,:])*numpy.cos(phase_cleaned[chan,:]))
-                    parms[gain + ':' + pol + ':Imag:' + antenna]['values'][:, chan] = numpy.copy((amp_cleaned[chan,:])*numpy.sin(phase_cleaned[chan,:]))
-
-                if plotting:
-                    axsa2[4*istat][0].imshow(numpy.transpose(amp_orig),
-                        interpolation='none',origin='lower',clim=(0.5, 1.5),aspect='auto')
-                    axsa2[4*istat][0].set_xlabel('freq')
-                    axsa2[4*istat][0].set_ylabel('time')
-                    axsa2[4*istat][0].set_title('Original' + '    ' + antenna)
-
-                    axsa2[4*istat+1][0].imshow(numpy.transpose(amp_median),
-                        interpolation='none',origin='lower',aspect='auto', clim=(0.5,1.5))
-                    axsa2[4*istat+1][0].set_xlabel('freq')
-                    axsa2[4*istat+1][0].set_ylabel('time')
-                    axsa2[4*istat+1][0].set_title('2D median model')
-
-                    axsa2[4*istat+2][0].imshow(numpy.transpose(numpy.abs(amp_orig-amp_median)),
-                        interpolation='none',origin='lower',clim=(0.0, 0.3),aspect='auto')
-                    axsa2[4*istat+2][0].set_xlabel('freq')
-                    axsa2[4*istat+2][0].set_ylabel('time')
-                    axsa2[4*istat+2][0].set_title('abs(Residual)')
-
-                    axsa2[4*istat+3][0].imshow(numpy.transpose(baddata),
-                        interpolation='none',origin='lower',clim=(0.0, 2.0),
-                        aspect='auto', cmap='gnuplot')
-                    axsa2[4*istat+3][0].set_xlabel('freq')
-                    axsa2[4*istat+3][0].set_ylabel('time')
-                    axsa2[4*istat+3][0].set_title('Replaced solutions')
+                    axsa[istat][0].annotate('scatter=' +'{:.2g}'.format(phase_scatter),
+                        xy=(0.5,0.02), color=cc, textcoords='axes fraction')
+                    axsa[istat][0].annotate('#knots=' +'{:d}'.format(phase_n_knots),
+                        xy=(0.01,0.02), color=cc,textcoords='axes fraction')
+
+                if numpy.any(phase_idxbad):
+                    axsa[istat][0].plot(timevec[phase_idxbad],phase_orig[phase_idxbad],
+                        marker='o', c=ccf, ls=ls, markersize=4)
+
+                idxbadi = numpy.where(phase_weights < 1.0)
+                if numpy.any(idxbadi):
+                    axsa[istat][0].plot(timevec[idxbadi],numpy.mod(phase_orig[idxbadi]+numpy.pi, 2*numpy.pi) - numpy.pi,
+                        marker='o', c='black', ls=ls, markersize=4, mec='black')
+
+                axsa[istat][0].plot(timevec, numpy.mod(phase_model+numpy.pi, 2*numpy.pi) - numpy.pi, c=ccf, lw=1.0)
+                axsa[istat][0].set_title(antenna)
+                axsa[istat][0].set_ylim(-3.14, 3.14)
+                axsa[istat][0].set_xlim(0, max(timevec))
+        else:
+            if plotting and chan == nchans-1: # plot last channel
+                axsa[istat][0].plot(timevec, amp_cleaned, marker=fmt, ls=ls,
+                    markersize=0.1*len(amp_cleaned), c=cc,mec=cc)
+                axsa[istat][0].plot(timevec,noisevec, c=cc, lw=0.75, ls='--')
 
+                if pol in pol_list[0]:
+                    axsa[istat][0].annotate('scatter=' +'{:.2g}'.format(scatter),
+                        xy=(0.5,0.15), color=cc,textcoords='axes fraction')
+                    axsa[istat][0].annotate('#knots=' +'{:d}'.format(n_knots),
+                        xy=(0.01,0.15), color=cc,textcoords='axes fraction') # we divded by three beucase we mirrored the array
+                else:
+                    axsa[istat][0].annotate('scatter=' +'{:.2g}'.format(scatter),
+                        xy=(0.5,0.02), color=cc, textcoords='axes fraction')
+                    axsa[istat][0].annotate('#knots=' +'{:d}'.format(n_knots),
+                        xy=(0.01,0.02), color=cc,textcoords='axes fraction')
+
+                if numpy.any(idxbad):
+                    axsa[istat][0].plot(timevec[idxbad],amp_orig[idxbad],
+                        marker='o', c=ccf, ls=ls, markersize=4)
+
+                idxbadi = numpy.where(weights < 1.0)
+                if numpy.any(idxbadi):
+                    axsa[istat][0].plot(timevec[idxbadi],amp_orig[idxbadi],
+                        marker='o', c='black', ls=ls, markersize=4, mec='black')
+
+                axsa[istat][0].plot(timevec, model, c=ccf, lw=1.0)
+                axsa[istat][0].set_title(antenna)
+                axsa[istat][0].set_ylim(-0.3, 2)
+                axsa[istat][0].set_xlim(0, max(timevec))
+
+    if nchans > 5: # Do 2D smooth
+        # Collect the (chan, time) amplitudes and phases of all polarizations
+        # and stations, so that they can be filtered together
+        stack_keys = []
+        stack_amp_orig = []
+        stack_phase_orig = []
+        for pol in pol_list:
+            for istat,antenna in enumerate(sorted(antenna_list)[::-1]):
+                channel_parms_real = numpy.transpose(parms[gain + ':' + pol + ':Real:'+ antenna]['values'])
+                channel_parms_imag = numpy.transpose(parms[gain + ':' + pol + ':Imag:'+ antenna]['values'])
+                stack_keys.append((pol, istat, antenna))
+                stack_amp_orig.append(numpy.sqrt(channel_parms_real**2 + channel_parms_imag**2))
+                stack_phase_orig.append(numpy.arctan2(channel_parms_imag, channel_parms_real))
+
+        amp_cleaned_stack, amp_median_stack, baddata_stack = median2Dfilter(
+            numpy.array(stack_amp_orig), log=True)
+        phase_cleaned_stack, phase_median_stack, phase_baddata_stack = median2Dfilter(
+            numpy.array(stack_phase_orig), log=False)
+
+        for i, (pol, istat, antenna) in enumerate(stack_keys):
+            # put back the results
+            amp_orig = stack_amp_orig[i]
+            amp_cleaned = amp_cleaned_stack[i]
+            amp_median = amp_median_stack[i]
+            baddata = baddata_stack[i]
+            phase_cleaned = phase_cleaned_stack[i]
+            parms[gain + ':' + pol + ':Real:' + antenna]['values'][:] = numpy.transpose(amp_cleaned*numpy.cos(phase_cleaned))
+            parms[gain + ':' + pol + ':Imag:' + antenna]['values'][:] = numpy.transpose(amp_cleaned*numpy.sin(phase_cleaned))
+
+            if plotting:
+                axsa2[4*istat][0].imshow(numpy.transpose(amp_orig),
+                    interpolation='none',origin='lower',clim=(0.5, 1.5),aspect='auto')
+                axsa2[4*istat][0].set_xlabel('freq')
+                axsa2[4*istat][0].set_ylabel('time')
+                axsa2[4*istat][0].set_title('Original' + '    ' + antenna)
+
+                axsa2[4*istat+1][0].imshow(numpy.transpose(amp_median),
+                    interpolation='none',origin='lower',aspect='auto', clim=(0.5,1.5))
+                axsa2[4*istat+1][0].set_xlabel('freq')
+                axsa2[4*istat+1][0].set_ylabel('time')
+                axsa2[4*istat+1][0].set_title('2D median model')
+
+                axsa2[4*istat+2][0].imshow(numpy.transpose(numpy.abs(amp_orig-amp_median)),
+                    interpolation='none',origin='lower',clim=(0.0, 0.3),aspect='auto')
+                axsa2[4*istat+2][0].set_xlabel('freq')
+                axsa2[4*istat+2][0].set_ylabel('time')
+                axsa2[4*istat+2][0].set_title('abs(Residual)')
+
+                axsa2[4*istat+3][0].imshow(numpy.transpose(baddata),
+                    interpolation='none',origin='lower',clim=(0.0, 2.0),
+                    aspect='auto', cmap='gnuplot')
+                axsa2[4*istat+3][0].set_xlabel('freq')
+                axsa2[4*istat+3][0].set_ylabel('time')
+                axsa2[4*istat+3][0].set_title('Replaced solutions')
 
     if plotting:
         fa.savefig('1Dsmooth.png', dpi=100)
@@ -749,9 +290,7 @@ def main(instrument_name, instrument_name_smoothed, normalize=True, plotting=Fal
 
     if os.path.exists(instrument_name_smoothed):
         shutil.rmtree(instrument_name_smoothed)
-    pdbnew = lofar.parmdb.parmdb(instrument_name_smoothed, create=True)
-    pdbnew.addValues(parms)
-    pdbnew.flush()
+    write_solutions(solutions, instrument_name_smoothed)
 
     # Copy output to original path and delete copies if scratch directory is specified
     if scratch_dir is not None: